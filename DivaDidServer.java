@@ -0,0 +1,55 @@
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+
+import ch.unifr.diuf.diva.did.DivaDid;
+
+/**
+ * A long-lived DivaDID process
+ *
+ * Reads one degradation script path per line on stdin, runs it through
+ * DivaDID and answers with a single "OK" or "ERROR message" line on stdout
+ * once the output image has been written. This lets divadid.py pay for JVM
+ * startup, jar loading and JIT warm-up once per worker instead of once per
+ * script.
+ *
+ * Run with Java 11+ directly from source:
+ *
+ *     java -cp DivaDid.jar DivaDidServer.java
+ */
+public class DivaDidServer {
+    public static void main(String[] args) throws IOException {
+        PrintStream protocol = System.out;
+
+        // DivaDID prints progress to stdout; keep it off the protocol stream.
+        System.setOut(new PrintStream(new OutputStream() {
+            @Override
+            public void write(int b) {
+            }
+        }));
+
+        BufferedReader in = new BufferedReader(
+                new InputStreamReader(System.in, "UTF-8"));
+
+        protocol.println("READY");
+        protocol.flush();
+
+        String line;
+        while ((line = in.readLine()) != null) {
+            line = line.trim();
+            if (line.isEmpty()) {
+                continue;
+            }
+
+            try {
+                DivaDid.main(new String[] { line });
+                protocol.println("OK");
+            } catch (Throwable t) {
+                protocol.println("ERROR " + String.valueOf(t).replace('\n', ' '));
+            }
+            protocol.flush();
+        }
+    }
+}
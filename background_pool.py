@@ -0,0 +1,284 @@
+"""
+A pool of validated, pre-decoded background pages
+
+Background scans are large, and picking one used to mean listing the
+background folder and decoding a multi-megapixel JPEG or TIFF for every page,
+only to silently give up on files that failed to decode. This module instead:
+
+1. Indexes the background folder once, recording the dimensions of every page
+   and rejecting the ones that cannot be decoded. The index is saved to the
+   cache directory and rebuilt when the folder changes, like word_index.
+
+2. Optionally keeps decoded pages as .npy files in TMP_DIR. Workers map them
+   read-only, so a page decoded by one worker is reused by all the others
+   without decoding it again. The cache is bounded by a size budget and evicts
+   the least recently used pages first.
+"""
+import configparser
+import hashlib
+import os
+import random
+import sys
+
+import cv2
+import numpy as np
+
+from word_index import IMAGE_EXTENSIONS, folder_signature
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+TMP_DIR = CONFIG['DIRECTORIES']['tmp_dir']
+CACHE_DIR = CONFIG.get('DIRECTORIES', 'cache_dir', fallback="./cache/")
+
+DECODED_CACHE = CONFIG.getboolean('BACKGROUNDS', 'decoded_cache',
+                                  fallback=False)
+DECODED_CACHE_BUDGET_MB = CONFIG.getint('BACKGROUNDS', 'decoded_cache_mb',
+                                        fallback=4096)
+
+# Bumped whenever the on-disk layout of the index changes
+INDEX_VERSION = 1
+
+_loaded_indexes = {}
+
+
+class BackgroundIndex:
+    """
+    The valid background pages of a folder
+
+    paths : np.ndarray of bytes
+        Paths relative to `root`, utf-8 encoded
+    heights, widths : np.ndarray of uint32
+        The dimensions of each page
+    """
+
+    def __init__(self, root, paths, heights, widths, signature):
+        self.root = root
+        self.paths = paths
+        self.heights = heights
+        self.widths = widths
+        self.signature = signature
+
+    def __len__(self):
+        return len(self.paths)
+
+    def path(self, index):
+        """ The full path of the page at `index`. """
+
+        return os.path.join(self.root, self.paths[index].decode("utf-8"))
+
+    def random_index(self, rng=random):
+        """ Pick a page uniformly at random. """
+
+        return rng.randrange(len(self.paths))
+
+    @classmethod
+    def build(cls, root, signature=None):
+        """
+        Decode every image in `root` once, keeping the ones that are valid
+        """
+
+        if signature is None:
+            signature = folder_signature(root)
+
+        paths = []
+        heights = []
+        widths = []
+
+        for name in sorted(os.listdir(root)):
+            full_path = os.path.join(root, name)
+            if not name.lower().endswith(IMAGE_EXTENSIONS) or \
+                    not os.path.isfile(full_path):
+                continue
+
+            img = cv2.imread(full_path)
+            if img is None:
+                print("Rejecting background {}: cannot be decoded".format(
+                    full_path), file=sys.stderr)
+                continue
+
+            paths.append(name.encode("utf-8"))
+            heights.append(img.shape[0])
+            widths.append(img.shape[1])
+
+        if not paths:
+            raise OSError("{} folder contains no valid background images"
+                          .format(root))
+
+        return cls(root,
+                   np.array(paths, dtype=bytes),
+                   np.array(heights, dtype=np.uint32),
+                   np.array(widths, dtype=np.uint32),
+                   signature)
+
+    def save(self, file):
+        """ Atomically save the index to `file`. """
+
+        tmp_file = "{}.{}.tmp".format(file, os.getpid())
+
+        with open(tmp_file, 'wb') as index_file:
+            np.savez(index_file,
+                     version=INDEX_VERSION,
+                     paths=self.paths,
+                     heights=self.heights,
+                     widths=self.widths,
+                     signature=self.signature)
+
+        os.replace(tmp_file, file)
+
+    @classmethod
+    def load(cls, file, root):
+        """ Load an index previously saved to `file`. """
+
+        with np.load(file) as data:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError("Outdated background index {}".format(file))
+
+            return cls(root,
+                       data['paths'],
+                       data['heights'],
+                       data['widths'],
+                       str(data['signature']))
+
+
+def _root_key(root):
+    return hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()[0:16]
+
+
+def load_index(root, cache_dir=CACHE_DIR):
+    """
+    Get the background index of a folder
+
+    The saved index is reused if the folder is unchanged since it was built.
+    Otherwise every page is decoded once more to validate it, and the index
+    saved again.
+    """
+
+    if root in _loaded_indexes:
+        return _loaded_indexes[root]
+
+    file = os.path.join(cache_dir, "backgrounds_{}.npz".format(_root_key(root)))
+    signature = folder_signature(root)
+
+    index = None
+    if os.path.isfile(file):
+        try:
+            index = BackgroundIndex.load(file, root)
+        except (OSError, ValueError, KeyError):
+            index = None
+
+    if index is None or index.signature != signature:
+        index = BackgroundIndex.build(root, signature)
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(file)
+
+    _loaded_indexes[root] = index
+
+    return index
+
+
+def _evict(cache_dir, budget_bytes):
+    """ Remove least recently used pages until the cache fits its budget. """
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if total <= budget_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def scale_to_height(img, height):
+    """
+    Scale an image down to `height`, keeping its aspect ratio
+
+    Images no taller than `height` are returned as they are, as are all
+    images if `height` is None.
+    """
+
+    if height is None or img.shape[0] <= height:
+        return img
+
+    width = max(1, int(round(img.shape[1] * height / img.shape[0])))
+
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def read_background(index, page, use_cache=DECODED_CACHE,
+                    budget_mb=DECODED_CACHE_BUDGET_MB, tmp_dir=TMP_DIR,
+                    grayscale=False, height=None):
+    """
+    Get the decoded pixels of a background page
+
+    Parameters
+    ----------
+    index : BackgroundIndex
+        The index the page belongs to
+    page : int
+        The position of the page in the index
+    use_cache : bool, optional
+        Whether to go through the shared decoded cache
+    budget_mb : int, optional
+        The maximum size of the decoded cache, in megabytes
+    tmp_dir : str, optional
+        Where the decoded cache is kept
+    grayscale : bool, optional
+        Whether to decode the page as a single gray channel
+    height : int, optional
+        Scale the page down to this height (see scale_to_height). Scaled
+        pages are cached at their scale
+
+    Returns
+    -------
+    np.ndarray or None
+        The BGR page, or the 2-D gray page. Pages served from the cache are read-only memory maps,
+        so callers must copy before modifying them in place. None if the page
+        can no longer be decoded.
+    """
+
+    flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+
+    if not use_cache:
+        img = cv2.imread(index.path(page), flags)
+        return None if img is None else scale_to_height(img, height)
+
+    cache_dir = os.path.join(tmp_dir, "backgrounds_{}_{}".format(
+        _root_key(index.root), index.signature[0:12]))
+    file = os.path.join(cache_dir, "{}{}{}.npy".format(
+        page, "" if height is None else "_h{}".format(height),
+        "_gray" if grayscale else ""))
+
+    try:
+        img = np.load(file, mmap_mode='r')
+        # Mark the page as recently used for eviction
+        os.utime(file)
+        return img
+    except (FileNotFoundError, ValueError):
+        pass
+
+    img = cv2.imread(index.path(page), flags)
+    if img is None:
+        return None
+    img = scale_to_height(img, height)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    tmp_file = "{}.{}.tmp".format(file, os.getpid())
+    with open(tmp_file, 'wb') as page_file:
+        np.save(page_file, img)
+    os.replace(tmp_file, file)
+
+    _evict(cache_dir, budget_mb * 1024 * 1024)
+
+    return img
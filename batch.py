@@ -0,0 +1,227 @@
+"""
+Generate synthetic documents as arrays, on the fly
+
+This module makes Document usable as a data source for a training loop:
+instead of writing pages to disk and reading them back, generate_batch yields
+(image, ground_truth, metadata) tuples straight from a pool of worker
+processes. Only a bounded number of documents is generated ahead of the
+consumer, so memory use stays flat however many pages are requested.
+
+    for image, ground_truth, metadata in generate_batch(1000, seed=42):
+        ...
+"""
+import collections
+import itertools
+import multiprocessing
+import sys
+
+import background_pool
+import cv2
+import degradation
+import divadid
+import word_atlas
+import word_index
+
+from document import BACKGROUND_IMAGES_DIR, DEFAULT_GRAYSCALE
+from document import HANDWRITTEN_WORDS_DIR
+from document import Document, dprint, new_run_seed
+
+# generate_batch gives up once this many documents in a row fail to generate,
+# rather than trying forever when every document fails the same way
+MAX_CONSECUTIVE_FAILURES = 20
+
+
+def init_worker(engine, grayscale=False):
+    """
+    Prepare a pool worker process
+
+    Parameters
+    ----------
+    engine : str
+        The degradation engine the documents use
+    grayscale : bool, optional
+        Whether the documents are gray, which needs gray stains
+
+    Like generate_images.init_worker, loads everything that is shared between
+    documents (indexes, the word atlas, stains, the DivaDID JVM) once per
+    process rather than per page.
+    """
+    words = word_index.load_index(HANDWRITTEN_WORDS_DIR)
+    if word_atlas.ATLAS_ENABLED:
+        word_atlas.load_atlas(words)
+
+    background_pool.load_index(BACKGROUND_IMAGES_DIR)
+
+    if engine == "native":
+        degradation.load_stains(grayscale=grayscale)
+    elif engine == "divadid" and divadid.PERSISTENT_WORKER:
+        divadid.get_worker().start()
+
+
+def generate_document(fn_args):
+    """
+    Generate a single document in memory
+
+    Parameters
+    ----------
+    fn_args : dict
+        'index': the position of the document in the batch
+        'run_seed': the seed of the batch
+        'bypass': passed to Document.create
+        'document_args': keyword arguments for Document
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, dict) or None
+        The page, its ground truth and metadata about how it was generated,
+        or None if the document could not be generated, for instance because
+        an image could not be read
+    """
+
+    try:
+        document = Document(in_memory=True, run_seed=fn_args['run_seed'],
+                            index=fn_args['index'],
+                            **fn_args['document_args'])
+        document.create(bypass=fn_args['bypass'])
+
+    except (cv2.error, OSError) as exception:
+        dprint("Document {} of run {} failed: {}".format(
+            fn_args['index'], fn_args['run_seed'], exception),
+            file=sys.stderr)
+
+        return None
+
+    if document.image is None or document.ground_truth is None:
+        return None
+
+    metadata = {
+        'name': document.name,
+        'run_seed': document.run_seed,
+        'index': document.index,
+        'background': document.background,
+        'engine': document.engine,
+        'stain_level': document.stain_level,
+        'noise_level': document.text_noisy_level,
+        'grayscale': document.grayscale,
+        'word_boxes': document.word_boxes,
+    }
+
+    return document.image, document.ground_truth, metadata
+
+
+def generate_batch(n=None, seed=None, processes=None, prefetch=None,
+                   bypass=False, max_failures=MAX_CONSECUTIVE_FAILURES,
+                   **document_args):
+    """
+    Generate documents and yield them as arrays
+
+    Parameters
+    ----------
+    n : int, optional
+        The number of documents to yield. None yields documents forever
+    seed : int, optional
+        The run seed of the batch. Document i is seeded from the i-th child
+        of its SeedSequence, so a batch is reproducible. None draws a random
+        run seed
+    processes : int, optional
+        The number of worker processes. None uses one per CPU, 0 generates
+        in the calling process
+    prefetch : int, optional
+        The maximum number of documents generated ahead of the consumer.
+        Defaults to twice the number of processes
+    bypass : bool, optional
+        Passed to Document.create
+    max_failures : int, optional
+        Raise a RuntimeError once this many documents in a row fail to
+        generate. 0 never gives up
+    **document_args
+        Passed to Document (stain_level, noise_level, engine, ...). Patch
+        generation (patch_count) is not supported
+
+    Yields
+    ------
+    (np.ndarray, np.ndarray, dict)
+        A page, its 0/1 ground truth and metadata about how it was
+        generated, in order. Documents that fail to generate are skipped and
+        replaced, so exactly `n` documents are yielded.
+
+    The word atlas is built here, before the workers start, and every worker
+    loads the indexes and stains up front (see init_worker).
+    """
+
+    if document_args.get('patch_count'):
+        raise ValueError("generate_batch yields whole pages, patch_count is "
+                         "not supported")
+
+    if seed is None:
+        seed = new_run_seed()
+
+    def task(index):
+        return {
+            'index': index,
+            'run_seed': seed,
+            'bypass': bypass,
+            'document_args': document_args,
+        }
+
+    tasks = map(task, itertools.count())
+    yielded = 0
+    failures = 0
+
+    def accept(result):
+        """ Whether to yield `result`, counting documents that failed. """
+        nonlocal failures
+
+        if result is not None:
+            failures = 0
+            return True
+
+        failures += 1
+        if max_failures and failures >= max_failures:
+            raise RuntimeError("{} documents in a row failed to generate, "
+                               "giving up".format(failures))
+
+        return False
+
+    # Build the shared word atlas once, before the workers start mapping it
+    if word_atlas.ATLAS_ENABLED:
+        word_atlas.load_atlas(word_index.load_index(HANDWRITTEN_WORDS_DIR))
+
+    if processes == 0:
+        for fn_args in tasks:
+            if n is not None and yielded >= n:
+                return
+
+            result = generate_document(fn_args)
+            if accept(result):
+                yielded += 1
+                yield result
+        return
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if prefetch is None:
+        prefetch = 2 * processes
+
+    engine = document_args.get('engine', degradation.DEFAULT_ENGINE)
+    if bypass and engine == "divadid":
+        engine = "native"
+
+    with multiprocessing.Pool(processes, initializer=init_worker,
+                              initargs=(engine, document_args.get(
+                                  'grayscale', DEFAULT_GRAYSCALE))) as pool:
+        pending = collections.deque()
+
+        while n is None or yielded < n:
+            # Keep just enough documents in flight to cover what is still
+            # needed, up to the prefetch limit.
+            while len(pending) < prefetch and \
+                    (n is None or yielded + len(pending) < n):
+                pending.append(pool.apply_async(generate_document,
+                                                (next(tasks),)))
+
+            result = pending.popleft().get()
+            if accept(result):
+                yielded += 1
+                yield result
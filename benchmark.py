@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+End-to-end generation benchmark
+
+Measures how fast Document.create (and the encoding of its output) runs on
+procedurally generated fixtures, so that no real data set is needed:
+
+    ./benchmark.py run --output results.json
+    ./benchmark.py compare results.json baseline.json
+
+`run` fabricates background pages of every requested size, handwritten words
+and stains in a scratch directory, then runs every combination of mode, page
+size and worker count in a fresh process, with a settings.ini pointing at the
+fixtures. Modes are:
+
+    bypass    DivaDID bypassed, pages degraded by the native engine
+    stub      the DivaDID engine, with java replaced by a stub speaking the
+              DivaDidServer protocol that copies images unchanged, which
+              measures everything but DivaDID itself
+    divadid   the real DivaDID, skipped when java cannot be found
+
+With --fade_blur, every case is also run once per blur mode of the
+bleed-through text (see image_util.BLUR_MODES), so that the cost of the
+text_fade_blur stage can be compared between modes.
+
+Each case reports pages/sec, the peak resident memory of the main process
+and of its workers, and the p50/p95/max of every stage (see stage_timer).
+Results are written as JSON. `compare` flags every case whose throughput
+dropped, or whose peak memory grew, by more than a threshold relative to a
+baseline, and exits with a non-zero status if any did.
+"""
+import argparse
+import configparser
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import image_util
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODES = ("bypass", "stub", "divadid")
+
+# The DivaDID stub: answers the DivaDidServer protocol, or runs a single
+# script like `java -jar`, by copying the script's input to its output
+DIVADID_STUB = """#!{python}
+import shutil
+import sys
+import xml.etree.ElementTree as ElementTree
+
+
+def run(script):
+    root = ElementTree.parse(script).getroot()
+    shutil.copyfile(root.find('alias').get('value'),
+                    root.find('save').get('file'))
+
+
+if "-jar" in sys.argv:
+    run(sys.argv[-1])
+    sys.exit(0)
+
+print("READY", flush=True)
+for line in sys.stdin:
+    try:
+        run(line.strip())
+        print("OK", flush=True)
+    except Exception as exception:
+        print("ERROR {{}}".format(exception), flush=True)
+"""
+
+
+def parse_size(value):
+    """ Parse a WIDTHxHEIGHT page size. """
+
+    try:
+        width, height = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Page sizes must look like 1700x2200")
+
+    return width, height
+
+
+def make_backgrounds(folder, size, count, rng):
+    """ Paper-like pages: a warm tone with blotchy shading and grain. """
+
+    os.makedirs(folder, exist_ok=True)
+    width, height = size
+
+    for page in range(count):
+        tone = rng.uniform(190, 235) * np.array([0.93, 0.97, 1.0])
+
+        shading = rng.normal(0, 1, (max(2, height // 64), max(2, width // 64)))
+        shading = cv2.resize(shading.astype(np.float32), (width, height),
+                             interpolation=cv2.INTER_CUBIC)
+
+        img = tone[None, None, :] + 8 * shading[:, :, None] \
+            + rng.normal(0, 3, (height, width, 3))
+
+        cv2.imwrite(os.path.join(folder, "page_{:03d}.png".format(page)),
+                    np.clip(img, 0, 255).astype(np.uint8))
+
+
+def draw_word(rng, height=None, width=None):
+    """ Dark pen strokes on white, as a grayscale word image. """
+
+    if height is None:
+        height = int(rng.integers(40, 110))
+    if width is None:
+        width = int(rng.integers(60, 400))
+
+    img = np.full((height, width), 255, np.uint8)
+
+    x = 5
+    while x < width - 10:
+        points = np.stack([
+            x + np.cumsum(rng.integers(0, 6, 12)),
+            rng.integers(height // 4, 3 * height // 4, 12),
+        ], axis=1).astype(np.int32)
+        cv2.polylines(img, [points], False, int(rng.integers(0, 60)),
+                      int(rng.integers(2, 5)), cv2.LINE_AA)
+        x = int(points[-1, 0]) + int(rng.integers(2, 10))
+
+    return img
+
+
+def make_words(folder, count, rng):
+    """ Word images named like IAM's, 20 per writer. """
+
+    os.makedirs(folder, exist_ok=True)
+
+    for word in range(count):
+        writer = word // 20
+        cv2.imwrite(os.path.join(folder, "b{:02d}-{:03d}x-00-{:02d}.png".format(
+            writer % 100, writer, word % 20)), draw_word(rng))
+
+
+def make_stains(folder, count, rng, blur=1 / 12):
+    """
+    Soft, irregular brown blobs on a light background.
+
+    The edges are blurred by `blur` times the size of the blob.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+
+    for stain in range(count):
+        size = int(rng.integers(80, 240))
+        mask = np.zeros((size, size), np.float32)
+
+        for _ in range(6):
+            center = tuple(int(c) for c in rng.integers(size // 4,
+                                                        3 * size // 4, 2))
+            axes = tuple(int(a) for a in rng.integers(size // 10, size // 4, 2))
+            cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360,
+                        1.0, -1)
+
+        mask = cv2.GaussianBlur(mask, (0, 0), size * blur)
+        color = np.array([150, 170, 190], np.float32)
+        img = 235 - mask[:, :, None] * (235 - color)[None, None, :]
+
+        cv2.imwrite(os.path.join(folder, "stain_{:03d}.png".format(stain)),
+                    img.astype(np.uint8))
+
+
+def prepare_fixtures(workdir, sizes, seed):
+    """
+    Fabricate the fixtures shared by every case, unless they already exist
+    """
+
+    rng = np.random.default_rng(seed)
+
+    words = os.path.join(workdir, "fixtures", "words")
+    if not os.path.isdir(words):
+        make_words(words, 400, rng)
+
+    stains = os.path.join(workdir, "fixtures", "stains")
+    if not os.path.isdir(stains):
+        make_stains(stains, 12, rng)
+
+    for size in sizes:
+        folder = os.path.join(workdir, "fixtures",
+                              "backgrounds_{}x{}".format(*size))
+        if not os.path.isdir(folder):
+            make_backgrounds(folder, size, 4, rng)
+
+    stub = os.path.join(workdir, "fixtures", "divadid_stub")
+    with open(stub, 'w') as stub_file:
+        stub_file.write(DIVADID_STUB.format(python=sys.executable))
+    os.chmod(stub, 0o755)
+
+
+def write_case_settings(case_dir, workdir, mode, size, fade_blur=None):
+    """ Write the settings.ini of a case, based on the repository's. """
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO_DIR, "settings.ini"))
+
+    fixtures = os.path.join(workdir, "fixtures")
+    for section in ("DIRECTORIES", "IMAGES", "DIVADID"):
+        if not config.has_section(section):
+            config.add_section(section)
+
+    config['DIRECTORIES']['handwritten_words_dir'] = \
+        os.path.join(fixtures, "words")
+    config['DIRECTORIES']['background_images_dir'] = \
+        os.path.join(fixtures, "backgrounds_{}x{}".format(*size))
+    config['DIRECTORIES']['stain_images_dir'] = os.path.join(fixtures, "stains")
+    config['DIRECTORIES']['base_output_dir'] = os.path.join(case_dir, "out")
+    config['DIRECTORIES']['tmp_dir'] = os.path.join(case_dir, "tmp")
+    config['DIRECTORIES']['cache_dir'] = os.path.join(workdir, "cache")
+
+    config['DIVADID']['jar'] = os.path.join(REPO_DIR, "DivaDid.jar")
+    config['DIVADID']['server_source'] = \
+        os.path.join(REPO_DIR, "DivaDidServer.java")
+    if mode == "stub":
+        config['DIVADID']['java'] = os.path.join(fixtures, "divadid_stub")
+        config['DIVADID']['jvm_heap'] = ""
+        config['DIVADID']['jvm_flags'] = ""
+
+    config['IMAGES']['engine'] = "native" if mode == "bypass" else "divadid"
+    if fade_blur is not None:
+        config['IMAGES']['fade_blur'] = fade_blur
+
+    if config.has_section('PASS1_CACHE'):
+        config['PASS1_CACHE']['cache_dir'] = os.path.join(case_dir, "tmp")
+
+    os.makedirs(os.path.join(case_dir, "tmp"), exist_ok=True)
+    with open(os.path.join(case_dir, "settings.ini"), 'w') as settings:
+        config.write(settings)
+
+
+def benchmark_page(fn_args):
+    """ Create and encode one page, returning its stage timings. """
+
+    from document import Document
+    import output_writer
+
+    document = Document(in_memory=True, run_seed=fn_args['seed'],
+                        index=fn_args['index'])
+    document.create(bypass=fn_args['bypass'])
+
+    if document.image is None or document.ground_truth is None:
+        return None
+
+    with document.timer.stage("save"):
+        image_data = output_writer.encode(document.image, "png")
+        ground_truth_data = output_writer.encode(document.ground_truth, "png")
+    document.timer.add_bytes("save", len(image_data) + len(ground_truth_data))
+
+    return document.timer.as_dict()
+
+
+def run_case(case):
+    """
+    Run one case in the current process, whose working directory must hold
+    the case's settings.ini. Prints the case result as JSON.
+    """
+
+    import multiprocessing
+
+    import background_pool
+    import generate_images
+    import stage_timer
+    import word_atlas
+    import word_index
+    from document import BACKGROUND_IMAGES_DIR, HANDWRITTEN_WORDS_DIR
+
+    engine = "native" if case['mode'] == "bypass" else "divadid"
+
+    # Indexes and the atlas are built once per data set, not per run
+    words = word_index.load_index(HANDWRITTEN_WORDS_DIR)
+    if word_atlas.ATLAS_ENABLED:
+        word_atlas.load_atlas(words)
+    background_pool.load_index(BACKGROUND_IMAGES_DIR)
+
+    def tasks(start, count):
+        return [{'seed': case['seed'], 'index': index,
+                 'bypass': case['mode'] == "bypass"}
+                for index in range(start, start + count)]
+
+    summary = stage_timer.StageSummary()
+
+    with multiprocessing.Pool(case['workers'],
+                              initializer=generate_images.init_worker,
+                              initargs=(engine,)) as pool:
+        # Let every worker load its data before timing
+        pool.map(benchmark_page, tasks(0, case['workers']), 1)
+
+        start = time.time()
+        failed = 0
+        for stages in pool.imap_unordered(benchmark_page,
+                                          tasks(case['workers'],
+                                                case['pages']), 1):
+            if stages is None:
+                failed += 1
+            else:
+                summary.add(stages)
+        seconds = time.time() - start
+
+        pool.close()
+        pool.join()
+
+    result = dict(case)
+    result.update({
+        'seconds': round(seconds, 3),
+        'failed': failed,
+        'pages_per_sec': round((case['pages'] - failed) / seconds, 3),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_worker_rss_mb': round(resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'stages': summary.summary()['stages'],
+    })
+
+    print(json.dumps(result))
+
+
+def run(args):
+    """ Run every case and write the results. """
+
+    workdir = os.path.abspath(args.workdir)
+    prepare_fixtures(workdir, args.sizes, args.seed)
+
+    modes = list(args.modes)
+    if "divadid" in modes and shutil.which("java") is None:
+        print("java not found, skipping the divadid mode", file=sys.stderr)
+        modes.remove("divadid")
+
+    results = []
+
+    cases = [(mode, size, workers, fade_blur)
+             for mode in modes
+             for size in args.sizes
+             for workers in args.workers
+             for fade_blur in args.fade_blur or [None]]
+
+    for mode, size, workers, fade_blur in cases:
+        case = {'mode': mode, 'width': size[0], 'height': size[1],
+                'workers': workers, 'pages': args.pages,
+                'seed': args.seed}
+        if fade_blur is not None:
+            case['fade_blur'] = fade_blur
+
+        case_dir = os.path.join(workdir, "cases", case_name(case))
+        write_case_settings(case_dir, workdir, mode, size, fade_blur)
+
+        print("Running {}".format(case_name(case)))
+
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(
+            [REPO_DIR] + environment.get('PYTHONPATH', "").split(
+                os.pathsep)).rstrip(os.pathsep)
+
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "_case",
+             json.dumps(case)],
+            cwd=case_dir, env=environment, stdout=subprocess.PIPE,
+            universal_newlines=True)
+
+        if completed.returncode != 0:
+            print("{} failed".format(case_name(case)), file=sys.stderr)
+            continue
+
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append(result)
+
+        print("  {:.2f} pages/sec, peak RSS {} MB (workers {} MB)"
+              .format(result['pages_per_sec'], result['peak_rss_mb'],
+                      result['peak_worker_rss_mb']))
+
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'cases': results,
+    }
+
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2, sort_keys=True)
+
+    print("Results written to {}".format(args.output))
+
+    if args.baseline is not None:
+        return compare(args.output, args.baseline, args.threshold)
+
+    return 0
+
+
+def case_name(case):
+    """ A short name identifying a case across result files. """
+
+    name = "{}_{}x{}_w{}".format(case['mode'], case['width'], case['height'],
+                                 case['workers'])
+
+    if 'fade_blur' in case:
+        name += "_fade_{}".format(case['fade_blur'])
+
+    return name
+
+
+def compare(results_file, baseline_file, threshold):
+    """
+    Flag the cases that regressed against a baseline
+
+    Returns
+    -------
+    int
+        1 if any case regressed, 0 otherwise
+    """
+
+    with open(results_file) as results_input:
+        results = {case_name(case): case
+                   for case in json.load(results_input)['cases']}
+    with open(baseline_file) as baseline_input:
+        baseline = {case_name(case): case
+                    for case in json.load(baseline_input)['cases']}
+
+    regressions = 0
+
+    for name in sorted(results):
+        if name not in baseline:
+            print("{}: not in baseline".format(name))
+            continue
+
+        current = results[name]
+        reference = baseline[name]
+
+        speed = current['pages_per_sec'] / reference['pages_per_sec'] - 1
+        memory = max(current['peak_rss_mb'], current['peak_worker_rss_mb']) / \
+            max(reference['peak_rss_mb'], reference['peak_worker_rss_mb']) - 1
+
+        flags = []
+        if speed < -threshold:
+            flags.append("SLOWER")
+        if memory > threshold:
+            flags.append("MORE MEMORY")
+
+        regressions += bool(flags)
+
+        print("{}: {:+.1%} pages/sec, {:+.1%} peak RSS {}".format(
+            name, speed, memory, " ".join(flags)).rstrip())
+
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark document generation end to end.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('--output', metavar='FILE',
+                            default="benchmark_results.json",
+                            help='where to write the results')
+    run_parser.add_argument('--workdir', metavar='DIR',
+                            default=os.path.join("cache", "benchmark"),
+                            help='where fixtures and scratch files are kept')
+    run_parser.add_argument('--modes', nargs='+', choices=MODES,
+                            default=["bypass", "stub"])
+    run_parser.add_argument('--sizes', nargs='+', type=parse_size,
+                            default=[(1700, 2200)], metavar='WxH',
+                            help='page sizes to benchmark')
+    run_parser.add_argument('--workers', nargs='+', type=int, default=[1],
+                            help='worker counts to benchmark')
+    run_parser.add_argument('--fade_blur', nargs='+',
+                            choices=image_util.BLUR_MODES, default=None,
+                            help='blur modes of the bleed-through text to '
+                                 'benchmark (default: the one in '
+                                 'settings.ini)')
+    run_parser.add_argument('--pages', type=int, default=20,
+                            help='timed pages per case')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--baseline', metavar='FILE', default=None,
+                            help='compare the results against this file')
+    run_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='relative change flagged as a regression')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare results against a baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative change flagged as a '
+                                     'regression')
+
+    case_parser = subparsers.add_parser('_case')
+    case_parser.add_argument('case')
+
+    args = parser.parse_args()
+
+    if args.command == "_case":
+        run_case(json.loads(args.case))
+    elif args.command == "run":
+        sys.exit(run(args))
+    else:
+        sys.exit(compare(args.results, args.baseline, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,8 @@ the image files as well as ground truth files, the following steps are taken:
 
     2) Generated images are partitioned into a train-val-test set.
 
-    3) Images in each set are then packed into LMDBs.
+    3) Images in each set are then packed into LMDBs, or into tar shards with
+       --output_format tar.
 
     4) (OPTIONAL) Data set gets copied to the needed destination.
 
@@ -37,6 +38,7 @@ import lmdb
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.ndimage as nd
+import tar_shards
 
 from natsort import natsorted
 from multiprocessing import Pool
@@ -81,6 +83,11 @@ LABELS_DIR = os.path.join(RESULTS_DIR, "labels")
 
 LMDB_DIR = os.path.join(RESULTS_DIR, "lmdb")
 
+TAR_DIR = os.path.join(RESULTS_DIR, "tar")
+
+# Pack the train/val/test sets into LMDBs, or into rolling tar shards
+OUTPUT_FORMAT = "lmdb"
+
 # These folders get appended to the respective train/val/test directory
 ORIGINAL_SUBDIR = "original_images"
 GT_SUBDIR = "processed_gt"
@@ -429,6 +436,38 @@ def create_lmdb(images, db_file):
     env.close()
 
 
+def tar_member_extension(subdir):
+    return subdir.replace(os.sep, "_") + ".png"
+
+def create_tar_shards(args):
+    """
+    Pack every patch of a set, with all of its companion images, into tar
+    shards. Each patch is one sample, keyed by its file name, with one member
+    per subdirectory, e.g. img_1_0_0.original_images.png and
+    img_1_0_0.processed_gt.png
+    """
+    set_name = args[0]
+    set_dir = args[1]
+
+    writer = tar_shards.TarShardWriter(os.path.join(TAR_DIR, set_name),
+                                       set_name)
+
+    originals = os.path.join(set_dir, ORIGINAL_SUBDIR)
+    for x, imname in enumerate(sorted(os.listdir(originals))):
+        if x and x % 100 == 0:
+            print("Packed {} images".format(x))
+
+        members = []
+        for subdir in get_all_subdirs():
+            with open(os.path.join(set_dir, subdir, imname), 'rb') as member:
+                members.append((tar_member_extension(subdir), member.read()))
+
+        writer.add(os.path.splitext(imname)[0], members)
+
+    writer.close()
+    print("Done Packing Images")
+
+
 def set_up_lmdbs(args):
     dir = args[0]
     subdir = args[1]
@@ -554,6 +593,20 @@ def copy_files_to_position():
         shutil.copy2(os.path.join(LABELS_DIR, dir), dest_dir)
 
 
+def copy_tar_shards_to_position():
+
+    for source, dest in [
+            (TAR_DIR, os.path.join(DESTINATION_ROOT, "compute/tar", DATA_SET, "256")),
+            (LABELS_DIR, os.path.join(DESTINATION_ROOT, "data", DATA_SET, "labels"))]:
+
+        if os.path.exists(dest):
+            print(colored("Deleting {}".format(dest), 'red'))
+
+            shutil.rmtree(dest)
+
+        shutil.copytree(source, dest)
+
+
 def create_project():
     project_subdir = os.path.join(DATA_SET, PROJECT_SUB_REV, PROJECT_SUB_REV_2, PROJECT_ITER)
     net_dir = os.path.join(DESTINATION_ROOT, "nets", project_subdir)
@@ -597,6 +650,9 @@ def create_project():
 parser = argparse.ArgumentParser(description="Crop prepared data files and pack \
                                  into LMDB files")
 parser.add_argument('--experiment', default="", nargs=1)
+parser.add_argument('--output_format', choices=["lmdb", "tar"],
+                    default=OUTPUT_FORMAT,
+                    help="pack the data sets into LMDBs or into tar shards")
 parser.add_argument('source')
 parser.add_argument('data_set')
 parsed = parser.parse_args()
@@ -607,6 +663,7 @@ if DESTINATION_ROOT == "":
 
 DATA_SET = parsed.data_set
 ORIGINAL_DIR = parsed.source
+OUTPUT_FORMAT = parsed.output_format
 
 
 print("Source Dir: {}".format(ORIGINAL_DIR))
@@ -653,9 +710,13 @@ print("-- Starting STEP 2 --")
 
 split_into_sets()
 
-# STEP 3 - Generate needed lmdb's
+# STEP 3 - Generate needed lmdb's (or tar shards)
 print("-- Starting STEP 3 --")
 
+if OUTPUT_FORMAT == "tar":
+    pool.map(create_tar_shards, [("train", TRAIN_DIR), ("val", VAL_DIR),
+                                 ("test", TEST_DIR)])
+
 lmdb_dirs = []
 for dir in [ "train", "val", "test" ]:
     for subdir in [ ORIGINAL_SUBDIR, GT_SUBDIR, RECALL_SUBDIR, PRECISION_SUBDIR,
@@ -668,13 +729,17 @@ for dir in [ "train", "val", "test" ]:
                 subdir = os.path.join(REL_DARKNESS_SUBDIR, str(size), str(thresh), group)
                 lmdb_dirs.append((dir, subdir))
 
-pool.map(set_up_lmdbs, lmdb_dirs)
+if OUTPUT_FORMAT == "lmdb":
+    pool.map(set_up_lmdbs, lmdb_dirs)
 
 # STEP 4 - Copy files to needed locations - Optional
 
 if DATA_SET is not None:
     print("-- Starting STEP 4 --")
-    copy_files_to_position()
+    if OUTPUT_FORMAT == "tar":
+        copy_tar_shards_to_position()
+    else:
+        copy_files_to_position()
 else:
     print("-- SKIPPING STEP 4 --")
 
@@ -0,0 +1,372 @@
+"""
+An in-process stain-gradient degradation engine
+
+DivaDID's <gradient-degradations> step copies the gradients of randomly chosen
+stain images onto the page, wherever they are stronger than the page's own,
+and then reconstructs the page from the modified gradient field with a fixed
+number of relaxation sweeps. This module follows the same steps directly on
+NumPy arrays, but solves for the reconstruction with a fast sine transform
+instead of sweeping over the page hundreds of times.
+
+No Java, XML or intermediate PNG is involved, so this engine can be used for
+either pass of Document.create. See degradation_parity.py for a statistical
+comparison against DivaDID output.
+"""
+import collections
+import configparser
+import functools
+import os
+
+import cv2
+import numpy as np
+import scipy.fft
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+STAIN_IMAGES_DIR = CONFIG['DIRECTORIES']['stain_images_dir']
+DEFAULT_ENGINE = CONFIG.get('IMAGES', 'engine', fallback="divadid")
+
+# "divadid" runs DivaDid.jar, "native" uses degrade() below and "none" skips
+# degradation entirely.
+ENGINES = ("divadid", "native", "none")
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+# The number of relaxation sweeps DivaDID reconstructs a page with (see
+# divadid.build_script)
+RECONSTRUCTION_ITERATIONS = 750
+
+# DivaDID pastes no stain gradient where every channel of the page is darker
+# than UNLIT_LEVEL, and leaves pixels darker than INK_LEVEL unchanged
+UNLIT_LEVEL = 0.025 * 255
+INK_LEVEL = 0.1 * 255
+
+# DivaDID leaves out this margin of every stain when it averages their areas
+STAIN_MARGIN = 20
+
+# The number of scales the stains are kept at in every process. Pages scaled
+# to a target height come at one scale per background size, so this bounds
+# the memory the stains take rather than caching every scale ever used
+STAIN_CACHE_SIZE = 8
+
+# A stain placed on a page by draw_stains
+Stain = collections.namedtuple("Stain", ["top", "left", "image"])
+
+
+def stain_parameter_bounds(stain_level):
+    """
+    Get the strength and density ranges used for a given stain level
+
+    Parameters
+    ----------
+    stain_level : int
+        A value between 1 and 5 determining the amount of staining
+
+    Returns
+    -------
+    (float, float), (float, float)
+        The (low, high) bounds of the stain strength and of the stain density
+
+    Both engines sample their parameters from these ranges so that a stain
+    level means the same thing regardless of the engine in use.
+    """
+
+    strength = (0.1 * stain_level, 0.1 + 0.1 * stain_level)
+    density = (2 + 0.1 * stain_level, 2 + 0.1 * stain_level)
+
+    return strength, density
+
+
+@functools.lru_cache(maxsize=2)
+def _read_stains(stain_dir, grayscale):
+    """ Decode every stain image in a folder, at full size. """
+
+    stains = []
+
+    for name in sorted(os.listdir(stain_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+
+        stain = cv2.imread(os.path.join(stain_dir, name),
+                           cv2.IMREAD_GRAYSCALE if grayscale else
+                           cv2.IMREAD_COLOR)
+        if stain is not None:
+            stains.append(stain)
+
+    if not stains:
+        raise OSError("{} folder contains no stain images".format(stain_dir))
+
+    return stains
+
+
+@functools.lru_cache(maxsize=STAIN_CACHE_SIZE)
+def _scale_stains(stain_dir, grayscale, scale):
+    """ The stains of a folder, scaled down by `scale`, as float32. """
+
+    stains = []
+
+    for stain in _read_stains(stain_dir, grayscale):
+        if scale < 1:
+            size = (max(1, int(round(stain.shape[1] * scale))),
+                    max(1, int(round(stain.shape[0] * scale))))
+            stain = cv2.resize(stain, size, interpolation=cv2.INTER_AREA)
+
+        stains.append(stain.astype(np.float32))
+
+    return stains
+
+
+def load_stains(stain_dir=STAIN_IMAGES_DIR, grayscale=False, scale=1.0):
+    """
+    Load and preprocess every stain image in a folder
+
+    Parameters
+    ----------
+    stain_dir : str, optional
+        The folder holding the stain images (DivaDID's <source>)
+    grayscale : bool, optional
+        Whether to load the stains as a single gray channel
+    scale : float, optional
+        Scale the stains down by this factor, rounded to two decimals, for
+        pages scaled down by the same factor
+
+    Returns
+    -------
+    list of np.ndarray
+        One float32 BGR (or 2-D gray) array per stain
+
+    The folder is only read once per process. The stains are kept at the
+    STAIN_CACHE_SIZE scales used most recently.
+    """
+
+    return _scale_stains(stain_dir, grayscale, min(round(scale, 2), 1.0))
+
+
+def draw_stains(shape, density, stain_dir=STAIN_IMAGES_DIR, rng=np.random,
+                scale=1.0):
+    """
+    Pick the stains degrade() pastes onto a page, and where they go
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the page. A 2-D shape draws gray stains
+    density : float
+        Expected number of stains covering any given pixel (DivaDID's
+        <density>)
+    stain_dir : str, optional
+        The folder the stains are drawn from (DivaDID's <source>)
+    rng : np.random.RandomState or np.random.Generator, optional
+        The random number generator to draw from
+    scale : float, optional
+        The factor the page was scaled down by (see load_stains)
+
+    Returns
+    -------
+    list of Stain
+        The stains, in the order they are pasted, with their page coordinates
+
+    Like DivaDID, every stain in the folder is pasted again and again while a
+    coin toss succeeds, up to once per stain in the folder, and is turned by
+    90 degrees before every paste but the first. The odds of the coin make
+    `density` stains cover a pixel on average.
+    """
+
+    stains = load_stains(stain_dir, len(shape) == 2, scale)
+    height, width = shape[0:2]
+
+    margin = STAIN_MARGIN * scale
+    mean_stain_area = np.mean([max((s.shape[0] - margin) *
+                                   (s.shape[1] - margin), 0) for s in stains])
+    coverage = len(stains) * mean_stain_area / (height * width)
+    repeat = density / (coverage + density)
+
+    placed = []
+    for stain in stains:
+        count = 0
+        while rng.uniform() < repeat and count < len(stains):
+            if count:
+                stain = np.rot90(stain)
+
+            # Stains may hang over the page edge, like in DivaDID
+            top = int(rng.uniform() * (height + 2 * stain.shape[0]))
+            left = int(rng.uniform() * (width + 2 * stain.shape[1]))
+
+            placed.append(Stain(top - stain.shape[0], left - stain.shape[1],
+                                stain))
+            count += 1
+
+    return placed
+
+
+def _gradients(values):
+    """
+    The forward differences of a (height, width, channels) array
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        The horizontal and vertical gradients, 0 on the last row and column
+        like in DivaDID
+    """
+
+    gx = np.zeros_like(values)
+    gy = np.zeros_like(values)
+    np.subtract(values[:-1, 1:], values[:-1, :-1], out=gx[:-1, :-1])
+    np.subtract(values[1:, :-1], values[:-1, :-1], out=gy[:-1, :-1])
+
+    return gx, gy
+
+
+def _reconstruct(gx, gy, iterations):
+    """
+    Integrate a gradient field the way DivaDID's reconstruction does
+
+    Parameters
+    ----------
+    gx, gy : np.ndarray
+        The horizontal and vertical gradients of the change to make, as
+        (height, width, channels) arrays
+    iterations : float
+        The number of relaxation sweeps to imitate
+
+    Returns
+    -------
+    np.ndarray
+        The change whose gradients are closest to (gx, gy), held at 0 around
+        the border
+
+    DivaDID starts from the unchanged page and sweeps over it left to right,
+    top to bottom, right to left and bottom to top in turn, which only
+    converges for fine detail: the larger a stain, the more of it is lost.
+    The Poisson equation is solved exactly here with a sine transform, and
+    every frequency w is then damped by (1 + 4 (1 - cos w)) ** (iterations /
+    8) along each axis, which matches the sweeps to a fraction of a gray
+    level.
+    """
+
+    divergence = gx.copy()
+    divergence[:, 1:] -= gx[:, :-1]
+    divergence += gy
+    divergence[1:] -= gy[:-1]
+
+    height, width = gx.shape[0:2]
+    ly = 2 - 2 * np.cos(np.pi * np.arange(1, height + 1) / height)
+    lx = 2 - 2 * np.cos(np.pi * np.arange(1, width + 1) / width)
+
+    # (damping - 1) / the eigenvalues of the Laplacian, computed as the
+    # damping is close to 1 for the lowest frequencies
+    solver = (np.expm1(-iterations / 8 * np.add.outer(np.log1p(4 * ly),
+                                                      np.log1p(4 * lx)))
+              / np.add.outer(ly, lx))
+
+    spectrum = scipy.fft.dstn(divergence, type=2, axes=(0, 1))
+    spectrum *= solver.astype(np.float32)[:, :, np.newaxis]
+
+    return scipy.fft.idstn(spectrum, type=2, axes=(0, 1))
+
+
+def degrade(img, strength, density, noise_level=1, stain_dir=STAIN_IMAGES_DIR,
+            rng=np.random, scale=1.0, stains=None, offset=(0, 0)):
+    """
+    Apply stain-gradient degradations to an image
+
+    Parameters
+    ----------
+    img : np.ndarray
+        The BGR image to degrade, or a 2-D gray image, which is degraded with
+        gray stains. It is not modified
+    strength : float
+        How strongly each stain is applied (DivaDID's <strength>)
+    density : float
+        Expected number of stains covering any given pixel (DivaDID's
+        <density>)
+    noise_level : int, optional
+        A value between 1 and 5 determining the amount of pixel noise added
+        on top of the stains
+    stain_dir : str, optional
+        The folder the stains are drawn from (DivaDID's <source>)
+    rng : np.random.RandomState or np.random.Generator, optional
+        The random number generator to draw from
+    scale : float, optional
+        The factor the page was scaled down by, which the stains are scaled
+        down by as well (see load_stains)
+    stains : list of Stain, optional
+        Stains from draw_stains for a whole page that `img` is a window of.
+        When given, `density` is not used and no stains are drawn, so
+        windows of one page share its stains and are stained as densely as
+        the page
+    offset : tuple, optional
+        The (top, left) position of `img` on that page
+
+    Returns
+    -------
+    np.ndarray
+        The degraded uint8 image, with the same shape as `img`
+
+    A window is reconstructed on its own, so the stains fade out towards its
+    border rather than towards the border of the page.
+    """
+
+    if stains is None:
+        stains = draw_stains(img.shape, density, stain_dir, rng, scale)
+
+    height, width = img.shape[0:2]
+    values = img.reshape(height, width, -1).astype(np.float32)
+    channels = values.shape[2]
+
+    gx, gy = _gradients(values)
+    change_x = np.zeros_like(gx)
+    change_y = np.zeros_like(gy)
+    pasted = False
+
+    # The brightest channel tells unlit pixels and ink apart from the paper
+    brightest = values[:, :, 0]
+    for channel in range(1, channels):
+        brightest = np.maximum(brightest, values[:, :, channel])
+    lit = brightest >= UNLIT_LEVEL
+
+    for stain in stains:
+        top = stain.top - offset[0]
+        left = stain.left - offset[1]
+
+        # Gradients are pasted everywhere but on the last row and column
+        y0, x0 = max(top, 0), max(left, 0)
+        y1 = min(top + stain.image.shape[0], height - 1)
+        x1 = min(left + stain.image.shape[1], width - 1)
+        if y0 >= y1 or x0 >= x1:
+            continue
+
+        stain_x, stain_y = _gradients(
+            stain.image.reshape(stain.image.shape[0], stain.image.shape[1],
+                                -1)[:, :, 0:channels])
+        window = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+        stain_x = stain_x[window] * strength
+        stain_y = stain_y[window] * strength
+
+        # A stain gradient replaces the page gradient it is stronger than
+        region = (slice(y0, y1), slice(x0, x1))
+        page_x = gx[region] + change_x[region]
+        page_y = gy[region] + change_y[region]
+        replace = stain_x ** 2 + stain_y ** 2 > page_x ** 2 + page_y ** 2
+        replace &= lit[region][:, :, np.newaxis]
+
+        change_x[region][replace] = (stain_x - gx[region])[replace]
+        change_y[region][replace] = (stain_y - gy[region])[replace]
+        pasted = True
+
+    if pasted:
+        # The stains spread as far at a smaller scale as on the full page
+        field = _reconstruct(change_x, change_y,
+                             RECONSTRUCTION_ITERATIONS * scale ** 2)
+        field[brightest < INK_LEVEL] = 0
+    else:
+        field = np.zeros_like(values)
+
+    if noise_level:
+        field += rng.normal(0, noise_level,
+                            size=(height, width, 1)).astype(np.float32)
+
+    return np.clip(np.rint(values + field), 0,
+                   255).astype(np.uint8).reshape(img.shape)
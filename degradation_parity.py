@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Compare the native degradation engine against DivaDID
+
+For each fixture image, the same stain strength and density are applied once
+by DivaDID and once by degradation.degrade. The two engines are random, so
+their outputs are compared statistically rather than pixel by pixel: for every
+statistic below, the native engine must land within a tolerance of DivaDID,
+averaged over all fixtures. The tolerance is relative, except for statistics
+that are signed or close to zero (see ABSOLUTE_TOLERANCES), where a relative
+difference means nothing.
+
+Without a fixture folder, background pages and stains are fabricated like
+benchmark.py does, so that no real data set is needed. DivaDID needs java and
+DivaDid.jar; without them only the native statistics are printed and the
+script exits with SKIP_STATUS, so that a skipped comparison is never taken for
+a passing one.
+
+The script exits with status 1 if any statistic is out of tolerance.
+"""
+import argparse
+import configparser
+import os
+import random
+import shutil
+import sys
+
+import benchmark
+import cv2
+import degradation
+import divadid
+import numpy as np
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+STAIN_IMAGES_DIR = CONFIG['DIRECTORIES']['stain_images_dir']
+TMP_DIR = CONFIG['DIRECTORIES']['tmp_dir']
+
+# The exit status when DivaDID could not be run (the "skipped" status of
+# automake test suites)
+SKIP_STATUS = 77
+
+# Statistics compared by their absolute difference rather than their relative
+# one: mean_shift is signed and may be close to 0 (in gray levels), and
+# changed_fraction is near 0 at low stain levels.
+#
+# Measured on the fabricated fixtures (4 pages, 3 samples each, --seed 0):
+#
+#   level  statistic          divadid    native    diff
+#   1      change_std          0.5324    0.4529   0.149 rel.
+#          changed_fraction    0.0001    0.0000   0.000 abs.
+#          low_frequency       0.2271    0.1811   0.203 rel.
+#          mean_shift          0.1480   -0.0265   0.175 abs.
+#   3      change_std          2.7769    2.5840   0.069 rel.
+#          changed_fraction    0.1039    0.0904   0.014 abs.
+#          low_frequency       1.4039    1.2702   0.095 rel.
+#          mean_shift          0.2547   -0.0088   0.264 abs.
+#   5      change_std          6.6620    6.0603   0.090 rel.
+#          changed_fraction    0.3981    0.3590   0.039 abs.
+#          low_frequency       3.4044    3.0590   0.101 rel.
+#          mean_shift          0.2571    0.0058   0.251 abs.
+#
+# The largest relative difference is 0.20, so the default --tolerance of 0.5
+# leaves room for sampling noise, while the first native engine, which blended
+# whole stains into the page, was off by more than a factor of ten.
+ABSOLUTE_TOLERANCES = {'mean_shift': 2.0, 'changed_fraction': 0.05}
+
+
+def degradation_statistics(original, degraded):
+    """
+    Summarize how much an image was changed by a degradation
+
+    Returns
+    -------
+    dict
+        mean_shift: mean intensity change
+        change_std: standard deviation of the intensity change
+        changed_fraction: fraction of pixels changed by more than 4 levels
+        low_frequency: standard deviation of the heavily blurred change,
+                       i.e. how blotchy (stain-like) the change is
+    """
+
+    original = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    degraded = cv2.cvtColor(degraded, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+    change = degraded - original
+
+    return {
+        'mean_shift': float(np.mean(change)),
+        'change_std': float(np.std(change)),
+        'changed_fraction': float(np.mean(np.abs(change) > 4)),
+        'low_frequency': float(np.std(cv2.GaussianBlur(change, (0, 0), 15))),
+    }
+
+
+def make_fixtures(folder, seed):
+    """
+    Fabricate background pages and stains in `folder`, unless they exist
+
+    Returns
+    -------
+    (str, str)
+        The folders of the backgrounds and of the stains
+    """
+
+    rng = np.random.default_rng(seed)
+
+    backgrounds = os.path.join(folder, "backgrounds")
+    if not os.path.isdir(backgrounds):
+        benchmark.make_backgrounds(backgrounds, (850, 1100), 4, rng)
+
+    # The blobs of benchmark.py are too soft for DivaDID, which only pastes
+    # stain gradients stronger than those of the page: give them the crisp
+    # edges of scanned stains
+    stains = os.path.join(folder, "stains")
+    if not os.path.isdir(stains):
+        benchmark.make_stains(stains, 12, rng, blur=1 / 100)
+
+    return backgrounds, stains
+
+
+def run_divadid(image_path, strength, density, index,
+                stain_dir=STAIN_IMAGES_DIR):
+    """ Degrade `image_path` with DivaDID and return the result. """
+
+    xml_path = os.path.join(TMP_DIR, "parity_script_{}.xml".format(index))
+    output_path = os.path.join(TMP_DIR, "parity_{}.png".format(index))
+
+    root = divadid.build_script(os.path.abspath(image_path), output_path,
+                                strength, density, stain_dir)
+    divadid.write_script(root, xml_path)
+
+    try:
+        divadid.run_script(xml_path)
+        return cv2.imread(output_path)
+    finally:
+        os.remove(xml_path)
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare native degradations against DivaDID.')
+    parser.add_argument('fixture_dir', metavar='DIR', nargs='?', default=None,
+                        help='folder of fixture background images (default: '
+                             'fabricated pages and stains)')
+    parser.add_argument('--stain_level', type=int, default=1,
+                        help='stain level to compare at')
+    parser.add_argument('--samples', type=int, default=3,
+                        help='degradations per fixture and engine')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative difference per statistic')
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    stain_dir = STAIN_IMAGES_DIR
+    if args.fixture_dir is None:
+        args.fixture_dir, stain_dir = make_fixtures(
+            os.path.join(TMP_DIR, "parity_fixtures"), args.seed)
+
+    engines = ['divadid', 'native']
+    if shutil.which(divadid.JAVA) is None:
+        missing = divadid.JAVA
+    elif not os.path.isfile(divadid.DIVADID_JAR):
+        missing = divadid.DIVADID_JAR
+    else:
+        missing = None
+
+    if missing:
+        print("{} not found, only the native engine is run and DivaDID is "
+              "NOT compared".format(missing), file=sys.stderr)
+        engines = ['native']
+
+    (strength_low, strength_high), (density_low, density_high) = \
+        degradation.stain_parameter_bounds(args.stain_level)
+
+    totals = {engine: {} for engine in engines}
+
+    fixtures = sorted(f for f in os.listdir(args.fixture_dir)
+                      if f.lower().endswith(degradation.IMAGE_EXTENSIONS))
+
+    for index, name in enumerate(fixtures):
+        path = os.path.join(args.fixture_dir, name)
+        original = cv2.imread(path)
+        if original is None:
+            continue
+
+        for sample in range(args.samples):
+            strength = random.uniform(strength_low, strength_high)
+            density = random.uniform(density_low, density_high)
+
+            # DivaDID's script adds no pixel noise, so neither does the
+            # native engine here
+            outputs = {
+                'native': degradation.degrade(original, strength, density,
+                                              noise_level=0,
+                                              stain_dir=stain_dir),
+            }
+            if 'divadid' in engines:
+                outputs['divadid'] = run_divadid(
+                    path, strength, density, "{}_{}".format(index, sample),
+                    stain_dir)
+
+            for engine, degraded in outputs.items():
+                stats = degradation_statistics(original, degraded)
+                for key, value in stats.items():
+                    totals[engine].setdefault(key, []).append(value)
+
+    if not totals['native']:
+        sys.exit("No fixture images found in {}".format(args.fixture_dir))
+
+    if 'divadid' not in engines:
+        print("{:<18}{:>12}".format("statistic", "native"))
+        for key in sorted(totals['native']):
+            print("{:<18}{:>12.4f}".format(key,
+                                           np.mean(totals['native'][key])))
+        print("Comparison skipped", file=sys.stderr)
+        sys.exit(SKIP_STATUS)
+
+    failed = False
+
+    print("{:<18}{:>12}{:>12}{:>12}".format("statistic", "divadid", "native",
+                                            "diff"))
+    for key in sorted(totals['divadid']):
+        expected = np.mean(totals['divadid'][key])
+        actual = np.mean(totals['native'][key])
+
+        if key in ABSOLUTE_TOLERANCES:
+            difference = abs(actual - expected)
+            tolerance = ABSOLUTE_TOLERANCES[key]
+            kind = "abs."
+        else:
+            difference = abs(actual - expected) / max(abs(expected), 1e-6)
+            tolerance = args.tolerance
+            kind = "rel."
+
+        flag = ""
+        if difference > tolerance:
+            failed = True
+            flag = "  FAIL"
+
+        print("{:<18}{:>12.4f}{:>12.4f}{:>12.3f} {}{}".format(
+            key, expected, actual, difference, kind, flag))
+
+    divadid.shutdown()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+A persistent DivaDID worker
+
+Running ``java -jar DivaDid.jar script.xml`` for every degradation pass pays for
+a full JVM startup, jar load and JIT warm-up each time. This module instead
+keeps one long-lived DivaDID JVM per process (see DivaDidServer.java) and
+feeds it degradation scripts over a pipe.
+
+The worker is restarted automatically if the JVM dies or hangs on a script. JVM
+heap size, flags and the script timeout are read from the [DIVADID] section of
+settings.ini.
+"""
+import atexit
+import configparser
+import os
+import select
+import shlex
+import subprocess
+
+from lxml import etree
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+DIVADID_JAR = CONFIG.get('DIVADID', 'jar', fallback="DivaDid.jar")
+SERVER_SOURCE = CONFIG.get('DIVADID', 'server_source',
+                           fallback="DivaDidServer.java")
+JAVA = CONFIG.get('DIVADID', 'java', fallback="java")
+JVM_HEAP = CONFIG.get('DIVADID', 'jvm_heap', fallback="")
+JVM_FLAGS = CONFIG.get('DIVADID', 'jvm_flags', fallback="")
+PERSISTENT_WORKER = CONFIG.getboolean('DIVADID', 'persistent_worker',
+                                      fallback=True)
+MAX_SCRIPTS_PER_JVM = CONFIG.getint('DIVADID', 'max_scripts_per_jvm',
+                                    fallback=0)
+MAX_RESTARTS = CONFIG.getint('DIVADID', 'max_restarts', fallback=3)
+SCRIPT_TIMEOUT = CONFIG.getfloat('DIVADID', 'script_timeout', fallback=300)
+
+
+class DivaDidError(RuntimeError):
+    """ Raised when DivaDID fails to process a degradation script. """
+
+
+class DivaDidWorker:
+    """
+    A long-lived DivaDID JVM
+
+    Scripts are passed one path per line on the JVM's stdin. The JVM answers
+    with "OK" once the degraded image has been written, or "ERROR ..." if
+    DivaDID raised. If the JVM exits for any reason, or does not answer
+    within `timeout` seconds, it is transparently restarted, up to
+    `max_restarts` times per script.
+
+    A DivaDidWorker belongs to the process that started it. It is not safe to
+    share one between threads or to use one inherited across a fork.
+    """
+
+    def __init__(self, java=JAVA, heap=JVM_HEAP, flags=JVM_FLAGS,
+                 max_scripts=MAX_SCRIPTS_PER_JVM, max_restarts=MAX_RESTARTS,
+                 timeout=SCRIPT_TIMEOUT):
+        """
+        Initialize a new, not yet started, DivaDidWorker
+
+        Parameters
+        ----------
+        java : str, optional
+            The java executable to launch
+        heap : str, optional
+            Maximum JVM heap, passed as -Xmx (e.g. "2g"). Empty for the JVM
+            default
+        flags : str, optional
+            Extra JVM flags, split as a shell would
+        max_scripts : int, optional
+            Restart the JVM after this many scripts. 0 means never
+        max_restarts : int, optional
+            How many times to restart a crashed JVM before giving up on a
+            script
+        timeout : float, optional
+            Seconds to wait for the JVM to start or to answer a script before
+            killing it. 0 waits forever
+        """
+
+        self.java = java
+        self.heap = heap
+        self.flags = flags
+        self.max_scripts = max_scripts
+        self.max_restarts = max_restarts
+        self.timeout = timeout
+
+        self.process = None
+        self.scripts_run = 0
+
+    def command(self):
+        """ The command line used to launch the JVM. """
+
+        command = [self.java]
+
+        if self.heap:
+            command.append("-Xmx{}".format(self.heap))
+
+        command += shlex.split(self.flags)
+        command += ["-cp", DIVADID_JAR, SERVER_SOURCE]
+
+        return command
+
+    def is_alive(self):
+        """ Whether the JVM is running. """
+
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """ Launch the JVM and wait until it is ready to accept scripts. """
+
+        self.stop()
+
+        self.process = subprocess.Popen(self.command(),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True,
+                                        bufsize=1)
+        self.scripts_run = 0
+
+        if self._readline().strip() != "READY":
+            self.stop()
+            raise DivaDidError("DivaDID worker failed to start: {}".format(
+                " ".join(self.command())))
+
+    def _readline(self):
+        """
+        Read a line from the JVM, killing it if none comes within `timeout`
+
+        Returns "" if the JVM exited or was killed. The JVM writes one line
+        per request, so nothing is left in the pipe's buffer that select
+        would not see.
+        """
+
+        if self.timeout > 0:
+            ready, _, _ = select.select([self.process.stdout], [], [],
+                                        self.timeout)
+            if not ready:
+                self.process.kill()
+                return ""
+
+        return self.process.stdout.readline()
+
+    def stop(self):
+        """ Shut the JVM down, if it is running. """
+
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+        self.process.stdout.close()
+        self.process = None
+
+    def run(self, xml_path):
+        """
+        Run a single degradation script
+
+        Parameters
+        ----------
+        xml_path : str
+            The path of the DivaDID script to run
+
+        Returns once the image named by the script's <save> element has been
+        written. Raises DivaDidError if DivaDID rejects the script or the JVM
+        keeps crashing.
+        """
+
+        xml_path = os.path.abspath(xml_path)
+        restarts = 0
+
+        while True:
+            if not self.is_alive():
+                self.start()
+
+            try:
+                self.process.stdin.write(xml_path + "\n")
+                self.process.stdin.flush()
+                response = self._readline()
+            except OSError:
+                response = ""
+
+            if response:
+                break
+
+            # The JVM died or hung mid-script. Restart it and try again.
+            self.stop()
+            restarts += 1
+            if restarts > self.max_restarts:
+                raise DivaDidError(
+                    "DivaDID worker crashed or timed out {} times running "
+                    "{}".format(restarts, xml_path))
+
+        self.scripts_run += 1
+        if self.max_scripts and self.scripts_run >= self.max_scripts:
+            self.stop()
+
+        response = response.strip()
+        if response != "OK":
+            raise DivaDidError("DivaDID failed on {}: {}".format(xml_path,
+                                                                 response))
+
+
+def build_script(base_image, output_image, strength, density, stain_dir,
+                 iterations=750):
+    """
+    Build a DivaDID script that adds surface stains to an image
+
+    Parameters
+    ----------
+    base_image : str
+        The path of the image that DivaDID will apply degradations to
+    output_image : str
+        The path DivaDID will save the degraded image to
+    strength : float
+        The strength of the gradient degradations
+    density : float
+        The density of the gradient degradations
+    stain_dir : str
+        The folder DivaDID draws stain images from
+    iterations : int, optional
+        The number of iterations of the gradient-domain reconstruction
+
+    Returns
+    -------
+    etree.Element
+        The root element of the xml tree
+    """
+
+    root = etree.Element("root")
+
+    alias_e = etree.SubElement(root, "alias")
+    alias_e.set("id", "INPUT")
+
+    alias_e.set("value", base_image)
+
+    image_e = etree.SubElement(root, "image")
+    image_e.set("id", "my-image")
+    load_e = etree.SubElement(image_e, "load")
+    load_e.set("file", "INPUT")
+
+    image_e2 = etree.SubElement(root, "image")
+    image_e2.set("id", "my-copy")
+    copy_e2 = etree.SubElement(image_e2, "copy")
+    copy_e2.set("ref", "my-image")
+
+    # Add stains
+    gradient_degradation_e = etree.SubElement(root, "gradient-degradations")
+    gradient_degradation_e.set("ref", "my-copy")
+    strength_e = etree.SubElement(gradient_degradation_e, "strength")
+    strength_e.text = "{:.2f}".format(strength)
+    density_e = etree.SubElement(gradient_degradation_e, "density")
+    density_e.text = "{:.2f}".format(density)
+    iterations_e = etree.SubElement(gradient_degradation_e, "iterations")
+    iterations_e.text = str(iterations)
+    source_e = etree.SubElement(gradient_degradation_e, "source")
+    source_e.text = stain_dir
+
+    save_e = etree.SubElement(root, "save")
+    save_e.set("ref", "my-copy")
+    save_e.set("file", output_image)
+
+    return root
+
+
+def write_script(root, xml_path):
+    """ Write a DivaDID script built by build_script to `xml_path`. """
+
+    with open(xml_path, 'w') as output_xml:
+        output_xml.write(
+            etree.tostring(root, pretty_print=True).decode("utf-8"))
+
+
+_worker = None
+_worker_pid = None
+
+
+def get_worker():
+    """
+    Get the DivaDidWorker owned by the current process
+
+    Pool workers each get their own JVM. A worker inherited from a parent
+    process through fork is discarded rather than shared.
+    """
+    global _worker, _worker_pid
+
+    if _worker is None or _worker_pid != os.getpid():
+        _worker = DivaDidWorker()
+        _worker_pid = os.getpid()
+
+    return _worker
+
+
+def run_script(xml_path):
+    """
+    Run a DivaDID degradation script
+
+    Parameters
+    ----------
+    xml_path : str
+        The path of the DivaDID script to run
+
+    Uses the persistent worker of the current process unless
+    `persistent_worker` is disabled in settings.ini, in which case a fresh
+    ``java -jar`` is launched for the script, and killed after
+    `script_timeout` seconds.
+    """
+
+    if not PERSISTENT_WORKER:
+        subprocess.check_call([JAVA, "-jar", DIVADID_JAR, xml_path],
+                              stdout=subprocess.DEVNULL,
+                              timeout=SCRIPT_TIMEOUT or None)
+        return
+
+    get_worker().run(xml_path)
+
+
+def shutdown():
+    """ Stop the current process' worker, if any. """
+
+    if _worker is not None and _worker_pid == os.getpid():
+        _worker.stop()
+
+
+atexit.register(shutdown)
@@ -3,20 +3,27 @@ A synthetic handwritten Document
 
 This module includes the Document class.
 """
+import collections
 import configparser
 import errno
 import multiprocessing
 import os
 import random
-import subprocess
+import re
 import sys
-import shutil
 
+import background_pool
 import cv2
+import degradation
+import divadid
 import image_util as util
 import numpy as np
+import output_writer
+import pass1_cache
+import stage_timer
+import word_atlas
+import word_index
 
-from lxml import etree
 from text_writer_state import TextWriterState
 
 CONFIG = configparser.ConfigParser()
@@ -32,6 +39,108 @@ DEFAULT_BASE_OUTPUT_DIR = CONFIG['DIRECTORIES']['base_output_dir']
 # If that does not work, just use /tmp
 TMP_DIR = CONFIG['DIRECTORIES']['tmp_dir']
 
+# Keep pages, ground truth and intermediates as arrays and only encode them on
+# save. Files are then only written where DivaDID strictly needs them.
+DEFAULT_IN_MEMORY = CONFIG.getboolean('IMAGES', 'in_memory', fallback=False)
+
+# Generate single-channel gray pages: backgrounds, stains and text are all
+# handled as one channel, and pages are saved as gray images
+DEFAULT_GRAYSCALE = CONFIG.getboolean('IMAGES', 'grayscale', fallback=False)
+
+# Scale backgrounds down to this height before anything else, and words and
+# stains by the same factor (0 keeps the scans' resolution)
+DEFAULT_TARGET_HEIGHT = CONFIG.getint('IMAGES', 'target_height', fallback=0)
+
+# How the bleed-through text is blurred (see image_util.BLUR_MODES), and the
+# resolution reduction of the "downscale" mode
+FADE_BLUR = CONFIG.get('IMAGES', 'fade_blur', fallback="downscale")
+FADE_DOWNSCALE = CONFIG.getint('IMAGES', 'fade_downscale', fallback=4)
+
+# Patch generation (see Document.create): the side of the square patches, and
+# the margin around each patch that is degraded and composited along with it
+PATCH_SIZE = CONFIG.getint('PATCHES', 'size', fallback=256)
+PATCH_MARGIN = CONFIG.getint('PATCHES', 'margin', fallback=32)
+
+# The size of the Gaussian kernel blurring the bleed-through text. Words are
+# padded by half of it, so that their blurs never overlap
+FADE_KERNEL = 51
+
+
+def new_run_seed():
+    """ Draw a fresh, random 63 bit run seed from OS entropy. """
+
+    return random.SystemRandom().getrandbits(63)
+
+
+def remove_orphaned_files(run_seed, tmp_dir=TMP_DIR):
+    """
+    Remove the temporary files left behind by an interrupted run
+
+    Every intermediate file of a document contains the document's name,
+    `<run seed>_<index>`, so the files of a run can be told apart from those
+    of other runs sharing TMP_DIR. Only call this while no worker of the run
+    is generating.
+
+    Returns
+    -------
+    int
+        The number of files removed
+    """
+
+    pattern = re.compile(r"(^|_){}_\d{{7,}}[_.]".format(run_seed))
+    removed = 0
+
+    if not os.path.isdir(tmp_dir):
+        return 0
+
+    for name in os.listdir(tmp_dir):
+        if not pattern.search(name):
+            continue
+
+        try:
+            os.remove(os.path.join(tmp_dir, name))
+            removed += 1
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+
+    return removed
+
+
+# A window of a page generated on its own: its top left corner on the page, its
+# pixels and its ground truth
+Patch = collections.namedtuple("Patch", ["top", "left", "image",
+                                         "ground_truth"])
+
+
+def _overlaps(position, shape, regions):
+    """ Whether a box at `position` of `shape` overlaps any of `regions`. """
+
+    top, left = position
+    bottom, right = top + shape[0], left + shape[1]
+
+    return any(top < region_bottom and region_top < bottom and
+               left < region_right and region_left < right
+               for region_top, region_left, region_bottom, region_right
+               in regions)
+
+
+def _timed_write(function, file, *args):
+    """
+    Run `function(*args)`, a write to `file`, as the "encode" stage
+
+    Used on writer threads, which cannot time into the document's timer.
+    Returns a StageTimer holding the write's time and the bytes written.
+    """
+
+    timer = stage_timer.StageTimer()
+
+    with timer.stage("encode"):
+        function(*args)
+    timer.add_bytes("encode", os.path.getsize(file))
+
+    return timer
+
+
 def dprint(*args, **kwargs):
     """
     A debug print function
@@ -40,7 +149,8 @@ def dprint(*args, **kwargs):
     function will prepend every line with the currrent process number. (Note
     this is not the PID)
     """
-    print(str(multiprocessing.current_process()._identity[0]) + ": "
+    identity = multiprocessing.current_process()._identity
+    print((str(identity[0]) if identity else "main") + ": "
           + " ".join(map(str, args)), **kwargs)
 
 
@@ -54,20 +164,54 @@ class Document:
     """
 
     def __init__(self, stain_level=1, noise_level=1,seed=None,
-                 output_loc=DEFAULT_BASE_OUTPUT_DIR):
+                 output_loc=DEFAULT_BASE_OUTPUT_DIR,
+                 engine=degradation.DEFAULT_ENGINE,
+                 in_memory=DEFAULT_IN_MEMORY,
+                 run_seed=None, index=0, grayscale=DEFAULT_GRAYSCALE,
+                 patch_count=0, patch_size=PATCH_SIZE,
+                 patch_margin=PATCH_MARGIN,
+                 target_height=DEFAULT_TARGET_HEIGHT):
         """
         Initialize a new Document
 
         Parameters
         ----------
         seed : int, optional
-            The random seed to use for this document
+            The random seed to use for this document. Overrides run_seed and
+            index
         stain_level : int, optional
             A value that is passed to DivaDID to determine amount of staining
         noise_level : int, optional
             A value that is passed to DivaDID to determine amount of noise
         output_loc : str, optional
             The location the final document will be saved to
+        engine : str, optional
+            The degradation engine to use: "divadid", "native" (the in-process
+            engine of the degradation module) or "none"
+        in_memory : bool, optional
+            Whether to keep the generated page and ground truth as arrays
+            (see `image` and `ground_truth`) instead of in TMP_DIR files
+        run_seed : int, optional
+            The seed of the run this document belongs to. A random run seed is
+            drawn if neither seed nor run_seed is given
+        index : int, optional
+            The position of this document in its run
+        grayscale : bool, optional
+            Whether to generate a single-channel gray page. Its ground truth
+            is then thresholded from the gray text
+        patch_count : int, optional
+            Only generate this many square windows of the page (see
+            `patches`) instead of the whole page. 0 generates the whole page
+        patch_size : int, optional
+            The side of the windows
+        patch_margin : int, optional
+            The margin degraded and composited around every window, so that
+            blurs near its border see the text beyond it
+        target_height : int, optional
+            Scale the background down to this height before degrading it, and
+            the words, stains and bleed-through blur by the same factor, so
+            the page looks the same at a lower resolution. 0 keeps the
+            background's resolution
 
         For every synthetic document created, a new Document object should
         be instantiated.
@@ -77,6 +221,14 @@ class Document:
         be instantiated in different threads or processes. As long as no
         instance is accesed by more than one thread or process, all member
         functions can be safely called without concern about locks.
+
+        Every Document draws from its own random number generators (`rng` for
+        numpy, `py_random` for the standard library), never from the global
+        ones. Unless an explicit seed is given, they are seeded from the
+        `index`-th child of the run's SeedSequence, so a document is fully
+        determined by its run seed and index. Its name (and so its file
+        names) is derived from the same pair, which makes it unique without
+        probing the output directory.
         """
 
         if not os.path.isdir(HANDWRITTEN_WORDS_DIR):
@@ -85,63 +237,84 @@ class Document:
             raise OSError("{} folder for background images does not exist".format(BACKGROUND_IMAGES_DIR))
         if not os.path.isdir(STAIN_IMAGES_DIR):
             raise OSError("{} folder for stain images does not exist".format(STAIN_IMAGES_DIR))
+        if engine not in degradation.ENGINES:
+            raise ValueError("Unknown degradation engine {}".format(engine))
+        if FADE_BLUR not in util.BLUR_MODES:
+            raise ValueError("Unknown fade blur mode {}".format(FADE_BLUR))
 
         self.stain_level = stain_level
         self.text_noisy_level = noise_level
+        self.engine = engine
+
+        self.in_memory = in_memory
+        self.grayscale = grayscale
+        self.patch_count = patch_count
+        self.patch_size = patch_size
+        self.patch_margin = patch_margin
+        self.target_height = target_height or None
+
+        # The factor the current background is scaled down by (see
+        # target_height), set by create
+        self.scale = 1.0
 
         self.result = None
         self.result_ground_truth = None
 
-        self.output_dir = output_loc
-        dprint("Output_dir: {}".format(self.output_dir))
-
-        if seed is not None:
-            self.random_seed = seed
-        else:
-            self._assign_random_seed()
+        # Only used when in_memory is set
+        self.image = None
+        self.ground_truth = None
 
-        # Seed both the python and numpy random number generators, so that we
-        # can guarantee some sort of determinacy.
-        random.seed(self.random_seed)
-        np.random.seed(self.random_seed)
+        # The (top, left, bottom, right) box of every word of the text
+        self.word_boxes = []
 
-        dprint("Using seed {}".format(self.random_seed))
+        # The generated windows, as Patch tuples, when patch_count is set
+        self.patches = []
 
-        self._gather_data_sources()
+        # The futures of the writes handed to an AsyncWriter by save
+        self.writes = []
 
-    def _assign_random_seed(self):
-        """
-        Get a random seed that will not clash with another document
+        # The path of the background image, set by create
+        self.background = None
 
-        Since the random seed is used as part of the filename of the written
-        document, there is value in making sure the seed of this document does
-        not clash with another document that already exists in the target
-        directory.
-        """
-        tries = 0
-        condition = True
+        self.output_dir = output_loc
+        dprint("Output_dir: {}".format(self.output_dir))
 
-        random.seed()
+        if seed is not None:
+            seed_sequence = np.random.SeedSequence(seed)
+            self.name = str(seed)
+        else:
+            if run_seed is None:
+                run_seed = new_run_seed()
+            seed_sequence = np.random.SeedSequence(run_seed, spawn_key=(index,))
+            self.name = "{}_{:07d}".format(run_seed, index)
 
-        # This roughly emulates a do-while loop. We need to assign a seed at
-        # least once.
-        while condition:
-            if tries > 10:
-                raise RuntimeError("Could not find an unused seed")
+        self.run_seed = run_seed
+        self.index = index
 
-            self.random_seed = random.randint(10000, 100000)
+        numpy_seed, python_seed = seed_sequence.spawn(2)
+        self.rng = np.random.default_rng(numpy_seed)
+        self.py_random = random.Random(
+            int.from_bytes(python_seed.generate_state(4).tobytes(), "little"))
 
-            file = "img_{}.png".format(self.random_seed)
-            file = self.output_dir + '/' + file
+        dprint("Using seed {}".format(self.name))
 
-            condition = os.path.isfile(file)
+        # Per-stage wall time, CPU time and bytes of create and save
+        self.timer = stage_timer.StageTimer()
 
-            tries += 1
+        self._gather_data_sources()
 
     def _gather_data_sources(self):
         """ Parse lists of needed directories. """
 
         self.word_image_folder_list = [HANDWRITTEN_WORDS_DIR]
+
+        # Indexes are built once and cached, so that words can be sampled
+        # without listing their folder each time.
+        self.word_indexes = [word_index.load_index(folder)
+                             for folder in self.word_image_folder_list]
+
+        # Backgrounds are validated once, when they are indexed
+        self.backgrounds = background_pool.load_index(BACKGROUND_IMAGES_DIR)
         return
 
         # self.word_image_folder_list = []
@@ -163,11 +336,15 @@ class Document:
         Parameters
         ----------
         bypass : bool, optional
-            Whether or not to bypass the DivaDID stage
+            Whether or not to bypass the DivaDID stage. A bypassed document is
+            degraded by the in-process "native" engine instead, unless its
+            engine is "none"
 
         The current generation process has three stages. The first is to pick
         a random background image and then use DivaDID to apply some simply
-        degradations to add some noise and natural variation.
+        degradations to add some noise and natural variation. Depending on
+        settings.ini, the degraded background may be drawn from a pool of
+        cached variants instead (see pass1_cache).
 
         The second stage is to add text to the background image. During this
         process, the "ground truth" file is also created.
@@ -175,25 +352,53 @@ class Document:
         The third and final stage is a second iteration of DivaDID. Now that we
         have text on the document, we degrade the image once more to give it
         a somewhat more realistic appearance.
+
+        With a patch_count, only that many windows of the page are generated,
+        and kept in memory as `patches` (see _create_patches).
         """
 
+        if self.patch_count > 0:
+            return self._create_patches(self._resolve_engine(bypass))
+
         base_working_dir = TMP_DIR
 
         # Get a random background image
-        bg_image_name = random.choice(os.listdir(BACKGROUND_IMAGES_DIR))
+        bg_index = self.backgrounds.random_index(self.py_random)
+
+        bg_full_path = self.backgrounds.path(bg_index)
+        self.background = bg_full_path
+        self._set_scale(bg_index)
+
+        engine = self._resolve_engine(bypass)
+
+        # Degrade the background image, or reuse a cached degraded variant
+        with self.timer.stage("pass1"):
+            img = pass1_cache.get_variant(
+                self.backgrounds, bg_index, engine, self.stain_level,
+                self.text_noisy_level,
+                lambda: self._degrade_background(bg_index, engine),
+                rng=self.py_random, grayscale=self.grayscale,
+                height=self.target_height)
+        if img is None:
+            return
+        self.timer.add_bytes("pass1", img.nbytes)
 
-        bg_full_path = os.path.join(BACKGROUND_IMAGES_DIR, bg_image_name)
+        # Add text to degraded background image
+        dprint("-{} Adding text to image {} -".format(self.name, bg_full_path))
+        if self.rng.random() < 0.3:
+            img = self._add_text_fade(img)
+        img = self._add_text(img)
 
-        if bypass is True:
-            dprint("Adding text to image {}".format(bg_full_path))
-            img = cv2.imread(bg_full_path)
-            if img is None:
+        if engine != "divadid":
+            with self.timer.stage("pass2"):
+                img = self._degrade(img, engine)
+            self.timer.add_bytes("pass2", img.nbytes)
+
+            if self.in_memory:
+                self.image = img
                 return
-            if np.random.random() < 0.3:
-                img = self._add_text_fade(img)
-            img = self._add_text(img)
 
-            filename = str(self.random_seed) + "_augmented.png"
+            filename = self.name + "_augmented.png"
             path = os.path.join(base_working_dir, filename)
 
             cv2.imwrite(path, img)
@@ -201,57 +406,310 @@ class Document:
             self.result = path
             return
 
-        # Generate XML for DivaDID and then degrade background image
-        dprint("- Generating degraded image - pass 1")
-        first_xml, first_image = self._generate_degradation_xml(bg_full_path,
-                                                                1,
-                                                                True,
-                                                                base_working_dir)
+        with self.timer.stage("pass2"):
+            filename = self.name + "_augmented.png"
+            path = os.path.join(base_working_dir, filename)
+            cv2.imwrite(path, img)
 
-        subprocess.check_call(["java", "-jar", "DivaDid.jar", first_xml],
-                              stdout=subprocess.DEVNULL)
 
-        # Add text to degraded background image
-        dprint("-{} Adding text to image {} -".format(self.random_seed, bg_full_path))
-        img = cv2.imread(first_image)
-        if img is None:
-            os.remove(first_xml)
-            os.remove(first_image)
-            return
-        if np.random.random() < 0.3:
-            img = self._add_text_fade(img)
-        img = self._add_text(img)
+            # Generate XML for second pass of DivaDID. Degrade image with text
+            dprint("- Generating degraded image - pass 2")
+            second_xml, second_image = self._generate_degradation_xml(
+                path,
+                2,
+                True,
+                base_working_dir)
 
-        filename = str(self.random_seed) + "_augmented.png"
-        path = os.path.join(base_working_dir, filename)
-        cv2.imwrite(path, img)
+            divadid.run_script(second_xml)
 
+            os.remove(second_xml)
+            os.remove(path)
 
-        # Generate XML for second pass of DivaDID. Degrade image with text
-        dprint("- Generating degraded image - pass 2")
-        second_xml, second_image = self._generate_degradation_xml(
-            path,
-            2,
-            True,
-            base_working_dir)
+            # DivaDID writes color pages, so gray pages are kept in memory
+            # for save to encode as gray
+            if self.in_memory or self.grayscale:
+                self.image = cv2.imread(second_image, self._imread_flags())
+                os.remove(second_image)
 
-        subprocess.check_call(["java", "-jar", "DivaDid.jar", second_xml],
-                              stdout=subprocess.DEVNULL)
+        if self.in_memory or self.grayscale:
+            if self.image is not None:
+                self.timer.add_bytes("pass2", self.image.nbytes)
+            return
 
         self.result = second_image
 
+    def _create_patches(self, engine):
+        """
+        Generate only a few windows of a page.
+
+        Parameters
+        ----------
+        engine : str
+            The degradation engine, "native" or "none"
+
+        Windows of patch_size pixels are picked at random, centered within
+        the region TextWriterState fills with text. Words are laid out on the
+        whole page as usual, but only those overlapping a window are loaded,
+        and degradation, compositing and the ground truth are restricted to
+        each window and its margin. Stains are likewise drawn for the whole
+        page and only those hitting a window are applied. The pass-1 cache is
+        not used.
+        """
+
+        if engine == "divadid":
+            raise ValueError("Patch generation needs the native or none "
+                             "engine")
+
+        bg_index = self.backgrounds.random_index(self.py_random)
+        self.background = self.backgrounds.path(bg_index)
+        self._set_scale(bg_index)
+
+        with self.timer.stage("pass1"):
+            with self.timer.stage("background_decode"):
+                page = background_pool.read_background(
+                    self.backgrounds, bg_index, grayscale=self.grayscale,
+                    height=self.target_height)
+            if page is None:
+                return
+            self.timer.add_bytes("background_decode", page.nbytes)
+
+            windows = self._patch_windows(page.shape)
+            regions = [(max(top - self.patch_margin, 0),
+                        max(left - self.patch_margin, 0),
+                        min(top + self.patch_size + self.patch_margin,
+                            page.shape[0]),
+                        min(left + self.patch_size + self.patch_margin,
+                            page.shape[1]))
+                       for top, left in windows]
+
+            # Stains are drawn once for the whole page, so each window is
+            # stained as densely as a full page and overlapping windows agree
+            stains = self._draw_stains(page.shape, engine)
+            images = [self._degrade(np.array(page[top:bottom, left:right]),
+                                    engine, stains, (top, left))
+                      for top, left, bottom, right in regions]
+
+        if not windows:
+            dprint("{} is smaller than a patch".format(self.background))
+            return
+
+        faded = None
+        if self.rng.random() < 0.3:
+            faded = self._place_words(page.shape, self._fade_kernel() // 2,
+                                      regions).sprites
+
+        state = self._place_words(page.shape, regions=regions)
+        self.word_boxes = util.sprite_boxes(state.sprites, page.shape)
+        stains = self._draw_stains(page.shape, engine)
+
+        for (top, left), region, img in zip(windows, regions, images):
+            if faded:
+                sprites = util.crop_sprites(faded, region)
+                with self.timer.stage("text_fade_blur"):
+                    sprites = util.blur_sprites(sprites, img.shape,
+                                                self._fade_kernel(),
+                                                FADE_BLUR, FADE_DOWNSCALE)
+                with self.timer.stage("composite"):
+                    util.composite_sprites(img, sprites, out=img)
+
+            sprites = util.crop_sprites(state.sprites, region)
+            with self.timer.stage("composite"):
+                util.composite_sprites(img, sprites, out=img)
+
+            with self.timer.stage("ground_truth"):
+                ground_truth = util.text_mask(sprites, img.shape)
+
+            with self.timer.stage("pass2"):
+                img = self._degrade(img, engine, stains, region[0:2])
+
+            # Drop the margin
+            y, x = top - region[0], left - region[1]
+            window = (slice(y, y + self.patch_size),
+                      slice(x, x + self.patch_size))
+            self.patches.append(Patch(top, left, img[window],
+                                      ground_truth[window]))
+
+    def _patch_windows(self, shape):
+        """ The (top, left) corners of patch_count random windows. """
+
+        if shape[0] < self.patch_size or shape[1] < self.patch_size:
+            return []
+
+        text = TextWriterState(shape)
+        windows = []
+
+        for _ in range(self.patch_count):
+            center = self.rng.uniform(text.start_position,
+                                      text.end_position)
+            top, left = np.clip(np.round(center - self.patch_size / 2), 0,
+                                np.array(shape[0:2]) - self.patch_size)
+            windows.append((int(top), int(left)))
+
+        return windows
+
+    def save_patches(self, codec=output_writer.IMAGE_CODEC,
+                     ground_truth_codec=output_writer.GROUND_TRUTH_CODEC,
+                     png_level=output_writer.PNG_LEVEL, writer=None):
+        """
+        Save the generated patches and their ground truth.
+
+        Parameters
+        ----------
+        codec, ground_truth_codec : str, optional
+            The codecs of the patches and of their ground truth
+        png_level : int, optional
+            The compression level of the png codec
+        writer : output_writer.AsyncWriter, optional
+            See save
+
+        Returns
+        -------
+        list of (str, str)
+            The paths patch k and its ground truth are saved to,
+            img_<name>_p<k> and img_<name>_p<k>_gt with the codecs'
+            extensions
+        """
+
+        files = []
+
+        for number, patch in enumerate(self.patches):
+            name = "img_{}_p{}".format(self.name, number)
+            files.append((
+                self._write(patch.image, None,
+                            name + output_writer.extension(codec), codec,
+                            png_level, writer),
+                self._write(patch.ground_truth, None,
+                            name + "_gt" +
+                            output_writer.extension(ground_truth_codec),
+                            ground_truth_codec, png_level, writer)))
+
+        return files
+
+    def warm_pass1_cache(self, page, bypass=False):
+        """
+        Fill the pass-1 cache of a background ahead of time.
+
+        Parameters
+        ----------
+        page : int
+            The position of the background in the background index
+        bypass : bool, optional
+            Whether or not to bypass the DivaDID stage, as for create
+        """
+
+        engine = self._resolve_engine(bypass)
+        self._set_scale(page)
+
+        pass1_cache.warm(self.backgrounds, page, engine, self.stain_level,
+                         self.text_noisy_level,
+                         lambda: self._degrade_background(page, engine),
+                         grayscale=self.grayscale, height=self.target_height)
+
+    def _set_scale(self, bg_index):
+        """ Set `scale` for the background at bg_index. """
+
+        self.scale = 1.0
+
+        if self.target_height is not None:
+            self.scale = min(1.0, self.target_height /
+                             float(self.backgrounds.heights[bg_index]))
+
+    def _fade_kernel(self):
+        """ The bleed-through blur kernel, scaled like the page. """
+
+        return max(3, int(round(FADE_KERNEL * self.scale)) | 1)
+
+    def _resolve_engine(self, bypass):
+        """ The engine to use, given the bypass argument of create. """
+
+        if bypass is True and self.engine == "divadid":
+            return "native"
+
+        return self.engine
+
+    def _degrade_background(self, bg_index, engine):
+        """
+        Run the first degradation pass on a background image.
+
+        Parameters
+        ----------
+        bg_index : int
+            The position of the background in the background index
+        engine : str
+            The degradation engine to use
+
+        Returns
+        -------
+        cv2.Image or None
+            The degraded background, or None if it could not be read
+        """
+
+        if engine != "divadid":
+            with self.timer.stage("background_decode"):
+                img = background_pool.read_background(
+                    self.backgrounds, bg_index, grayscale=self.grayscale,
+                    height=self.target_height)
+            if img is None:
+                return None
+            self.timer.add_bytes("background_decode", img.nbytes)
+
+            return self._degrade(img, engine)
+
+        # DivaDID reads the background from a file, so a background to be
+        # scaled down is handed over scaled
+        background = self.backgrounds.path(bg_index)
+        if self.scale < 1:
+            with self.timer.stage("background_decode"):
+                img = background_pool.read_background(
+                    self.backgrounds, bg_index, height=self.target_height)
+            if img is None:
+                return None
+
+            background = os.path.join(TMP_DIR, self.name + "_background.png")
+            cv2.imwrite(background, img)
+
+        # Generate XML for DivaDID and then degrade background image
+        dprint("- Generating degraded image - pass 1")
+        first_xml, first_image = self._generate_degradation_xml(
+            background,
+            1,
+            True,
+            TMP_DIR)
+
+        divadid.run_script(first_xml)
+
+        img = cv2.imread(first_image, self._imread_flags())
         os.remove(first_xml)
-        os.remove(second_xml)
         os.remove(first_image)
+        if background != self.backgrounds.path(bg_index):
+            os.remove(background)
 
-    def save(self, file=None):
+        return img
+
+    def save(self, file=None, codec=output_writer.IMAGE_CODEC,
+             png_level=output_writer.PNG_LEVEL, writer=None):
         """
         Save the generated document to the passed location.
 
         Parameters
         ----------
         file : str, optional
-            The name of the file to save the synthetic document to
+            The name of the file to save the synthetic document to. Defaults
+            to img_<name> with the codec's extension
+        codec : str, optional
+            The codec to encode the document with (see output_writer.CODECS)
+        png_level : int, optional
+            The compression level of the png codec
+        writer : output_writer.AsyncWriter, optional
+            Hands encoding and writing over to the writer's threads and
+            returns immediately; the future of the write is added to
+            `writes`. By default the document is written before save
+            returns
+
+        Returns
+        -------
+        str
+            The path the document is saved to, or None if it was not
 
         Note that due to the use of DivaDID, for performance reasons,
         intermediate stages of the document generation process are saved at
@@ -259,35 +717,39 @@ class Document:
         likely need to be moved from that location to a final folder.
         """
 
-        if self.result is None:
+        if self.result is None and self.image is None:
             dprint("Trying to save document before it has been generated.",
                    file=sys.stderr)
             return
 
         if file is None:
-            file = "img_{}.png".format(self.random_seed)
-
-        file = os.path.join(self.output_dir, file)
-
-        try:
-            os.makedirs(self.output_dir)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                raise
+            file = "img_{}{}".format(self.name, output_writer.extension(codec))
 
-        shutil.copy2(self.result, file)
-        dprint("File saved to {}".format(file))
+        return self._write(self.image, self.result, file, codec, png_level,
+                           writer)
 
-        os.remove(self.result)
-
-    def save_ground_truth(self, file=None):
+    def save_ground_truth(self, file=None,
+                          codec=output_writer.GROUND_TRUTH_CODEC,
+                          png_level=output_writer.PNG_LEVEL, writer=None):
         """
         Save the generated document to the passed location.
 
         Parameters
         ----------
         file : str, optional
-            The name of the file to save the ground truth document to
+            The name of the file to save the ground truth document to.
+            Defaults to img_<name>_gt with the codec's extension
+        codec : str, optional
+            The codec to encode the ground truth with
+        png_level : int, optional
+            The compression level of the png codec
+        writer : output_writer.AsyncWriter, optional
+            See save
+
+        Returns
+        -------
+        str
+            The path the ground truth is saved to, or None if it was not
 
         Note that due to the use of DivaDID, for performance reasons,
         intermediate stages of the document generation process are saved at
@@ -295,13 +757,24 @@ class Document:
         likely need to be moved from that location to a final folder.
         """
 
-        if self.result is None:
+        if self.result is None and self.image is None:
             dprint("Trying to save document before it has been generated.",
                    file=sys.stderr)
             return
 
         if file is None:
-            file = "img_{}_gt.png".format(self.random_seed)
+            file = "img_{}_gt{}".format(self.name,
+                                        output_writer.extension(codec))
+
+        return self._write(self.ground_truth, self.result_ground_truth, file,
+                           codec, png_level, writer)
+
+    def _write(self, img, tmp_file, file, codec, png_level, writer):
+        """
+        Write an in-memory image, or move its TMP_DIR file, to `file`
+        """
+
+        output_writer.check_codec(codec)
 
         file = os.path.join(self.output_dir, file)
 
@@ -311,8 +784,29 @@ class Document:
             if exception.errno != errno.EEXIST:
                 raise
 
-        shutil.copy2(self.result_ground_truth, file)
-        dprint("File saved to {}".format(file))
+        if img is not None:
+            arguments = (output_writer.write_image, file, img, codec,
+                         png_level)
+        else:
+            arguments = (output_writer.move_file, tmp_file, file, codec,
+                         png_level)
+
+        # With a writer, save only counts the time spent waiting for a free
+        # slot in its queue. The write itself is timed on the writer's thread
+        # as the "encode" stage, which the future returns
+        with self.timer.stage("save"):
+            if writer is None:
+                arguments[0](*arguments[1:])
+                dprint("File saved to {}".format(file))
+                self.timer.add_bytes("save", os.path.getsize(file))
+            else:
+                future = writer.submit(_timed_write, arguments[0], file,
+                                       *arguments[1:])
+                if future is not None:
+                    self.writes.append(future)
+                dprint("File queued for {}".format(file))
+
+        return file
 
     def _add_text_fade(self, img):
         """
@@ -337,49 +831,112 @@ class Document:
         the real text stage.
         """
 
-        color = np.array((53, 52, 46))
+        state = self._place_words(img.shape, self._fade_kernel() // 2)
 
-        state = TextWriterState(img.shape)
+        if state.sprites:
+            # Blur all the words at once rather than one by one
+            with self.timer.stage("text_fade_blur"):
+                sprites = util.blur_sprites(state.sprites, img.shape,
+                                            self._fade_kernel(), FADE_BLUR,
+                                            FADE_DOWNSCALE)
 
-        word_rand_folder = random.choice(self.word_image_folder_list)
+            with self.timer.stage("composite"):
+                img = util.composite_sprites(img, sprites,
+                                             out=self._writeable(img))
 
-        all_words = None
+        return img
+
+    def _place_words(self, shape, padding=0, regions=None):
+        """
+        Lay words out on a page and load them as sprites.
+
+        Parameters
+        ----------
+        shape : tuple
+            The shape of the page
+        padding : int, optional
+            A blank border added around every word, which also spaces the
+            words further apart
+        regions : list of tuple, optional
+            Only load the words overlapping one of these (top, left, bottom,
+            right) boxes. The layout, and the random draws, are the same
+            whatever the regions
+
+        Returns
+        -------
+        TextWriterState
+            The layout, holding a sprite for every loaded word
+
+        Words are laid out from their dimensions in the word index, so a word
+        is only decoded once it is known to fit on the page. Words are scaled
+        down like the page (see target_height).
+        """
+
+        color = np.array((53, 52, 46))
+
+        state = TextWriterState(shape)
+
+        word_rand_index = self.py_random.choice(self.word_indexes)
 
         # Add individual words until we run out of space
         while True:
+            word = word_rand_index.random_index(self.py_random)
+            word_shape = np.array((int(word_rand_index.heights[word]),
+                                   int(word_rand_index.widths[word])))
+            if self.scale < 1:
+                word_shape = np.maximum(
+                    np.round(word_shape * self.scale).astype(int), 1)
+            word_shape += 2 * padding
+
+            if state.get_next_word_pos(word_shape) is None:
+                break
 
-            word_image_name = random.choice(os.listdir(word_rand_folder))
-            word_full_path = os.path.join(word_rand_folder, word_image_name)
+            color += self.rng.integers(-2, 3, size=3)
 
-            word = cv2.imread(word_full_path)
-            new_word_space = np.full((word.shape[0] + 50, word.shape[1] + 50, 3),
-                                     255,
-                                     dtype=np.uint8)
-            new_word_space[25:word.shape[0] + 25, 25:word.shape[1] + 25] = word
-            word = new_word_space
-            word = util.add_alpha_channel(word)
+            if regions is not None and \
+                    not _overlaps(state.offset, word_shape, regions):
+                continue
 
-            # if word.shape[0] == 0 or word.shape[1] == 1:
-                # continue
+            with self.timer.stage("words"):
+                alpha = word_atlas.word_alpha(word_rand_index, word)
+                if alpha is None:
+                    # An undecodable word image leaves a gap
+                    continue
+                if self.scale < 1:
+                    alpha = cv2.resize(alpha, (int(word_shape[1]) - 2 * padding,
+                                               int(word_shape[0]) - 2 * padding),
+                                       interpolation=cv2.INTER_AREA)
+            self.timer.add_bytes("words", alpha.nbytes)
 
-            # word = cv2.resize(word, (new_word_width, new_word_height), cv2.INTER_CUBIC)
+            if padding:
+                alpha = cv2.copyMakeBorder(alpha, padding, padding, padding,
+                                           padding, cv2.BORDER_CONSTANT,
+                                           value=0)
 
-            if state.get_next_word_pos(word.shape) is None:
-                break
+            state.add_sprite(util.boost_alpha(alpha), self._ink(color))
 
-            color += np.random.randint(-2, 3, size=3)
-            util.white_to_alpha(word, color=color)
+        return state
 
-            word = cv2.GaussianBlur(word, (51, 51), 0)
+    def _imread_flags(self):
+        """ How to read back the pages DivaDID writes. """
 
-            # word = np.where((word - 20) < 0, 0, word - 20)
+        return cv2.IMREAD_GRAYSCALE if self.grayscale else cv2.IMREAD_COLOR
 
-            all_words = state.get_padded_image(word)
+    def _ink(self, color):
+        """ The color of text sprites, in the channels of the page. """
 
-        if all_words is not None:
-            img = util.alpha_composite(img, all_words)
+        return util.gray_color(color) if self.grayscale else color
 
-        return img
+    @staticmethod
+    def _writeable(img):
+        """
+        `img` if it can be composited onto in place, None otherwise
+
+        Cached pass-1 variants and decoded backgrounds are read-only memory
+        maps, shared with other documents.
+        """
+
+        return img if img.flags.writeable else None
 
     def _add_text(self, img):
         """
@@ -401,52 +958,123 @@ class Document:
         the ground truth image is generated as well.
         """
 
-        color = np.array((53, 52, 46))
+        state = self._place_words(img.shape)
+
+        if not state.sprites:
+            print("GOODBYE")
+            return None
 
-        state = TextWriterState(img.shape)
+        with self.timer.stage("composite"):
+            img = util.composite_sprites(img, state.sprites,
+                                         out=self._writeable(img))
 
-        ground_truth = np.ones((img.shape[0], img.shape[1], 3), np.uint8)
+        # The ground truth is 1 where the text, composited onto a page of 1s,
+        # rises above gray level 10. util.text_mask finds those pixels from
+        # the text's alpha alone
+        with self.timer.stage("ground_truth"):
+            ground_truth = util.text_mask(state.sprites, img.shape)
+            self.word_boxes = util.sprite_boxes(state.sprites, img.shape)
+            self.timer.add_bytes("ground_truth", ground_truth.nbytes)
 
-        word_rand_folder = random.choice(self.word_image_folder_list)
+            if self.in_memory:
+                self.ground_truth = ground_truth
+                return img
 
-        all_words = None
+            self.result_ground_truth = os.path.join(TMP_DIR,
+                                                    self.name + "_gt.png")
 
-        while True:
+            cv2.imwrite(self.result_ground_truth, ground_truth)
+
+        return img
 
-            word_image_name = random.choice(os.listdir(word_rand_folder))
-            word_full_path = os.path.join(word_rand_folder, word_image_name)
+    def _degrade(self, img, engine, stains=None, offset=(0, 0)):
+        """
+        Degrade an image in process.
 
-            word = cv2.imread(word_full_path)
-            word = util.add_alpha_channel(word)
+        Parameters
+        ----------
+        img : cv2.Image
+            The image to degrade
+        engine : str
+            Either "native" or "none"
+        stains : tuple, optional
+            The (strength, stains) _draw_stains picked for a whole page that
+            `img` is a window of
+        offset : tuple, optional
+            The (top, left) position of `img` on that page
 
-            # if word.shape[0] == 0 or word.shape[1] == 1:
-                # continue
+        Returns
+        -------
+        cv2.Image
 
-            if state.get_next_word_pos(word.shape) is None:
-                break
+        This is the array-based counterpart to a DivaDID pass. Stain strength
+        and density are drawn from the same ranges _generate_degradation_xml
+        uses.
+        """
 
-            color += np.random.randint(-2, 3, size=3)
-            util.white_to_alpha(word, color=color)
+        if engine == "none":
+            return img
 
-            all_words = state.get_padded_image(word)
+        if stains is not None:
+            strength, placed = stains
+            return degradation.degrade(img,
+                                       strength,
+                                       None,
+                                       self.text_noisy_level,
+                                       STAIN_IMAGES_DIR,
+                                       rng=self.rng,
+                                       scale=self.scale,
+                                       stains=placed,
+                                       offset=offset)
 
-        if all_words is None:
-            print("GOODBYE")
-            return None
+        strength, density = self._stain_parameters()
 
-        ground_truth_word = all_words.copy()
+        return degradation.degrade(img,
+                                   strength,
+                                   density,
+                                   self.text_noisy_level,
+                                   STAIN_IMAGES_DIR,
+                                   rng=self.rng,
+                                   scale=self.scale)
 
-        img = util.alpha_composite(img, all_words)
-        ground_truth = util.alpha_composite(ground_truth, ground_truth_word)
+    def _stain_parameters(self):
+        """ A random (strength, density) pair for self.stain_level. """
 
-        ground_truth = cv2.cvtColor(ground_truth, cv2.COLOR_BGR2GRAY)
-        _, ground_truth = cv2.threshold(ground_truth, 10, 1, cv2.THRESH_BINARY)
+        (strength_low, strength_high), (density_low, density_high) = \
+            degradation.stain_parameter_bounds(self.stain_level)
 
-        self.result_ground_truth = os.path.join(TMP_DIR, str(self.random_seed) + "_gt.png")
+        strength = self.py_random.uniform(strength_low, strength_high)
+        density = self.py_random.uniform(density_low, density_high)
 
-        cv2.imwrite(self.result_ground_truth, ground_truth)
+        return strength, density
 
-        return img
+    def _draw_stains(self, shape, engine):
+        """
+        Pick the stains of one native degradation pass over a whole page.
+
+        Parameters
+        ----------
+        shape : tuple
+            The shape of the page
+        engine : str
+            Either "native" or "none"
+
+        Returns
+        -------
+        tuple or None
+            The (strength, stains) to pass to _degrade for each window of the
+            page, or None for the "none" engine
+        """
+
+        if engine == "none":
+            return None
+
+        strength, density = self._stain_parameters()
+
+        return strength, degradation.draw_stains(shape, density,
+                                                 STAIN_IMAGES_DIR,
+                                                 rng=self.rng,
+                                                 scale=self.scale)
 
     def _generate_degradation_xml(self,
                                   base_image,
@@ -487,14 +1115,11 @@ class Document:
         In either case, the return value is the generated XML.
         """
 
-        output_file_name = "degraded_{}_{}.png".format(self.random_seed, index)
-        xml_file_name = "degradation_script_{}_{}.xml".format(self.random_seed,
-                                                              index)
+        output_file_name = "degraded_{}_{}.png".format(self.name, index)
+        xml_file_name = "degradation_script_{}_{}.xml".format(self.name, index)
 
-        stain_strength_low_bound = 0.1 * self.stain_level
-        stain_strength_high_bound = 0.1 + 0.1 * self.stain_level
-        stain_density_low_bound = 2 + 0.1 * self.stain_level
-        stain_density_high_bound = 2 + 0.1 * self.stain_level
+        (strength_low, strength_high), (density_low, density_high) = \
+            degradation.stain_parameter_bounds(self.stain_level)
 
         if save_location is None:
             xml_full_path = os.path.join("data/xml/", xml_file_name)
@@ -503,50 +1128,17 @@ class Document:
             xml_full_path = os.path.join(save_location, xml_file_name)
             output_full_path = os.path.join(save_location, output_file_name)
 
-        root = etree.Element("root")
-
-        alias_e = etree.SubElement(root, "alias")
-        alias_e.set("id", "INPUT")
-
-        alias_e.set("value", base_image)
-
-        image_e = etree.SubElement(root, "image")
-        image_e.set("id", "my-image")
-        load_e = etree.SubElement(image_e, "load")
-        load_e.set("file", "INPUT")
-
-        image_e2 = etree.SubElement(root, "image")
-        image_e2.set("id", "my-copy")
-        copy_e2 = etree.SubElement(image_e2, "copy")
-        copy_e2.set("ref", "my-image")
-
-        # Add stains
-        for stain_folder in [STAIN_IMAGES_DIR]:  # os.listdir(STAIN_IMAGES_DIR)[0:20]:
-            gradient_degradation_e = etree.SubElement(root,
-                                                      "gradient-degradations")
-            gradient_degradation_e.set("ref", "my-copy")
-            strength_e = etree.SubElement(gradient_degradation_e, "strength")
-            strength_e.text = "{:.2f}".format(
-                random.uniform(stain_strength_low_bound,
-                               stain_strength_high_bound))
-            density_e = etree.SubElement(gradient_degradation_e, "density")
-            density_e.text = "{:.2f}".format(
-                random.uniform(stain_density_low_bound,
-                               stain_density_high_bound))
-            iterations_e = etree.SubElement(gradient_degradation_e,
-                                            "iterations")
-            iterations_e.text = "750"
-            source_e = etree.SubElement(gradient_degradation_e, "source")
-            source_e.text = stain_folder
-
-        save_e = etree.SubElement(root, "save")
-        save_e.set("ref", "my-copy")
-        save_e.set("file", output_full_path)
+        strength = self.py_random.uniform(strength_low, strength_high)
+        density = self.py_random.uniform(density_low, density_high)
+
+        root = divadid.build_script(base_image,
+                                    output_full_path,
+                                    strength,
+                                    density,
+                                    STAIN_IMAGES_DIR)
 
         if save is True:
-            output_xml = open(xml_full_path, 'w')
-            output_xml.write(
-                etree.tostring(root, pretty_print=True).decode("utf-8"))
+            divadid.write_script(root, xml_full_path)
 
             return xml_full_path, output_full_path
 
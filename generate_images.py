@@ -12,15 +12,31 @@ the binarized data is exclusively the text itself, and not other noise.
 """
 import argparse
 import configparser
+import functools
+import json
 import multiprocessing
 import os
-import random
+import queue
 import sys
+import time
 
 from multiprocessing import Pool
-from document import Document
+from document import Document, BACKGROUND_IMAGES_DIR, HANDWRITTEN_WORDS_DIR
+from document import DEFAULT_TARGET_HEIGHT, PATCH_MARGIN, PATCH_SIZE
+from document import new_run_seed, remove_orphaned_files
 
+import background_pool
 import cv2
+import degradation
+import divadid
+import lmdb_output
+import manifest
+import output_writer
+import pass1_cache
+import stage_timer
+import tar_shards
+import word_atlas
+import word_index
 
 # Check to make sure that we are using Python 3
 if sys.version_info < (3, 0):
@@ -30,10 +46,28 @@ if sys.version_info < (3, 0):
 CONFIG = configparser.ConfigParser()
 CONFIG.read("settings.ini")
 
-DEFAULT_OUTPUT_DIR = os.path.join(CONFIG['DIRECTORIES']['base_output_dir'],
-                                  "synthetic_trial_" + str(random.randint(10000, 100000)))
+DEFAULT_BASE_OUTPUT_DIR = CONFIG['DIRECTORIES']['base_output_dir']
 DEFAULT_STAIN_LEVEL = CONFIG['IMAGES']['stain_level']
 DEFAULT_NOISE_LEVEL = CONFIG['IMAGES']['noise_level']
+DEFAULT_IN_MEMORY = CONFIG.getboolean('IMAGES', 'in_memory', fallback=False)
+DEFAULT_GRAYSCALE = CONFIG.getboolean('IMAGES', 'grayscale', fallback=False)
+DEFAULT_PATCHES = CONFIG.getint('PATCHES', 'count', fallback=0)
+
+OUTPUT_FORMATS = ("files", "lmdb", "tar")
+
+# Seconds between two throughput reports
+REPORT_INTERVAL = 5
+
+# The arguments that shape a run's output. They are saved when a run starts,
+# and --resume restores those it is not given and rejects differing ones
+RUN_SETTINGS = ("output_count", "stain_level", "text_noise_level", "engine",
+                "grayscale", "target_height", "patches", "patch_size",
+                "patch_margin", "output_format", "codec", "gt_codec",
+                "png_level", "word_boxes")
+
+# The queue a pool worker reports the outcome of its asynchronous writes to,
+# as (index, stages, errors) tuples (see report_writes)
+_write_results = None
 
 
 def dprint(*args, **kwargs):
@@ -63,6 +97,21 @@ def check_output_count(value):
     return value
 
 
+def check_non_negative(value):
+    """
+    Custom `type` function for argparse to check for counts that may be 0
+
+    A custom function that verifies that values passed into the program as
+    --patches and --patch_margin are valid. Valid means any non-negative
+    integer.
+    """
+    value = int(value)
+    if value < 0:
+        raise argparse.ArgumentTypeError("Value must not be negative")
+
+    return value
+
+
 def check_level(value):
     """
     Custom `type` function for argparse to check for valid level args
@@ -88,27 +137,237 @@ def generate_single_image(fn_args):
     fn_args : argparse.Namespace
 
     Using arguments passed in the command line, generate a single image and
-    save it to the given output directory.
+    save it to the given output directory, or encode it for the main process
+    to store when the output format is not files.
+
+    Returns
+    -------
+    (dict, (bytes, bytes)) or None
+        The manifest record of the image and, unless the output format is
+        files, the encoded image and ground truth. The record's 'stages' hold
+        the document's stage timings (see stage_timer). None if the image was
+        not generated
+
+    With --patches, the record lists the 'patches' of the page and the
+    encoded data is a list of (image, ground truth) pairs, one per patch.
     """
     dprint("Generating image #{}".format(fn_args['iter'] + 1))
 
     try:
         document = Document(fn_args['args'].stain_level,
                             fn_args['args'].text_noise_level,
-                            output_loc=fn_args['args'].output_dir)
-
+                            output_loc=fn_args['args'].output_dir,
+                            engine=fn_args['args'].engine,
+                            in_memory=fn_args['args'].in_memory,
+                            grayscale=fn_args['args'].grayscale,
+                            run_seed=fn_args['args'].seed,
+                            index=fn_args['iter'],
+                            patch_count=fn_args['args'].patches,
+                            patch_size=fn_args['args'].patch_size,
+                            patch_margin=fn_args['args'].patch_margin,
+                            target_height=fn_args['args'].target_height)
+
+        start = time.time()
         document.create(bypass=fn_args['args'].bypass_divadid)
-        document.save()
-        document.save_ground_truth()
+        created = time.time()
+
+        args = fn_args['args']
+        record = {
+            'index': fn_args['iter'],
+            'name': document.name,
+            'run_seed': document.run_seed,
+            'shard': args.shard_index,
+            'params': {
+                'engine': document.engine,
+                'stain_level': document.stain_level,
+                'noise_level': document.text_noisy_level,
+                'grayscale': document.grayscale,
+                'scale': round(document.scale, 6),
+            },
+        }
+
+        if args.word_boxes:
+            record['word_boxes'] = [list(box) for box in document.word_boxes]
+
+        if args.output_format != "files":
+            if args.patches:
+                if not document.patches:
+                    return None
+
+                images = [(patch.image, patch.ground_truth)
+                          for patch in document.patches]
+                record['patches'] = [{'top': patch.top, 'left': patch.left}
+                                     for patch in document.patches]
+            else:
+                if document.image is None or document.ground_truth is None:
+                    return None
+
+                images = [(document.image, document.ground_truth)]
+
+            with document.timer.stage("save"):
+                payload = [(output_writer.encode(image, args.codec,
+                                                 args.png_level),
+                            output_writer.encode(ground_truth, args.gt_codec,
+                                                 args.png_level))
+                           for image, ground_truth in images]
+            document.timer.add_bytes("save", sum(
+                len(image_data) + len(ground_truth_data)
+                for image_data, ground_truth_data in payload))
+
+            if not args.patches:
+                payload = payload[0]
+
+            record['stages'] = document.timer.as_dict()
+            record['image_codec'] = args.codec
+            record['ground_truth_codec'] = args.gt_codec
+            record['seconds'] = {
+                'create': round(created - start, 3),
+                'save': round(time.time() - created, 3),
+            }
+
+            return record, payload
+
+        writer = None
+        if args.writer_threads > 0:
+            writer = output_writer.get_writer(args.writer_threads,
+                                              args.writer_queue)
+
+        if args.patches:
+            files = document.save_patches(args.codec, args.gt_codec,
+                                          args.png_level, writer)
+            if not files:
+                return None
+
+            record['patches'] = [
+                {'top': patch.top, 'left': patch.left,
+                 'image': os.path.basename(image_file),
+                 'ground_truth': os.path.basename(ground_truth_file)}
+                for patch, (image_file, ground_truth_file)
+                in zip(document.patches, files)]
+        else:
+            image_file = document.save(codec=args.codec,
+                                       png_level=args.png_level, writer=writer)
+            ground_truth_file = document.save_ground_truth(
+                codec=args.gt_codec, png_level=args.png_level, writer=writer)
+
+            if image_file is None:
+                return None
+
+            record['image'] = os.path.basename(image_file)
+            record['ground_truth'] = os.path.basename(ground_truth_file)
+
+        if document.writes:
+            # The main process only lists the document once its files are
+            # written, which the writer reports through _write_results
+            output_writer.when_done(
+                document.writes,
+                functools.partial(report_writes, fn_args['iter']))
+            record['writes_pending'] = True
+
+        saved = time.time()
+
+        record['stages'] = document.timer.as_dict()
+        record['seconds'] = {
+            'create': round(created - start, 3),
+            'save': round(saved - created, 3),
+        }
+
+        return record, None
 
     except cv2.error as exception:
-        dprint(document.random_seed)
+        dprint(document.name)
         dprint(type(exception))
         dprint(exception.args)
         dprint(exception.args)
 
         with open("errors.txt", "a+") as errors:
-            errors.write("{}\n".format(document.random_seed))
+            errors.write("{}\n".format(document.name))
+
+        return None
+
+    except OSError as exception:
+        dprint("Write failed: {}".format(exception), file=sys.stderr)
+
+        return None
+
+
+def report_writes(index, timers, errors):
+    """
+    Report the writes of document `index` to the main process
+
+    Called by the worker's AsyncWriter once they are all done, with the
+    StageTimer of every write that succeeded and the exception of every
+    write that failed.
+    """
+    timer = stage_timer.StageTimer()
+    for write_timer in timers:
+        timer.merge(write_timer)
+
+    _write_results.put((index, timer.as_dict(),
+                        [str(error) for error in errors]))
+
+
+def init_worker(engine, writer_threads=0, writer_queue=1, grayscale=False,
+                write_results=None):
+    """
+    Prepare a pool worker process
+
+    Parameters
+    ----------
+    engine : str
+        The degradation engine the run uses
+    writer_threads, writer_queue : int, optional
+        The size of the worker's output writer. No writer is started for 0
+        threads
+    grayscale : bool, optional
+        Whether the run generates gray pages, which need gray stains
+    write_results : multiprocessing.Queue, optional
+        Where the outcome of the worker's asynchronous writes is reported
+
+    Runs once per worker, before its first image. Loads everything that is
+    shared between documents (indexes, the word atlas, stains, the DivaDID
+    JVM) so that the cost is paid once per process rather than per page.
+    """
+    words = word_index.load_index(HANDWRITTEN_WORDS_DIR)
+    if word_atlas.ATLAS_ENABLED:
+        word_atlas.load_atlas(words)
+
+    background_pool.load_index(BACKGROUND_IMAGES_DIR)
+
+    global _write_results
+    _write_results = write_results
+
+    if writer_threads > 0:
+        output_writer.get_writer(writer_threads, writer_queue)
+
+    if engine == "native":
+        degradation.load_stains(grayscale=grayscale)
+    elif engine == "divadid" and divadid.PERSISTENT_WORKER:
+        divadid.get_worker().start()
+
+
+def warm_single_background(fn_args):
+    """
+    Fill the pass-1 cache of a single background
+
+    Parameters
+    ----------
+    fn_args : dict
+        The background's position in the background index ('page') and the
+        command line arguments ('args')
+    """
+    dprint("Warming pass-1 cache of background #{}".format(fn_args['page']))
+
+    document = Document(fn_args['args'].stain_level,
+                        fn_args['args'].text_noise_level,
+                        output_loc=fn_args['args'].output_dir,
+                        engine=fn_args['args'].engine,
+                        in_memory=fn_args['args'].in_memory,
+                        grayscale=fn_args['args'].grayscale,
+                        target_height=fn_args['args'].target_height)
+
+    document.warm_pass1_cache(fn_args['page'],
+                              bypass=fn_args['args'].bypass_divadid)
 
 
 def main():
@@ -121,32 +380,418 @@ def main():
     parser = argparse.ArgumentParser(description='Generate some images.')
     parser.add_argument('output_count', metavar='N', type=check_output_count,
                         nargs='?', default=10,
-                        help='number of images to generate')
+                        help='number of images to generate, across all '
+                             'shards')
     parser.add_argument('stain_level', metavar='S', type=check_level,
                         nargs='?', default=DEFAULT_STAIN_LEVEL, help='amount of noise in stains')
     parser.add_argument('text_noise_level', metavar='T', type=check_level,
                         nargs='?', default=DEFAULT_NOISE_LEVEL, help='amount of noise in text')
-    parser.add_argument('--output_dir', metavar='DIR', default=DEFAULT_OUTPUT_DIR,
-                        help='directory where final images are to be saved')
+    parser.add_argument('--output_dir', metavar='DIR', default=None,
+                        help='directory where final images are to be saved '
+                             '(default: synthetic_run_<seed> in the base '
+                             'output directory)')
+    parser.add_argument('--engine', choices=degradation.ENGINES,
+                        default=degradation.DEFAULT_ENGINE,
+                        help="degradation engine to use")
     parser.add_argument('--bypass_divadid', action='store_true',
-                        help="do not pass images through DivaDID")
+                        help="do not pass images through DivaDID, degrade them "
+                             "with the native engine instead")
+    parser.add_argument('--in_memory', action='store_true',
+                        default=DEFAULT_IN_MEMORY,
+                        help="keep intermediate images in memory and only "
+                             "encode them once, on save")
+    parser.add_argument('--grayscale', action='store_true',
+                        default=DEFAULT_GRAYSCALE,
+                        help="generate single-channel gray pages, end to end")
+    parser.add_argument('--target_height', type=int,
+                        default=DEFAULT_TARGET_HEIGHT,
+                        help="scale backgrounds down to this height before "
+                             "any processing, and words and stains alike "
+                             "(0 = the scans' resolution)")
+    parser.add_argument('--patches', type=check_non_negative, default=DEFAULT_PATCHES,
+                        help="only generate this many square windows of each "
+                             "page, around its text (0 = whole pages)")
+    parser.add_argument('--patch_size', type=check_output_count,
+                        default=PATCH_SIZE,
+                        help="side of the windows generated with --patches")
+    parser.add_argument('--patch_margin', type=check_non_negative,
+                        default=PATCH_MARGIN,
+                        help="margin degraded and composited around every "
+                             "window")
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS,
+                        default="files",
+                        help="write one file per image, pack images into an "
+                             "LMDB environment per shard, or into rolling "
+                             "tar shards")
+    parser.add_argument('--codec', choices=output_writer.CODECS,
+                        default=output_writer.IMAGE_CODEC,
+                        help="codec of the generated images")
+    parser.add_argument('--gt_codec',
+                        choices=output_writer.CODECS + output_writer.MASK_CODECS,
+                        default=output_writer.GROUND_TRUTH_CODEC,
+                        help="codec of the ground truth images. png1 (1-bit "
+                             "PNG) and npybits (bit-packed .npz) are compact "
+                             "mask codecs")
+    parser.add_argument('--word_boxes', action='store_true',
+                        help="add the (top, left, bottom, right) box of every "
+                             "word to the manifest records")
+    parser.add_argument('--png_level', type=int, choices=range(10),
+                        default=output_writer.PNG_LEVEL, metavar='0-9',
+                        help="compression level of png output")
+    parser.add_argument('--writer_threads', type=int,
+                        default=output_writer.WRITER_THREADS,
+                        help="threads per worker encoding and writing "
+                             "finished images (0 = write synchronously)")
+    parser.add_argument('--writer_queue', type=check_output_count,
+                        default=output_writer.WRITER_QUEUE,
+                        help="images a worker may have waiting to be "
+                             "written before it blocks")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="run seed. Every document is seeded from it and "
+                             "its index, so a run is reproducible")
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help="index of the shard generated by this process")
+    parser.add_argument('--shard_count', type=check_output_count, default=1,
+                        help="number of shards the run is split into")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted run in --output_dir, "
+                             "skipping the documents its manifest lists")
+    parser.add_argument('--metrics', metavar='FILE', default=None,
+                        help="append the stage timings of every document to "
+                             "FILE, one JSON line per document")
+    parser.add_argument('--warm_pass1_cache', action='store_true',
+                        help="degrade every background ahead of time to fill "
+                             "the pass-1 cache before generating")
+    parser.add_argument('--workers', type=check_output_count,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument('--chunksize', type=check_output_count, default=1,
+                        help="number of images handed to a worker at once")
+    parser.add_argument('--recycle_after', type=int, default=0,
+                        help="replace a worker after it generated this many "
+                             "images, to cap memory creep (0 = never)")
 
     args = parser.parse_args()
 
-    print("Generating {} images in {}".format(args.output_count,
-                                              args.output_dir))
-
-    # Uncomment this line and comment out the pool = Pool() line to aid in
+    # Parse again without defaults, to tell which settings were given
+    parser.set_defaults(**dict.fromkeys(RUN_SETTINGS))
+    explicit = vars(parser.parse_args())
+    given = set(key for key in RUN_SETTINGS if explicit[key] is not None)
+
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard_index must be between 0 and --shard_count - 1")
+
+    manifest_file = None
+    completed = {}
+    saved_settings = None
+
+    if args.resume:
+        if args.output_dir is None and args.seed is None:
+            parser.error("--resume needs the --output_dir or the --seed of "
+                         "the interrupted run")
+
+        if args.output_dir is None:
+            args.output_dir = os.path.join(
+                DEFAULT_BASE_OUTPUT_DIR, "synthetic_run_{}".format(args.seed))
+
+        manifest_file = os.path.join(
+            args.output_dir,
+            manifest.shard_manifest_name(args.shard_index, args.shard_count))
+        completed = manifest.completed_records(manifest_file)
+
+        run_seeds = set(record['run_seed'] for record in completed.values())
+        if args.seed is None and len(run_seeds) == 1:
+            args.seed = run_seeds.pop()
+        elif run_seeds - {args.seed}:
+            parser.error("{} belongs to run {}, not {}".format(
+                manifest_file, sorted(run_seeds), args.seed))
+
+        if args.seed is None:
+            parser.error("nothing to resume in {}; pass the --seed of the "
+                         "interrupted run".format(args.output_dir))
+
+        settings_file = os.path.join(
+            args.output_dir,
+            manifest.run_settings_name(args.shard_index, args.shard_count))
+        saved_settings = manifest.read_run_settings(settings_file)
+
+        if saved_settings is None and 'output_count' not in given:
+            parser.error("{} does not hold the settings of the interrupted "
+                         "run; pass N and the settings it was started "
+                         "with".format(args.output_dir))
+
+        for key, value in (saved_settings or {}).items():
+            if key in RUN_SETTINGS and key not in given:
+                setattr(args, key, value)
+
+    if args.seed is None:
+        if args.shard_count > 1:
+            parser.error("sharded runs need an explicit --seed shared by "
+                         "every shard")
+        args.seed = new_run_seed()
+
+    if args.output_dir is None:
+        args.output_dir = os.path.join(DEFAULT_BASE_OUTPUT_DIR,
+                                       "synthetic_run_{}".format(args.seed))
+
+    if args.bypass_divadid and args.engine == "divadid":
+        args.engine = "native"
+
+    if saved_settings is not None:
+        for key in RUN_SETTINGS:
+            if key in saved_settings and \
+                    getattr(args, key) != saved_settings[key]:
+                parser.error("the interrupted run was started with {} = {}, "
+                             "not {}".format(key, saved_settings[key],
+                                             getattr(args, key)))
+
+    if args.patches > 0:
+        if args.engine == "divadid":
+            parser.error("--patches needs the native or none engine (or "
+                         "--bypass_divadid)")
+        if args.output_format == "lmdb":
+            parser.error("--patches cannot be written to lmdb")
+
+    if args.output_format != "files":
+        # Pages are encoded from their arrays and shipped to the main process
+        args.in_memory = True
+
+    if manifest_file is None:
+        manifest_file = os.path.join(
+            args.output_dir,
+            manifest.shard_manifest_name(args.shard_index, args.shard_count))
+
+    indices = [index for index in manifest.shard_indices(args.output_count,
+                                                         args.shard_index,
+                                                         args.shard_count)
+               if index not in completed]
+
+    if args.resume:
+        removed = remove_orphaned_files(args.seed)
+        removed += output_writer.remove_partial_files(args.output_dir,
+                                                      args.seed)
+        print("Resuming run {}: {} images already done, {} orphaned "
+              "temporary files removed".format(args.seed, len(completed),
+                                               removed))
+
+    print("Generating {} images in {} (seed {}, shard {} of {})".format(
+        len(indices), args.output_dir, args.seed, args.shard_index,
+        args.shard_count))
+
+    # Build the shared word atlas once, before the workers start mapping it
+    if word_atlas.ATLAS_ENABLED:
+        word_atlas.load_atlas(word_index.load_index(HANDWRITTEN_WORDS_DIR))
+
+    # Uncomment this line and comment out the pool = Pool(...) line to aid in
     # debugging
     # generate_single_image({'iter': 0, 'args': args})
-    pool = Pool()
-
-    pool.map(generate_single_image,
-             list(map(lambda x: {'iter': x, 'args': args},
-                      range(args.output_count))))
-
-    print("Generated {} images in {}".format(args.output_count,
+    maxtasksperchild = None
+    if args.recycle_after > 0:
+        maxtasksperchild = max(1, args.recycle_after // args.chunksize)
+
+    write_results = multiprocessing.Queue()
+    pool = Pool(args.workers, initializer=init_worker,
+                initargs=(args.engine, args.writer_threads,
+                          args.writer_queue, args.grayscale, write_results),
+                maxtasksperchild=maxtasksperchild)
+
+    if args.warm_pass1_cache and not pass1_cache.enabled(args.engine):
+        print("The pass-1 cache is disabled (see reuse_factor in "
+              "settings.ini), not warming it", file=sys.stderr)
+    elif args.warm_pass1_cache:
+        pages = range(len(background_pool.load_index(BACKGROUND_IMAGES_DIR)))
+        pool.map(warm_single_background,
+                 list(map(lambda x: {'page': x, 'args': args}, pages)))
+
+    tasks = map(lambda x: {'iter': x, 'args': args}, indices)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if not args.resume and os.path.isfile(manifest_file):
+        # A fresh run overwrites whatever documents the old manifest listed
+        os.remove(manifest_file)
+
+    if saved_settings is None:
+        settings = {key: getattr(args, key) for key in RUN_SETTINGS}
+        settings['seed'] = args.seed
+        manifest.write_run_settings(
+            os.path.join(args.output_dir, manifest.run_settings_name(
+                args.shard_index, args.shard_count)), settings)
+    manifest_writer = manifest.ManifestWriter(manifest_file)
+
+    store = None
+    if args.output_format == "lmdb":
+        lmdb_name = lmdb_output.shard_environment_name(args.shard_index,
+                                                       args.shard_count)
+        store = lmdb_output.LmdbShardWriter(
+            os.path.join(args.output_dir, lmdb_name), manifest_writer)
+    elif args.output_format == "tar":
+        def commit_shard(shard, records):
+            for record in records:
+                record['tar'] = shard
+                manifest_writer.append(record)
+
+        store = tar_shards.TarShardWriter(
+            args.output_dir,
+            "images_shard_{:05d}_of_{:05d}".format(args.shard_index,
+                                                   args.shard_count),
+            on_commit=commit_shard)
+
+    summary = stage_timer.StageSummary()
+    metrics_file = None
+    if args.metrics is not None:
+        metrics_file = open(args.metrics, 'a')
+
+    start = time.time()
+    last_report = start
+    done = 0
+    failed = 0
+
+    def add_stages(record):
+        stages = record.pop('stages')
+        summary.add(stages)
+
+        if metrics_file is not None:
+            metrics_file.write(json.dumps({'index': record['index'],
+                                           'name': record['name'],
+                                           'stages': stages},
+                                          sort_keys=True) + "\n")
+
+    # Documents written by a worker's AsyncWriter are listed in the manifest
+    # once the writer reports their files written, along with the "encode"
+    # stage timed on its threads. The report may arrive before or after the
+    # record
+    waiting = {}
+    written = {}
+
+    def write_finished(index, stages, errors):
+        nonlocal failed
+
+        if index not in waiting:
+            written[index] = (stages, errors)
+            return
+
+        record = waiting.pop(index)
+        record['stages'].update(stages)
+        add_stages(record)
+
+        if errors:
+            failed += 1
+            print("Image #{} was not written: {}".format(
+                index + 1, "; ".join(errors)), file=sys.stderr)
+        else:
+            manifest_writer.append(record)
+
+    def collect_writes(timeout=None):
+        while True:
+            try:
+                if timeout is None:
+                    result = write_results.get_nowait()
+                else:
+                    result = write_results.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+            write_finished(*result)
+
+    # Results stream back as soon as any worker finishes an image, so a slow
+    # page never holds up the report or the other workers.
+    for result in pool.imap_unordered(generate_single_image, tasks,
+                                      args.chunksize):
+        done += 1
+        if result is not None and 'writes_pending' not in result[0]:
+            add_stages(result[0])
+
+        if result is None:
+            failed += 1
+        elif result[0].pop('writes_pending', False):
+            index = result[0]['index']
+            waiting[index] = result[0]
+            if index in written:
+                write_finished(index, *written.pop(index))
+        elif store is None:
+            manifest_writer.append(result[0])
+        elif args.output_format == "lmdb":
+            record, (image_data, ground_truth_data) = result
+            record['lmdb'] = lmdb_name
+            store.put(record, image_data, ground_truth_data)
+        elif args.patches:
+            # All the patches of a page form one sample, with members
+            # p<k>.<ext> and p<k>.gt.<ext>
+            record, payload = result
+            key = "img_" + record['name']
+            members = []
+
+            for number, (patch, (image_data, ground_truth_data)) in \
+                    enumerate(zip(record['patches'], payload)):
+                patch['image_member'] = "{}.p{}{}".format(
+                    key, number, output_writer.extension(args.codec))
+                patch['ground_truth_member'] = "{}.p{}.gt{}".format(
+                    key, number, output_writer.extension(args.gt_codec))
+                members.append((patch['image_member'][len(key) + 1:],
+                                image_data))
+                members.append((patch['ground_truth_member'][len(key) + 1:],
+                                ground_truth_data))
+
+            members.append(
+                ("json", json.dumps(record, sort_keys=True).encode("utf-8")))
+            store.add(key, members, record)
+        else:
+            record, (image_data, ground_truth_data) = result
+            key = "img_" + record['name']
+            record['image_member'] = key + output_writer.extension(args.codec)
+            record['ground_truth_member'] = key + ".gt" + \
+                output_writer.extension(args.gt_codec)
+            store.add(key, [
+                (record['image_member'][len(key) + 1:], image_data),
+                (record['ground_truth_member'][len(key) + 1:],
+                 ground_truth_data),
+                ("json", json.dumps(record, sort_keys=True).encode("utf-8")),
+            ], record)
+
+        collect_writes()
+
+        now = time.time()
+        if now - last_report >= REPORT_INTERVAL or done == len(indices):
+            last_report = now
+            print("{}/{} images ({} failed), {:.2f} pages/sec".format(
+                done, len(indices), failed, done / (now - start)))
+
+    pool.close()
+    pool.join()
+
+    # The workers closed their writers on exit, so every report is sent
+    while waiting:
+        collected = len(waiting)
+        collect_writes(timeout=1)
+        if len(waiting) == collected:
+            break
+
+    if waiting:
+        failed += len(waiting)
+        print("{} images were never reported written".format(len(waiting)),
+              file=sys.stderr)
+
+        for record in waiting.values():
+            add_stages(record)
+
+    if store is not None:
+        store.close()
+    manifest_writer.close()
+    if metrics_file is not None:
+        metrics_file.close()
+
+    summary_file = os.path.join(
+        args.output_dir, "stage_summary_shard_{:05d}_of_{:05d}.json".format(
+            args.shard_index, args.shard_count))
+    with open(summary_file, 'w') as output:
+        json.dump(summary.summary(), output, indent=2, sort_keys=True)
+
+    print("Generated {} images in {}".format(done - failed,
                                               args.output_dir))
+    print("Stage timings: {}".format(summary_file))
+    print(json.dumps({name: stage["wall"]
+                      for name, stage in summary.summary()["stages"].items()},
+                     indent=2, sort_keys=True))
 
 
 if __name__ == "__main__":
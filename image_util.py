@@ -1,3 +1,5 @@
+import functools
+
 import cv2
 import numpy as np
 
@@ -14,6 +16,44 @@ def white_to_alpha(img, color=None):
     img_clipped = np.minimum(255 - img[:, :, 3], 40)
     np.putmask(img[:, :, 3], img[:, :, 3] > 30, img[:, :, 3] + img_clipped)
 
+def alpha_to_bgra(alpha, color=None):
+    """
+    Build a BGRA sprite from a single-channel alpha mask.
+
+    Equivalent to add_alpha_channel followed by white_to_alpha for a word
+    whose gray levels are 255 - alpha.
+    """
+
+    if color is None:
+        color = [0, 0, 0]
+
+    img = np.empty(alpha.shape + (4,), np.uint8)
+    img[:, :, 0:3] = color
+    img[:, :, 3] = boost_alpha(alpha)
+
+    return img
+
+def boost_alpha(alpha):
+    """
+    The alpha mask of a word, strengthened as white_to_alpha does.
+
+    Returns a new single-channel mask; `alpha` itself is left unchanged.
+    """
+
+    alpha = np.array(alpha, np.uint8)
+
+    img_clipped = np.minimum(255 - alpha, 40)
+    np.putmask(alpha, alpha > 30, alpha + img_clipped)
+
+    return alpha
+
+def gray_color(color):
+    """ The single-channel gray of a BGR color, as cv2.cvtColor computes it. """
+
+    color = np.asarray(color, np.uint8).reshape(1, 1, 3)
+
+    return cv2.cvtColor(color, cv2.COLOR_BGR2GRAY).reshape(1)
+
 def add_alpha_channel(img):
     b, g, r = cv2.split(img)
 
@@ -21,24 +61,334 @@ def add_alpha_channel(img):
 
     return cv2.merge((b, g, r, a))
 
-def alpha_composite(face_img, overlay_t_img):
-    """ From https://stackoverflow.com/a/37198079 """
-    # Split out the transparency mask from the colour info
-    overlay_img = overlay_t_img[:,:,:3] # Grab the BRG planes
-    overlay_mask = overlay_t_img[:,:,3:]  # And the alpha plane
+# Rows composited at a time, bounding the size of the uint16 temporaries
+COMPOSITE_ROWS = 256
+
+def alpha_composite(face_img, overlay_t_img, out=None):
+    """
+    Alpha blend an overlay onto an image, in 8.8 fixed point.
+
+    Parameters
+    ----------
+    face_img : np.ndarray
+        The uint8 image to blend onto, with C channels (2-D for C = 1)
+    overlay_t_img : np.ndarray
+        The uint8 overlay, with C color channels followed by an alpha
+        channel, which is broadcast over the color channels
+    out : np.ndarray, optional
+        Where to write the result. May be face_img itself to blend in place,
+        provided it is writeable (pass1 variants and cached backgrounds are
+        read-only memory maps). A new array by default
+
+    Returns
+    -------
+    np.ndarray
+        out
+
+    Each pixel is (face * (255 - alpha) + overlay * alpha) / 255, rounded
+    down, which is accumulated in uint16 and divided with a shift. The result
+    is within 1 of the floating point blend this used to compute. Rows
+    without any overlay are copied (or, in place, skipped) without blending.
+    """
+
+    if out is None:
+        out = np.empty_like(face_img)
+
+    face = face_img if face_img.ndim == 3 else face_img[:, :, np.newaxis]
+    result = out if out.ndim == 3 else out[:, :, np.newaxis]
+    channels = face.shape[2]
+
+    if overlay_t_img.shape[2] != channels + 1:
+        raise ValueError("Overlay has {} channels, expected {} colors and "
+                         "alpha".format(overlay_t_img.shape[2], channels))
+
+    for top in range(0, face.shape[0], COMPOSITE_ROWS):
+        rows = slice(top, top + COMPOSITE_ROWS)
+        alpha = overlay_t_img[rows, :, channels:]
+
+        if not alpha.any():
+            if out is not face_img:
+                result[rows] = face[rows]
+            continue
+
+        alpha = alpha.astype(np.uint16)
+
+        blended = np.subtract(255, alpha, dtype=np.uint16)
+        blended = blended * face[rows]
+        blended += overlay_t_img[rows, :, 0:channels] * alpha
+
+        # x // 255 == (x + (x >> 8) + 1) >> 8 for every x below 65536
+        blended += (blended >> 8) + 1
+        blended >>= 8
+
+        result[rows] = blended
+
+    return out
+
+
+def _blend(face, alpha, color, out):
+    """ Blend a constant color with an alpha mask, in 8.8 fixed point. """
+
+    alpha = alpha[:, :, np.newaxis].astype(np.uint16)
+
+    blended = np.subtract(255, alpha, dtype=np.uint16)
+    blended = blended * face
+    blended += alpha * np.asarray(color, np.uint16)
+
+    blended += (blended >> 8) + 1
+    blended >>= 8
+
+    out[...] = blended
+
+def composite_sprites(face_img, sprites, out=None):
+    """
+    Alpha blend text sprites onto an image, one bounding box at a time.
+
+    Parameters
+    ----------
+    face_img : np.ndarray
+        The uint8 image to blend onto, with C channels (2-D for C = 1)
+    sprites : list of text_writer_state.Sprite
+        The sprites, each an alpha mask placed at (top, left) in a single
+        color of C channels. They are blended in order
+    out : np.ndarray, optional
+        As for alpha_composite
+
+    Returns
+    -------
+    np.ndarray
+        out
+
+    Every pixel covered by a single sprite gets exactly the value
+    alpha_composite gives for a page-sized overlay holding the sprite.
+    Pixels outside every sprite are only copied.
+    """
+
+    if out is None:
+        out = face_img.copy()
+    elif out is not face_img:
+        out[...] = face_img
+
+    result = out if out.ndim == 3 else out[:, :, np.newaxis]
+    height, width = result.shape[0:2]
+
+    for sprite in sprites:
+        top = max(sprite.top, 0)
+        left = max(sprite.left, 0)
+        bottom = min(sprite.top + sprite.alpha.shape[0], height)
+        right = min(sprite.left + sprite.alpha.shape[1], width)
+
+        if bottom <= top or right <= left:
+            continue
+
+        alpha = sprite.alpha[top - sprite.top:bottom - sprite.top,
+                             left - sprite.left:right - sprite.left]
+        region = result[top:bottom, left:right]
+
+        _blend(region, alpha, sprite.color[0:result.shape[2]], region)
+
+    return out
+
+@functools.lru_cache(maxsize=4096)
+def _mask_threshold(color, background, threshold):
+    """
+    The smallest alpha at which a sprite of `color` (a BGR or gray tuple)
+    blended onto a page of value `background` turns gray above `threshold`,
+    or 256 if none does
+    """
+
+    channels = min(len(color), 3)
+    color = np.array(color, np.uint8)
+
+    alphas = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    blended = np.empty((256, 1, channels), np.uint8)
+    _blend(np.full((256, 1, channels), background, np.uint8), alphas,
+           color[0:channels], blended)
+
+    if channels == 3:
+        gray = cv2.cvtColor(blended, cv2.COLOR_BGR2GRAY).ravel()
+    else:
+        gray = blended.ravel()
+    above = np.flatnonzero(gray > threshold)
+
+    return int(above[0]) if above.size else 256
+
+def text_mask(sprites, shape, background=1, threshold=10):
+    """
+    The 0/1 ground truth mask of text sprites, straight from their alpha.
+
+    Parameters
+    ----------
+    sprites : list of text_writer_state.Sprite
+        The sprites, placed on a page of the given shape
+    shape : tuple
+        The shape of the page
+    background, threshold : int, optional
+        The mask is 1 wherever compositing the sprites onto a gray page of
+        value `background` gives a gray level above `threshold`
+
+    Returns
+    -------
+    np.ndarray
+        The uint8 mask, of the page's height and width
+
+    Compositing is monotonic in alpha, so each sprite reduces to one alpha
+    threshold, derived from its color with the exact compositing and gray
+    conversion arithmetic. No page is composited, and where sprites do not
+    overlap the mask is identical to thresholding the composited page.
+    """
+
+    mask = np.zeros(shape[0:2], np.uint8)
+    height, width = mask.shape
+
+    for sprite in sprites:
+        top = max(sprite.top, 0)
+        left = max(sprite.left, 0)
+        bottom = min(sprite.top + sprite.alpha.shape[0], height)
+        right = min(sprite.left + sprite.alpha.shape[1], width)
+
+        if bottom <= top or right <= left:
+            continue
+
+        alpha_threshold = _mask_threshold(
+            tuple(int(value) for value in sprite.color), background, threshold)
+
+        alpha = sprite.alpha[top - sprite.top:bottom - sprite.top,
+                             left - sprite.left:right - sprite.left]
+        region = mask[top:bottom, left:right]
+        region |= (alpha >= alpha_threshold).view(np.uint8)
+
+    return mask
+
+def crop_sprites(sprites, box):
+    """
+    The parts of sprites inside a box of the page.
+
+    Parameters
+    ----------
+    sprites : list of text_writer_state.Sprite
+        The sprites, in page coordinates
+    box : tuple
+        The (top, left, bottom, right) box
+
+    Returns
+    -------
+    list of text_writer_state.Sprite
+        The sprites overlapping the box, cropped to it and placed in the
+        box's coordinates. Their alpha are views of the original ones
+    """
+
+    top, left, bottom, right = box
+    cropped = []
+
+    for sprite in sprites:
+        sprite_top = max(sprite.top, top)
+        sprite_left = max(sprite.left, left)
+        sprite_bottom = min(sprite.top + sprite.alpha.shape[0], bottom)
+        sprite_right = min(sprite.left + sprite.alpha.shape[1], right)
+
+        if sprite_bottom <= sprite_top or sprite_right <= sprite_left:
+            continue
+
+        cropped.append(sprite._replace(
+            top=sprite_top - top, left=sprite_left - left,
+            alpha=sprite.alpha[sprite_top - sprite.top:sprite_bottom - sprite.top,
+                               sprite_left - sprite.left:sprite_right - sprite.left]))
+
+    return cropped
+
+def sprite_boxes(sprites, shape):
+    """ The (top, left, bottom, right) box of every sprite, on the page. """
+
+    return [(max(sprite.top, 0), max(sprite.left, 0),
+             min(sprite.top + sprite.alpha.shape[0], shape[0]),
+             min(sprite.left + sprite.alpha.shape[1], shape[1]))
+            for sprite in sprites]
+
+# How blur_sprites blurs: an exact Gaussian, a Gaussian at reduced
+# resolution, or three box filters approximating the Gaussian
+BLUR_MODES = ("gaussian", "downscale", "box")
+
+def _blur_layer(layer, sigma, mode, downscale):
+    """ Blur a single-channel layer with a Gaussian of the given sigma. """
+
+    if mode == "gaussian":
+        kernel = cv2.getGaussianKernel(2 * int(np.ceil(3 * sigma)) + 1, sigma)
+        return cv2.sepFilter2D(layer, -1, kernel, kernel)
+
+    if mode == "downscale":
+        height, width = layer.shape
+        small = cv2.resize(layer, (max(1, -(-width // downscale)),
+                                   max(1, -(-height // downscale))),
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (0, 0), sigma / downscale)
+        return cv2.resize(small, (width, height),
+                          interpolation=cv2.INTER_LINEAR)
+
+    if mode == "box":
+        # Three passes of a box filter of width w have a variance of
+        # 3 (w^2 - 1) / 12
+        width = int(round(np.sqrt(4 * sigma ** 2 + 1)))
+        width += 1 - width % 2
+        for _ in range(3):
+            layer = cv2.blur(layer, (width, width))
+        return layer
+
+    raise ValueError("Unknown blur mode {}".format(mode))
+
+def blur_sprites(sprites, shape, ksize, mode="gaussian", downscale=4):
+    """
+    Blur the alpha of text sprites as one layer, in a single pass.
+
+    Parameters
+    ----------
+    sprites : list of text_writer_state.Sprite
+        The sprites, placed on a page of the given shape
+    shape : tuple
+        The shape of the page
+    ksize : int
+        The size of the Gaussian kernel to approximate, as passed to
+        cv2.GaussianBlur with a sigma of 0
+    mode : str, optional
+        One of BLUR_MODES
+    downscale : int, optional
+        The resolution reduction of the "downscale" mode
+
+    Returns
+    -------
+    list of text_writer_state.Sprite
+        The sprites, with their alpha replaced by their box of the blurred
+        layer
+
+    Sprites that are padded by at least ksize // 2 and do not overlap come
+    out as if each had been blurred on its own, but the layer is only
+    filtered once, over the bounding box of all sprites.
+    """
+
+    if not sprites:
+        return []
 
-    # Again calculate the inverse mask
-    background_mask = 255 - overlay_mask
+    margin = ksize // 2
+    top = max(min(sprite.top for sprite in sprites) - margin, 0)
+    left = max(min(sprite.left for sprite in sprites) - margin, 0)
+    bottom = min(max(sprite.top + sprite.alpha.shape[0]
+                     for sprite in sprites) + margin, shape[0])
+    right = min(max(sprite.left + sprite.alpha.shape[1]
+                    for sprite in sprites) + margin, shape[1])
 
-    # Turn the masks into three channel, so we can use them as weights
-    overlay_mask = cv2.cvtColor(overlay_mask, cv2.COLOR_GRAY2BGR)
-    background_mask = cv2.cvtColor(background_mask, cv2.COLOR_GRAY2BGR)
+    layer = np.zeros((bottom - top, right - left), np.uint8)
 
-    # Create a masked out face image, and masked out overlay
-    # We convert the images to floating point in range 0.0 - 1.0
-    face_part = (face_img * (1 / 255.0)) * (background_mask * (1 / 255.0))
-    overlay_part = (overlay_img * (1 / 255.0)) * (overlay_mask * (1 / 255.0))
+    for sprite in sprites:
+        region = layer[sprite.top - top:sprite.top - top + sprite.alpha.shape[0],
+                       sprite.left - left:sprite.left - left + sprite.alpha.shape[1]]
+        np.maximum(region, sprite.alpha[0:region.shape[0], 0:region.shape[1]],
+                   out=region)
 
-    # And finally just add them together, and rescale it back to an 8bit integer image
-    return np.uint8(cv2.addWeighted(face_part, 255.0, overlay_part, 255.0, 0.0))
+    # The sigma cv2.GaussianBlur derives from the kernel size
+    sigma = 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+    layer = _blur_layer(layer, sigma, mode, downscale)
 
+    return [sprite._replace(alpha=layer[
+                sprite.top - top:sprite.top - top + sprite.alpha.shape[0],
+                sprite.left - left:sprite.left - left + sprite.alpha.shape[1]])
+            for sprite in sprites]
@@ -0,0 +1,152 @@
+"""
+Write generated documents straight into LMDB environments
+
+Instead of writing thousands of PNG files for crop_documents.py to read back,
+generate_images.py --output_format lmdb packs every document into the LMDB
+environment of its shard. Pool workers encode pages and send the bytes to the
+main process, which is the only writer of the environment and commits them in
+batched transactions.
+
+Each document is stored under three keys, which sort by global document
+index:
+
+    <index>:image          the encoded page
+    <index>:ground_truth   the encoded ground truth
+    <index>:meta           the document's manifest record, as JSON
+
+where <index> is zero padded to ten digits. Manifest records are only
+appended once the transaction holding their document is committed, so
+generate_images.py --resume works as it does for files.
+
+The lmdb package is only needed, and only imported, when this output format
+is used.
+"""
+import configparser
+import json
+import os
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+BATCH_SIZE = CONFIG.getint('LMDB', 'batch_size', fallback=64)
+MAP_SIZE_GB = CONFIG.getint('LMDB', 'map_size_gb', fallback=256)
+
+
+def _import_lmdb():
+    try:
+        import lmdb
+    except ImportError:
+        raise RuntimeError("The lmdb output format needs the lmdb package "
+                           "(pip install lmdb)")
+
+    return lmdb
+
+
+def shard_environment_name(shard_index, shard_count):
+    """ The directory name of the LMDB environment of a shard. """
+
+    return "lmdb_shard_{:05d}_of_{:05d}".format(shard_index, shard_count)
+
+
+def document_key(index, kind):
+    """ The key of one part ('image', 'ground_truth', 'meta') of a document. """
+
+    return "{:010d}:{}".format(index, kind).encode("ascii")
+
+
+class LmdbShardWriter:
+    """
+    The single writer of a shard's LMDB environment
+
+    Parameters
+    ----------
+    path : str
+        The environment directory, created if needed
+    manifest_writer : manifest.ManifestWriter, optional
+        Receives the record of every document once it is committed
+    batch_size : int, optional
+        The number of documents per write transaction
+    map_size_gb : int, optional
+        The maximum size of the environment
+    """
+
+    def __init__(self, path, manifest_writer=None, batch_size=BATCH_SIZE,
+                 map_size_gb=MAP_SIZE_GB):
+        lmdb = _import_lmdb()
+
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.manifest_writer = manifest_writer
+        self.batch_size = max(1, batch_size)
+        self.env = lmdb.open(path, map_size=map_size_gb * 1024 ** 3,
+                             subdir=True, readonly=False)
+        self.txn = None
+        self.pending = []
+
+    def put(self, record, image_data, ground_truth_data):
+        """
+        Add a document to the current transaction
+
+        Parameters
+        ----------
+        record : dict
+            The document's manifest record. Must hold its global 'index'
+        image_data, ground_truth_data : bytes
+            The encoded page and ground truth
+        """
+
+        if self.txn is None:
+            self.txn = self.env.begin(write=True)
+
+        index = record['index']
+        self.txn.put(document_key(index, "image"), image_data)
+        self.txn.put(document_key(index, "ground_truth"), ground_truth_data)
+        self.txn.put(document_key(index, "meta"),
+                     json.dumps(record, sort_keys=True).encode("utf-8"))
+
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        """ Commit the current transaction and record its documents. """
+
+        if self.txn is None:
+            return
+
+        self.txn.commit()
+        self.txn = None
+
+        if self.manifest_writer is not None:
+            for record in self.pending:
+                self.manifest_writer.append(record)
+        self.pending = []
+
+    def close(self):
+        """ Commit what is left and close the environment. """
+
+        self.commit()
+        self.env.sync()
+        self.env.close()
+
+
+def read_document(env, index):
+    """
+    Read a document back from an open environment
+
+    Returns
+    -------
+    (bytes, bytes, dict) or None
+        The encoded page, the encoded ground truth and the manifest record,
+        or None if the environment does not hold the document
+    """
+
+    with env.begin() as txn:
+        meta = txn.get(document_key(index, "meta"))
+        if meta is None:
+            return None
+
+        return (txn.get(document_key(index, "image")),
+                txn.get(document_key(index, "ground_truth")),
+                json.loads(meta.decode("utf-8")))
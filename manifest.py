@@ -0,0 +1,243 @@
+"""
+Dataset manifests
+
+Every run of generate_images.py records the documents it generated in a JSON
+lines manifest in its output directory, one record per document:
+
+    {"index": 12, "name": "42_0000012", "run_seed": 42, "shard": 0,
+     "image": "img_42_0000012.png", "ground_truth": "img_42_0000012_gt.png",
+     "params": {"engine": "native", "stain_level": 1, "noise_level": 1},
+     "seconds": {"create": 1.84, "save": 0.21}}
+
+`index` is the document's position in the global document index space of the
+run, which is what shards partition. Image paths are relative to the
+manifest's directory. Documents packed into an LMDB environment (see
+lmdb_output) name the environment in `lmdb` instead of image files, and those
+packed into tar shards (see tar_shards) name their shard in `tar`.
+
+A record is appended once both of its files are saved, or handed over to an
+output_writer that writes them atomically, and each record is written with a
+single append. After a crash, the documents that are complete are therefore
+the records whose files exist, save for possibly one torn last line, which
+readers ignore. That is what lets generate_images.py --resume pick up an
+interrupted run.
+
+The settings a shard was started with (document count, degradation levels,
+codecs, ...) are saved beside its manifest, in run_shard_*.json, so that
+--resume can restore them rather than mix settings within one dataset.
+
+Shard manifests are combined into a single dataset index with merge(), which
+rewrites paths but never copies image data.
+"""
+import json
+import os
+
+# Record fields holding paths relative to the manifest's directory. Records of
+# patch runs hold them in each entry of their 'patches' list instead
+PATH_KEYS = ('image', 'ground_truth', 'lmdb', 'tar')
+
+
+def _path_fields(record):
+    """ The (dict, key) of every path of a record, its patches included. """
+
+    for fields in [record] + record.get('patches', []):
+        for key in PATH_KEYS:
+            if fields.get(key) is not None:
+                yield fields, key
+
+
+def shard_manifest_name(shard_index, shard_count):
+    """ The file name of the manifest of a shard. """
+
+    return "manifest_shard_{:05d}_of_{:05d}.jsonl".format(shard_index,
+                                                          shard_count)
+
+
+def shard_indices(total, shard_index, shard_count):
+    """
+    The global document indices belonging to a shard
+
+    Documents are dealt round-robin, so shard k of n generates the documents
+    k, k + n, k + 2n, ... below `total`. Every index belongs to exactly one
+    shard, whatever the number of shards.
+    """
+
+    return range(shard_index, total, shard_count)
+
+
+def run_settings_name(shard_index, shard_count):
+    """ The file name of the run settings of a shard. """
+
+    return "run_shard_{:05d}_of_{:05d}.json".format(shard_index, shard_count)
+
+
+def write_run_settings(path, settings):
+    """ Atomically save the settings of a run, a JSON-serializable dict. """
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as settings_file:
+        json.dump(settings, settings_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def read_run_settings(path):
+    """ The settings saved by write_run_settings, or None if there are none. """
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as settings_file:
+        return json.load(settings_file)
+
+
+class ManifestWriter:
+    """
+    Appends document records to a manifest
+
+    Only one ManifestWriter should write to a given manifest at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+        # Start on a fresh line if an earlier writer died mid-record
+        size = os.fstat(self.fd).st_size
+        if size > 0:
+            with open(path, 'rb') as manifest_file:
+                manifest_file.seek(size - 1)
+                if manifest_file.read(1) != b"\n":
+                    os.write(self.fd, b"\n")
+
+    def append(self, record):
+        """ Append a single document record, in one write. """
+
+        line = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+
+        written = os.write(self.fd, line)
+        if written != len(line):
+            raise OSError("Short write to manifest {}".format(self.path))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_manifest(path):
+    """
+    Read every record of a manifest
+
+    Blank lines are skipped, and so are records torn by a crash mid-write.
+    """
+
+    records = []
+
+    with open(path) as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return records
+
+
+def completed_records(path):
+    """
+    The records of a manifest whose files are all still on disk
+
+    Parameters
+    ----------
+    path : str
+        The manifest. A missing manifest has no completed records
+
+    Returns
+    -------
+    dict
+        Records keyed by global document index
+    """
+
+    if not os.path.isfile(path):
+        return {}
+
+    directory = os.path.dirname(os.path.abspath(path))
+    records = {}
+
+    for record in read_manifest(path):
+        if all(os.path.exists(os.path.join(directory, fields[key]))
+               for fields, key in _path_fields(record)):
+            records[record['index']] = record
+
+    return records
+
+
+def find_manifests(directory):
+    """ The shard manifests found in `directory`, sorted by name. """
+
+    return sorted(os.path.join(directory, name)
+                  for name in os.listdir(directory)
+                  if name.startswith("manifest_shard_")
+                  and name.endswith(".jsonl"))
+
+
+def merge(manifests, output):
+    """
+    Combine shard manifests into a single dataset index
+
+    Parameters
+    ----------
+    manifests : list of str
+        The shard manifests to merge
+    output : str
+        The path of the merged manifest
+
+    Returns
+    -------
+    list of dict
+        The merged records, sorted by global index
+
+    Image paths are rewritten relative to the merged manifest's directory, so
+    the data itself stays where the shards wrote it. Raises ValueError if two
+    shards generated the same document index, or if they belong to different
+    runs.
+    """
+
+    output_dir = os.path.dirname(os.path.abspath(output))
+    records = {}
+    sources = {}
+    run_seeds = set()
+
+    for path in manifests:
+        shard_dir = os.path.dirname(os.path.abspath(path))
+
+        for record in read_manifest(path):
+            # A resumed shard may list a regenerated document twice; its last
+            # record is the current one.
+            if sources.get(record['index'], path) != path:
+                raise ValueError("Document {} appears in more than one shard "
+                                 "({})".format(record['index'], path))
+
+            for fields, key in _path_fields(record):
+                fields[key] = os.path.relpath(
+                    os.path.join(shard_dir, fields[key]), output_dir)
+
+            run_seeds.add(record['run_seed'])
+            records[record['index']] = record
+            sources[record['index']] = path
+
+    if len(run_seeds) > 1:
+        raise ValueError("Manifests come from different runs: {}".format(
+            sorted(run_seeds)))
+
+    merged = [records[index] for index in sorted(records)]
+
+    tmp_output = "{}.{}.tmp".format(output, os.getpid())
+    with open(tmp_output, 'w') as output_file:
+        for record in merged:
+            output_file.write(json.dumps(record, sort_keys=True) + "\n")
+    os.replace(tmp_output, output)
+
+    return merged
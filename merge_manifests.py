@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Merge the manifests of a sharded generate_images.py run
+
+Each shard of a run writes its own manifest next to its images. This script
+combines them into a single dataset index, sorted by global document index,
+without copying any image data:
+
+    ./merge_manifests.py --output dataset.jsonl node1/run_42 node2/run_42
+
+Arguments may be shard manifests or directories containing them.
+"""
+import argparse
+import os
+import sys
+
+import manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge shard manifests into one dataset index.')
+    parser.add_argument('sources', metavar='PATH', nargs='+',
+                        help='shard manifests, or directories holding them')
+    parser.add_argument('--output', metavar='FILE', required=True,
+                        help='path of the merged manifest')
+    parser.add_argument('--expected', type=int, default=None,
+                        help='total number of documents in the run; report '
+                             'any missing index')
+
+    args = parser.parse_args()
+
+    manifests = []
+    for source in args.sources:
+        if os.path.isdir(source):
+            manifests += manifest.find_manifests(source)
+        else:
+            manifests.append(source)
+
+    if not manifests:
+        sys.exit("No shard manifests found")
+
+    try:
+        records = manifest.merge(manifests, args.output)
+    except ValueError as exception:
+        sys.exit(str(exception))
+
+    print("Merged {} documents from {} manifests into {}".format(
+        len(records), len(manifests), args.output))
+
+    if args.expected is not None:
+        missing = sorted(set(range(args.expected))
+                         - set(record['index'] for record in records))
+        if missing:
+            print("{} documents missing, e.g. {}".format(len(missing),
+                                                         missing[0:10]))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the word_transform and image_util kernels
+
+Every kernel runs on procedurally drawn words (see benchmark.draw_word), or
+pages for the compositing kernels, of realistic sizes. For each kernel and
+size the benchmark reports the median time per call, the throughput in
+megapixels per second of input, and the peak memory NumPy allocates during a
+call (measured with tracemalloc in a separate, untimed run):
+
+    ./microbenchmark.py --output kernels.json
+
+Random kernels are seeded identically before every call, so their outputs are
+deterministic. That makes output equivalence checkable: save the outputs of
+the current kernels once, then check a reimplementation against them,
+within each kernel's tolerance:
+
+    ./microbenchmark.py --save_reference reference/
+    ./microbenchmark.py --check_reference reference/
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import image_util as util
+import word_transform
+
+from benchmark import draw_word
+from text_writer_state import TextWriterState
+
+# Word sizes (height, width), from a short word to a long one
+WORD_SIZES = [(60, 150), (110, 400)]
+
+# Page sizes (height, width) for the compositing kernels
+PAGE_SIZES = [(2200, 1700)]
+
+# Largest absolute difference to the reference allowed per kernel
+TOLERANCES = {'alpha_composite': 1}
+
+
+def word_fixture(size, seed):
+    return draw_word(np.random.default_rng(seed), *size)
+
+
+def bgra_word(size, seed):
+    """ A word as util.add_alpha_channel returns it, ready for white_to_alpha """
+
+    word = word_fixture(size, seed)
+    return np.dstack([word, word, word, np.full_like(word, 255)])
+
+
+def page_fixture(size, seed):
+    """ A page and a page-sized BGRA text layer with scattered words. """
+
+    rng = np.random.default_rng(seed)
+    height, width = size
+
+    page = rng.integers(180, 240, (height, width, 3)).astype(np.uint8)
+    overlay = np.zeros((height, width, 4), np.uint8)
+
+    for _ in range(height * width // 20000):
+        word = draw_word(rng)
+        y = int(rng.integers(0, height - word.shape[0]))
+        x = int(rng.integers(0, width - word.shape[1]))
+        overlay[y:y + word.shape[0], x:x + word.shape[1]] = \
+            util.alpha_to_bgra(255 - word, color=(53, 52, 46))
+
+    return page, overlay
+
+
+def fade_fixture(size, seed):
+    """ A page and the bleed-through sprites Document._add_text_fade lays out. """
+
+    rng = np.random.default_rng(seed)
+    page = rng.integers(180, 240, size + (3,)).astype(np.uint8)
+    state = TextWriterState(page.shape)
+
+    while True:
+        word = cv2.copyMakeBorder(255 - draw_word(rng), 25, 25, 25, 25,
+                                  cv2.BORDER_CONSTANT, value=0)
+        if state.get_next_word_pos(word.shape) is None:
+            break
+        state.add_sprite(util.boost_alpha(word), (53, 52, 46))
+
+    return page, state.sprites
+
+
+def fade_per_word(page, sprites):
+    """ Bleed-through text blurred one word at a time, as it used to be. """
+
+    sprites = [sprite._replace(alpha=cv2.GaussianBlur(sprite.alpha, (51, 51), 0))
+               for sprite in sprites]
+    return util.composite_sprites(page, sprites, out=page)
+
+
+def fade_blur(mode):
+    def kernel(page, sprites):
+        sprites = util.blur_sprites(sprites, page.shape, 51, mode)
+        return util.composite_sprites(page, sprites, out=page)
+
+    return kernel
+
+
+def white_to_alpha(img):
+    util.white_to_alpha(img, color=(53, 52, 46))
+    return img
+
+
+# name: (sizes, fixture(size, seed) -> args, kernel(*args) -> output)
+KERNELS = {
+    'apply_blur_edges': (
+        WORD_SIZES, lambda size, seed: (word_fixture(size, seed),),
+        lambda im: word_transform.apply_blur_edges(im, 5, 1.0)),
+    'apply_elastic_deformation': (
+        WORD_SIZES, lambda size, seed: (word_fixture(size, seed),),
+        lambda im: word_transform.apply_elastic_deformation(im, 5, 3)),
+    'apply_foreground_noise': (
+        WORD_SIZES, lambda size, seed: (word_fixture(size, seed),),
+        word_transform.apply_foreground_noise),
+    'apply_shear': (
+        WORD_SIZES, lambda size, seed: (word_fixture(size, seed),),
+        lambda im: word_transform.apply_shear(im, 10, True, 5)),
+    'apply_rotation': (
+        WORD_SIZES, lambda size, seed: (word_fixture(size, seed),),
+        lambda im: word_transform.apply_rotation(im, 5, 5)),
+    'apply_perspective': (
+        WORD_SIZES, lambda size, seed: (word_fixture(size, seed),),
+        word_transform.apply_perspective),
+    'white_to_alpha': (
+        WORD_SIZES, lambda size, seed: (bgra_word(size, seed),),
+        white_to_alpha),
+    'alpha_composite': (
+        PAGE_SIZES, page_fixture, util.alpha_composite),
+    'fade_per_word': (
+        PAGE_SIZES, fade_fixture, fade_per_word),
+}
+KERNELS.update({'fade_' + mode: (PAGE_SIZES, fade_fixture, fade_blur(mode))
+                for mode in util.BLUR_MODES})
+
+
+def seed_all(seed):
+    """ Seed the global generators the kernels draw from. """
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def copy_args(args):
+    """ Fresh copies of the arguments, since some kernels work in place. """
+
+    return tuple(arg.copy() if isinstance(arg, np.ndarray) else arg
+                 for arg in args)
+
+
+def time_kernel(kernel, args, repeats, seed):
+    """ The median seconds per call, over `repeats` calls. """
+
+    times = []
+
+    for _ in range(repeats):
+        call_args = copy_args(args)
+        seed_all(seed)
+
+        start = time.perf_counter()
+        kernel(*call_args)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def allocated_bytes(kernel, args, seed):
+    """ The peak of the memory NumPy allocates during one call. """
+
+    call_args = copy_args(args)
+    seed_all(seed)
+
+    tracemalloc.start()
+    try:
+        kernel(*call_args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+
+def reference_file(directory, name, size):
+    return os.path.join(directory, "{}_{}x{}.npy".format(name, *size))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the word transform and compositing kernels.')
+    parser.add_argument('--kernels', nargs='+', choices=sorted(KERNELS),
+                        default=sorted(KERNELS))
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='timed calls per kernel and size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='FILE', default=None,
+                        help='write the results as JSON')
+    parser.add_argument('--save_reference', metavar='DIR', default=None,
+                        help='save every kernel output to DIR')
+    parser.add_argument('--check_reference', metavar='DIR', default=None,
+                        help='check every kernel output against DIR')
+
+    args = parser.parse_args()
+
+    results = []
+    mismatches = 0
+
+    if args.save_reference is not None:
+        os.makedirs(args.save_reference, exist_ok=True)
+
+    for name in args.kernels:
+        sizes, fixture, kernel = KERNELS[name]
+
+        for size in sizes:
+            kernel_args = fixture(size, args.seed)
+            pixels = size[0] * size[1]
+
+            seconds = time_kernel(kernel, kernel_args, args.repeats, args.seed)
+            allocated = allocated_bytes(kernel, kernel_args, args.seed)
+
+            result = {
+                'kernel': name,
+                'height': size[0],
+                'width': size[1],
+                'seconds': seconds,
+                'mpix_per_sec': pixels / seconds / 1e6,
+                'allocated_mb': allocated / 1024 ** 2,
+            }
+
+            seed_all(args.seed)
+            output = np.asarray(kernel(*copy_args(kernel_args)))
+
+            if args.save_reference is not None:
+                np.save(reference_file(args.save_reference, name, size),
+                        output)
+
+            if args.check_reference is not None:
+                reference = np.load(reference_file(args.check_reference,
+                                                   name, size))
+                tolerance = TOLERANCES.get(name, 0)
+
+                if reference.shape != output.shape:
+                    result['equivalent'] = False
+                else:
+                    difference = np.abs(reference.astype(np.int64)
+                                        - output.astype(np.int64))
+                    result['max_difference'] = int(difference.max())
+                    result['equivalent'] = bool(difference.max() <= tolerance)
+
+                mismatches += not result['equivalent']
+
+            results.append(result)
+
+            print("{:<26} {:>4}x{:<4} {:9.3f} ms {:9.2f} Mpix/s {:8.2f} MB{}"
+                  .format(name, size[1], size[0], seconds * 1000,
+                          result['mpix_per_sec'], result['allocated_mb'],
+                          "" if 'equivalent' not in result else
+                          "  ok" if result['equivalent'] else "  MISMATCH"))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if mismatches:
+        print("{} outputs differ from the reference".format(mismatches))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
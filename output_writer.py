@@ -0,0 +1,354 @@
+"""
+Encode and write finished documents in background threads
+
+Document.save used to encode each page with the default PNG settings and copy
+it out of TMP_DIR before the worker could start on its next page. With an
+AsyncWriter, a worker hands the array (or the temporary file) over to a small
+thread pool and moves on: OpenCV and file I/O release the GIL, so encoding
+overlaps with the compositing of the next page. The number of writes in
+flight is bounded, so a slow disk applies backpressure instead of letting
+pages pile up in memory.
+
+Files are written to a temporary name and renamed into place, so a file that
+exists is always complete.
+
+Codecs
+------
+png
+    PNG with an explicit zlib compression level (0-9)
+webp
+    Lossless WebP, usually smaller than PNG but slower to encode
+npy
+    The raw NumPy array, the fastest to write and to read back
+
+The ground truth, a 0/1 mask, may also be stored in a compact mask codec:
+
+png1
+    A 1-bit PNG
+npybits
+    The mask's rows packed eight pixels to the byte with np.packbits, in a
+    .bits.npz archive holding the packed `bits` and the mask's `width`, which
+    decode uses to drop the padding of the rows to whole bytes
+"""
+import atexit
+import configparser
+import concurrent.futures
+import io
+import multiprocessing.util
+import os
+import re
+import shutil
+import sys
+import threading
+
+import cv2
+import numpy as np
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+CODECS = ("png", "webp", "npy")
+MASK_CODECS = ("png1", "npybits")
+
+# The file extension of every codec, where it is not "." + codec
+EXTENSIONS = {"png1": ".png", "npybits": ".bits.npz"}
+
+IMAGE_CODEC = CONFIG.get('OUTPUT', 'image_codec', fallback="png")
+GROUND_TRUTH_CODEC = CONFIG.get('OUTPUT', 'ground_truth_codec', fallback="png")
+PNG_LEVEL = CONFIG.getint('OUTPUT', 'png_level', fallback=3)
+WRITER_THREADS = CONFIG.getint('OUTPUT', 'writer_threads', fallback=2)
+WRITER_QUEUE = CONFIG.getint('OUTPUT', 'writer_queue', fallback=8)
+
+_writers = {}
+
+
+def check_codec(codec):
+    """ Raise ValueError if `codec` is not a supported codec. """
+
+    if codec not in CODECS + MASK_CODECS:
+        raise ValueError("Unknown codec {}, expected one of {}".format(
+            codec, ", ".join(CODECS + MASK_CODECS)))
+
+
+def extension(codec):
+    """ The file extension, with its dot, of a codec. """
+
+    check_codec(codec)
+
+    return EXTENSIONS.get(codec, "." + codec)
+
+
+def encode(img, codec, png_level=PNG_LEVEL):
+    """
+    Encode an image
+
+    Parameters
+    ----------
+    img : np.ndarray
+        The image to encode. A 2-D 0/1 mask for MASK_CODECS
+    codec : str
+        One of CODECS or MASK_CODECS
+    png_level : int, optional
+        The zlib compression level of the png codec
+
+    Returns
+    -------
+    bytes
+        The encoded file contents
+    """
+
+    check_codec(codec)
+
+    if codec == "npybits":
+        buffer = io.BytesIO()
+        np.savez(buffer, bits=np.packbits(img, axis=-1), width=img.shape[-1])
+        return buffer.getvalue()
+
+    if codec == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(img))
+        return buffer.getvalue()
+
+    if codec == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_level]
+    elif codec == "png1":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_level,
+                  cv2.IMWRITE_PNG_BILEVEL, 1]
+        codec = "png"
+    else:
+        # A quality above 100 selects lossless WebP
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+
+    success, data = cv2.imencode("." + codec, img, params)
+    if not success:
+        raise OSError("Could not encode image as {}".format(codec))
+
+    return data.tobytes()
+
+
+def decode(data, codec):
+    """
+    Decode an image encoded by encode
+
+    Parameters
+    ----------
+    data : bytes
+        The encoded file contents
+    codec : str
+        The codec `data` was encoded with
+
+    Returns
+    -------
+    np.ndarray
+        The image; masks come back as 0/1 arrays, whatever their codec
+    """
+
+    check_codec(codec)
+
+    if codec == "npybits":
+        with np.load(io.BytesIO(data)) as archive:
+            return np.unpackbits(archive['bits'], axis=-1,
+                                 count=int(archive['width']))
+
+    if codec == "npy":
+        return np.load(io.BytesIO(data))
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise OSError("Could not decode image as {}".format(codec))
+
+    if codec == "png1":
+        img = np.minimum(img, 1)
+
+    return img
+
+
+def write_file(file, data):
+    """ Atomically write `data` to `file`. """
+
+    tmp_file = "{}.{}.{}.tmp".format(file, os.getpid(), threading.get_ident())
+
+    with open(tmp_file, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(tmp_file, file)
+
+
+def remove_partial_files(directory, run_seed):
+    """
+    Remove the temporary files of a run's interrupted writes in `directory`
+
+    write_file and move_file write to <file>.<pid>.<thread>.tmp before
+    renaming into place; a killed run leaves those behind. Returns the number
+    of files removed.
+    """
+
+    pattern = re.compile(r"(^|_){}_\d{{7,}}.*\.\d+\.\d+\.tmp$".format(
+        run_seed))
+    removed = 0
+
+    if not os.path.isdir(directory):
+        return 0
+
+    for name in os.listdir(directory):
+        if not pattern.search(name):
+            continue
+
+        try:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+
+    return removed
+
+
+def write_image(file, img, codec, png_level=PNG_LEVEL):
+    """ Encode `img` and atomically write it to `file`. """
+
+    write_file(file, encode(img, codec, png_level))
+
+
+def move_file(source, file, codec, png_level=PNG_LEVEL):
+    """
+    Move an image file written in TMP_DIR to its final location
+
+    PNG files are moved as they are. Other codecs decode the file and encode
+    it again.
+    """
+
+    if codec == "png" and source.lower().endswith(".png"):
+        tmp_file = "{}.{}.{}.tmp".format(file, os.getpid(),
+                                         threading.get_ident())
+        shutil.move(source, tmp_file)
+        os.replace(tmp_file, file)
+        return
+
+    img = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise OSError("Could not read {}".format(source))
+
+    write_image(file, img, codec, png_level)
+    os.remove(source)
+
+
+class AsyncWriter:
+    """
+    A bounded pool of threads running writes
+
+    Parameters
+    ----------
+    threads : int
+        The number of writer threads. 0 runs every write synchronously, in the
+        calling thread
+    queue_size : int
+        The maximum number of writes queued or in progress. submit() blocks
+        while the queue is full
+    """
+
+    def __init__(self, threads=WRITER_THREADS, queue_size=WRITER_QUEUE):
+        self.threads = threads
+        self.executor = None
+        self.slots = None
+        self.errors = []
+
+        if threads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                threads, thread_name_prefix="writer")
+            self.slots = threading.BoundedSemaphore(max(1, queue_size))
+
+    def submit(self, function, *args):
+        """
+        Run `function(*args)` on a writer thread
+
+        Returns
+        -------
+        concurrent.futures.Future or None
+            The future of the write, or None when it ran synchronously
+
+        Errors are printed to stderr when the write fails and kept in
+        `errors`; they do not propagate to the caller, who can check the
+        future (see when_done).
+        """
+
+        if self.executor is None:
+            function(*args)
+            return None
+
+        self.slots.acquire()
+
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        self.slots.release()
+
+        exception = future.exception()
+        if exception is not None:
+            self.errors.append(exception)
+            print("Write failed: {}".format(exception), file=sys.stderr)
+
+    def close(self):
+        """ Wait for every pending write, then stop the threads. """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def when_done(futures, callback):
+    """
+    Call `callback(results, errors)` once every future of `futures` finished
+
+    `results` lists the return values of the futures that succeeded and
+    `errors` the exceptions of those that failed. The callback runs on the
+    writer thread that finished last, or right away if they all have.
+    """
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+
+        errors = [future.exception() for future in futures]
+        callback([future.result() for future, error in zip(futures, errors)
+                  if error is None],
+                 [error for error in errors if error is not None])
+
+    if not futures:
+        callback([], [])
+
+    for future in futures:
+        future.add_done_callback(finished)
+
+
+def get_writer(threads=WRITER_THREADS, queue_size=WRITER_QUEUE):
+    """
+    The AsyncWriter of the current process
+
+    The writer is created on first use, and closed when the process exits,
+    including pool workers, which do not run atexit handlers.
+    """
+
+    pid = os.getpid()
+
+    if pid not in _writers:
+        writer = AsyncWriter(threads, queue_size)
+        _writers[pid] = writer
+
+        atexit.register(writer.close)
+        # Ahead of the multiprocessing queues (priority 10), which pending
+        # writes may still report to
+        multiprocessing.util.Finalize(writer, writer.close, exitpriority=20)
+
+    return _writers[pid]
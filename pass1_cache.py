@@ -0,0 +1,169 @@
+"""
+A cache of pre-degraded backgrounds
+
+The first degradation pass of Document.create only depends on the background
+and the stain parameters, never on the text, yet it used to run for every
+page. This module keeps a pool of up to `variants` degraded versions of every
+background, filled lazily as documents are created or ahead of time with
+warm().
+
+`reuse_factor` trades diversity for throughput: a document generates (and
+caches) a fresh variant with probability 1 / reuse_factor and otherwise reuses
+one of the cached variants of its background, so on average each variant is
+used reuse_factor times. A reuse factor of 1 disables the cache.
+
+Variants are stored as .npy files and read back as read-only memory maps.
+"""
+import configparser
+import hashlib
+import os
+import random
+
+import numpy as np
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+TMP_DIR = CONFIG['DIRECTORIES']['tmp_dir']
+
+PASS1_CACHE_DIR = CONFIG.get('PASS1_CACHE', 'cache_dir', fallback=TMP_DIR)
+VARIANTS = CONFIG.getint('PASS1_CACHE', 'variants', fallback=8)
+REUSE_FACTOR = CONFIG.getfloat('PASS1_CACHE', 'reuse_factor', fallback=1)
+
+
+def enabled(engine, variants=VARIANTS, reuse_factor=REUSE_FACTOR):
+    """ Whether variants are cached at all for this configuration. """
+
+    return engine != "none" and reuse_factor > 1 and variants >= 1
+
+
+def variant_folder(backgrounds, cache_dir=PASS1_CACHE_DIR):
+    """ The folder holding the degraded variants of a BackgroundIndex. """
+
+    root = hashlib.sha1(os.path.abspath(backgrounds.root).encode("utf-8"))
+
+    return os.path.join(cache_dir, "pass1_{}_{}".format(
+        root.hexdigest()[0:16], backgrounds.signature[0:12]))
+
+
+def variant_prefix(page, engine, stain_level, noise_level, grayscale=False,
+                   height=None):
+    """ The file name prefix shared by all variants of one configuration. """
+
+    return "{}{}{}_s{}_n{}_p{}_".format(
+        engine, "_gray" if grayscale else "",
+        "" if height is None else "_h{}".format(height),
+        stain_level, noise_level, page)
+
+
+def _store(folder, prefix, slot, img):
+    os.makedirs(folder, exist_ok=True)
+
+    file = os.path.join(folder, "{}{}.npy".format(prefix, slot))
+    tmp_file = "{}.{}.tmp".format(file, os.getpid())
+
+    with open(tmp_file, 'wb') as variant_file:
+        np.save(variant_file, img)
+    os.replace(tmp_file, file)
+
+
+def get_variant(backgrounds, page, engine, stain_level, noise_level, degrade,
+                variants=VARIANTS, reuse_factor=REUSE_FACTOR,
+                cache_dir=PASS1_CACHE_DIR, rng=random, grayscale=False,
+                height=None):
+    """
+    Get a pass-1 degraded version of a background page
+
+    Parameters
+    ----------
+    backgrounds : background_pool.BackgroundIndex
+        The index the page belongs to
+    page : int
+        The position of the page in the index
+    engine : str
+        The degradation engine, part of the cache key
+    stain_level, noise_level : int
+        The degradation levels, part of the cache key
+    degrade : callable
+        Called without arguments to produce a fresh degraded variant. May
+        return None if the page cannot be degraded
+    variants : int, optional
+        The maximum number of variants kept per page and configuration
+    reuse_factor : float, optional
+        The average number of documents sharing a variant
+    cache_dir : str, optional
+        Where variants are kept
+    rng : random.Random, optional
+        The random number generator to draw from
+    grayscale : bool, optional
+        Whether `degrade` produces single-channel pages, part of the cache
+        key
+    height : int, optional
+        The height `degrade` scales pages to, if any, part of the cache key
+
+    Returns
+    -------
+    np.ndarray or None
+        The degraded page. Cached variants are read-only memory maps
+    """
+
+    if not enabled(engine, variants, reuse_factor):
+        return degrade()
+
+    folder = variant_folder(backgrounds, cache_dir)
+    prefix = variant_prefix(page, engine, stain_level, noise_level,
+                            grayscale, height)
+
+    try:
+        cached = sorted(int(name[len(prefix):-len(".npy")])
+                        for name in os.listdir(folder)
+                        if name.startswith(prefix) and name.endswith(".npy"))
+    except FileNotFoundError:
+        cached = []
+
+    if cached and rng.random() >= 1.0 / reuse_factor:
+        slot = rng.choice(cached)
+        try:
+            return np.load(os.path.join(folder, "{}{}.npy".format(prefix, slot)),
+                           mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            pass
+
+    img = degrade()
+    if img is None:
+        return None
+
+    free = sorted(set(range(variants)) - set(cached))
+    slot = free[0] if free else rng.randrange(variants)
+
+    _store(folder, prefix, slot, img)
+
+    return img
+
+
+def warm(backgrounds, page, engine, stain_level, noise_level, degrade,
+         variants=VARIANTS, cache_dir=PASS1_CACHE_DIR, grayscale=False,
+         height=None, reuse_factor=REUSE_FACTOR):
+    """
+    Fill every missing variant slot of a background page ahead of time
+
+    Takes the same arguments as get_variant. Nothing is stored when the
+    cache is disabled, since get_variant would never read it.
+    """
+
+    if not enabled(engine, variants, reuse_factor):
+        return
+
+    folder = variant_folder(backgrounds, cache_dir)
+    prefix = variant_prefix(page, engine, stain_level, noise_level,
+                            grayscale, height)
+
+    for slot in range(variants):
+        if os.path.isfile(os.path.join(folder, "{}{}.npy".format(prefix, slot))):
+            continue
+
+        img = degrade()
+        if img is None:
+            return
+
+        _store(folder, prefix, slot, img)
@@ -0,0 +1,141 @@
+"""
+Per-stage timing of document generation
+
+Every Document carries a StageTimer that records, for each stage of create()
+and save(), the wall time, the CPU time of the thread that ran it and the
+number of bytes it produced:
+
+    background_decode   reading a background page
+    pass1               the first degradation pass, or fetching a cached
+                        variant (includes background_decode)
+    words               loading word images
+    text_fade_blur      blurring the bleed-through text
+    composite           alpha compositing text onto the page
+    ground_truth        thresholding and storing the ground truth
+    pass2               the second degradation pass
+    save                encoding and writing the page and its ground truth,
+                        or only queueing them for an AsyncWriter
+    encode              encoding and writing on an AsyncWriter's threads
+
+The stage timings of many documents, possibly from many worker processes, are
+aggregated by a StageSummary in the process collecting them.
+"""
+import array
+import contextlib
+import time
+
+import numpy as np
+
+# The metrics recorded for every stage
+METRICS = ("wall", "cpu", "bytes")
+
+
+class StageTimer:
+    """ Accumulates the timings of the stages of one document. """
+
+    def __init__(self):
+        self.stages = {}
+
+    def _entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = {"wall": 0.0, "cpu": 0.0, "bytes": 0,
+                                 "calls": 0}
+
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as one call of stage `name`
+
+        Stages may nest, and a stage may be entered several times per
+        document; its times add up.
+        """
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+
+        try:
+            yield
+        finally:
+            entry = self._entry(name)
+            entry["wall"] += time.perf_counter() - wall
+            entry["cpu"] += time.thread_time() - cpu
+            entry["calls"] += 1
+
+    def add_bytes(self, name, count):
+        """ Count `count` bytes as produced by stage `name`. """
+
+        self._entry(name)["bytes"] += int(count)
+
+    def merge(self, other):
+        """ Add the timings of StageTimer `other` to this one. """
+
+        for name, entry in other.stages.items():
+            own = self._entry(name)
+            for key, value in entry.items():
+                own[key] += value
+
+    def as_dict(self):
+        """ The timings of every stage, rounded for reporting. """
+
+        return {name: {"wall": round(entry["wall"], 6),
+                       "cpu": round(entry["cpu"], 6),
+                       "bytes": entry["bytes"],
+                       "calls": entry["calls"]}
+                for name, entry in self.stages.items()}
+
+
+class StageSummary:
+    """
+    Aggregates the stage timings of many documents
+
+    Values are kept in compact arrays, so that millions of documents can be
+    summarized without holding on to their timing dictionaries.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.documents = 0
+
+    def add(self, stages):
+        """ Add the timings of a document, as returned by StageTimer.as_dict. """
+
+        self.documents += 1
+
+        for name, entry in stages.items():
+            if name not in self.values:
+                self.values[name] = {metric: array.array('d')
+                                     for metric in METRICS}
+
+            for metric in METRICS:
+                self.values[name][metric].append(entry[metric])
+
+    def summary(self):
+        """
+        The p50, p95, max and total of every metric of every stage
+
+        Returns
+        -------
+        dict
+            {"documents": n, "stages": {stage: {"documents": n_stage,
+            metric: {"p50": ..., "p95": ..., "max": ..., "total": ...}}}},
+            where n_stage is the number of documents that ran the stage
+        """
+
+        stages = {}
+
+        for name, metrics in sorted(self.values.items()):
+            stages[name] = {"documents": len(metrics["wall"])}
+
+            for metric, values in metrics.items():
+                values = np.frombuffer(values, dtype=np.float64)
+                p50, p95 = np.percentile(values, [50, 95])
+                stages[name][metric] = {
+                    "p50": round(float(p50), 6),
+                    "p95": round(float(p95), 6),
+                    "max": round(float(values.max()), 6),
+                    "total": round(float(values.sum()), 6),
+                }
+
+        return {"documents": self.documents, "stages": stages}
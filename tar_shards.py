@@ -0,0 +1,216 @@
+"""
+Pack output into rolling tar shards, WebDataset style
+
+Millions of small files in one directory are slow on shared filesystems and
+to stream from. A TarShardWriter instead appends samples to a tar file until
+it reaches a size or sample limit, then starts the next one:
+
+    <prefix>-000000.tar
+    <prefix>-000000.tar.idx.json
+    <prefix>-000001.tar
+    ...
+
+A sample is a group of members sharing a key, such as
+
+    img_42_0000012.png
+    img_42_0000012.gt.png
+    img_42_0000012.json
+
+which is the layout WebDataset loaders expect: everything up to the first dot
+is the key. Next to every shard, an index maps each member name to the offset
+and size of its data in the tar, so a single sample can be read with one seek
+(see read_member).
+
+Shards are written under a temporary name and renamed into place once
+complete, along with their index, so a shard that exists is always whole.
+"""
+import configparser
+import io
+import json
+import os
+import tarfile
+import time
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+SHARD_MB = CONFIG.getint('TAR', 'shard_mb', fallback=1024)
+SHARD_SAMPLES = CONFIG.getint('TAR', 'shard_samples', fallback=10000)
+
+
+def shard_name(prefix, number):
+    """ The file name of a shard. """
+
+    return "{}-{:06d}.tar".format(prefix, number)
+
+
+def index_name(shard):
+    """ The file name of the index of a shard. """
+
+    return shard + ".idx.json"
+
+
+def read_index(shard_path):
+    """ The member index of a shard: name -> (offset, size). """
+
+    with open(index_name(shard_path)) as index_file:
+        return {name: tuple(entry)
+                for name, entry in json.load(index_file).items()}
+
+
+def read_member(shard_path, name, index=None):
+    """
+    Read a single member of a shard without scanning the tar
+
+    Parameters
+    ----------
+    shard_path : str
+        The shard
+    name : str
+        The member to read
+    index : dict, optional
+        The shard's index, as returned by read_index. Read from disk if not
+        given
+
+    Returns
+    -------
+    bytes
+        The member's contents
+    """
+
+    if index is None:
+        index = read_index(shard_path)
+
+    offset, size = index[name]
+
+    with open(shard_path, 'rb') as shard_file:
+        shard_file.seek(offset)
+        return shard_file.read(size)
+
+
+class TarShardWriter:
+    """
+    Appends samples to rolling tar shards
+
+    Parameters
+    ----------
+    directory : str
+        Where shards are written
+    prefix : str
+        The name prefix of the shards. Writing again with the same prefix
+        continues after the last complete shard, and drops the incomplete
+        shards an interrupted writer left
+    max_mb : int, optional
+        A shard is closed once it reaches this size, in megabytes
+    max_samples : int, optional
+        A shard is closed once it holds this many samples (0 = no limit)
+    on_commit : callable, optional
+        Called as on_commit(shard, records) when a shard is complete, with
+        the shard's file name and the records passed to add()
+    """
+
+    def __init__(self, directory, prefix, max_mb=SHARD_MB,
+                 max_samples=SHARD_SAMPLES, on_commit=None):
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_samples = max_samples
+        self.on_commit = on_commit
+
+        self.number = 0
+        for name in os.listdir(directory):
+            if not name.startswith(prefix + "-"):
+                continue
+
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+            elif name.endswith(".tar"):
+                number = int(name[len(prefix) + 1:-len(".tar")])
+                self.number = max(self.number, number + 1)
+
+        self.tar = None
+        self.index = {}
+        self.records = []
+        self.samples = 0
+
+    def _open(self):
+        self.name = shard_name(self.prefix, self.number)
+        self.path = os.path.join(self.directory, self.name)
+        self.tmp_path = self.path + ".tmp"
+
+        self.tar = tarfile.open(self.tmp_path, 'w', format=tarfile.PAX_FORMAT)
+        self.index = {}
+        self.records = []
+        self.samples = 0
+
+    def add(self, key, members, record=None):
+        """
+        Append a sample
+
+        Parameters
+        ----------
+        key : str
+            The sample key. Must not contain a dot
+        members : list of (str, bytes)
+            The extension (without the leading dot) and contents of every
+            member of the sample
+        record : optional
+            Passed to on_commit once the sample's shard is complete
+        """
+
+        if "." in key:
+            raise ValueError("Sample key {} contains a dot".format(key))
+
+        if self.tar is None:
+            self._open()
+
+        now = time.time()
+
+        for extension, data in members:
+            info = tarfile.TarInfo("{}.{}".format(key, extension))
+            info.size = len(data)
+            info.mtime = now
+            self.tar.addfile(info, io.BytesIO(data))
+
+            # addfile leaves the tar at the end of the member's data, padded
+            # to whole blocks
+            blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+            padded = (blocks + (remainder > 0)) * tarfile.BLOCKSIZE
+            self.index[info.name] = (self.tar.offset - padded, info.size)
+
+        self.samples += 1
+        if record is not None:
+            self.records.append(record)
+
+        if self.tar.offset >= self.max_bytes or \
+                (self.max_samples > 0 and self.samples >= self.max_samples):
+            self.commit()
+
+    def commit(self):
+        """ Complete the current shard, if any, and start a new one. """
+
+        if self.tar is None:
+            return
+
+        self.tar.close()
+        self.tar = None
+
+        tmp_index = index_name(self.path) + ".tmp"
+        with open(tmp_index, 'w') as index_file:
+            json.dump(self.index, index_file, sort_keys=True)
+
+        os.replace(tmp_index, index_name(self.path))
+        os.replace(self.tmp_path, self.path)
+
+        if self.on_commit is not None:
+            self.on_commit(self.name, self.records)
+
+        self.number += 1
+        self.records = []
+
+    def close(self):
+        """ Complete the last shard. """
+
+        self.commit()
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import output_writer  # noqa: E402
+
+
+def test_mask_codecs_round_trip_odd_widths():
+    rng = np.random.default_rng(0)
+    mask = (rng.random((37, 850)) < 0.3).astype(np.uint8)
+
+    for codec in output_writer.MASK_CODECS:
+        decoded = output_writer.decode(output_writer.encode(mask, codec),
+                                       codec)
+
+        assert decoded.shape == mask.shape
+        assert np.array_equal(decoded, mask)
@@ -1,6 +1,11 @@
-import cv2
+import collections
+
 import numpy as np
 
+# A word placed on the page: its single-channel alpha mask, with its top left
+# corner at (top, left), drawn in `color`
+Sprite = collections.namedtuple("Sprite", ["top", "left", "alpha", "color"])
+
 class TextWriterState:
     def __init__(self, doc_shape):
         self.shape = np.array(doc_shape, dtype=np.int)
@@ -22,7 +27,7 @@ class TextWriterState:
 
         self.last_line_height = 0
 
-        self.padded_image = None
+        self.sprites = []
 
 
     def get_next_word_pos(self, word_shape):
@@ -62,28 +67,15 @@ class TextWriterState:
 
         return np.copy(self.offset)
 
-    def get_padded_image(self, word, word_shape=None):
-        if word_shape is None:
-            word_shape = word.shape[0:2]
-
-            if self.padded_image is None:
-                self.padded_image = cv2.copyMakeBorder(word,
-                                          self.offset[0],
-                                          self.shape[0] - self.offset[0] - word_shape[0],
-                                          self.offset[1],
-                                          self.shape[1] - self.offset[1] - word_shape[1],
-                                          cv2.BORDER_CONSTANT,
-                                          (0, 0, 0, 0))
-            else:
-                self.padded_image[self.offset[0]:self.offset[0] + word_shape[0],
-                                  self.offset[1]:self.offset[1] + word_shape[1]] = word
-
-            return self.padded_image
-        # else:
-            # return cv2.copyMakeBorder(word,
-                                      # self.offset[0] - word_shape[0],
-                                      # self.shape[0] - self.offset[0] - word_shape[0],
-                                      # self.offset[1] - word_shape[1],
-                                      # self.shape[1] - self.offset[1] - word_shape[1],
-                                      # cv2.BORDER_CONSTANT,
-                                      # (0, 0, 0, 0))
+    def add_sprite(self, alpha, color):
+        """
+        Place a word at the position returned by the last get_next_word_pos.
+
+        Only the word itself is kept, so nothing page-sized is allocated;
+        see image_util.composite_sprites.
+        """
+        sprite = Sprite(int(self.offset[0]), int(self.offset[1]), alpha,
+                        np.array(color).astype(np.uint8))
+        self.sprites.append(sprite)
+
+        return sprite
@@ -0,0 +1,253 @@
+"""
+A shared, preloaded atlas of word sprites
+
+Every Document places hundreds of words, and the same small word images get
+read and decoded from disk over and over again by every pool worker. The atlas
+decodes every word of a WordIndex once, as a single-channel alpha mask
+(255 - gray, since words are black on white), and packs them all into one
+contiguous memory-mapped file in TMP_DIR. Workers map that file read-only, so
+sprites are shared between processes and read without any copy.
+
+Corpora that do not fit in the configured memory budget are only partially
+packed. The remaining words are decoded from disk on demand, through a
+per-process LRU cache.
+
+Word images that cannot be decoded (the index only reads their header) have
+no alpha mask; Document skips them.
+"""
+import configparser
+import fcntl
+import functools
+import hashlib
+import os
+import sys
+
+import cv2
+import numpy as np
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+TMP_DIR = CONFIG['DIRECTORIES']['tmp_dir']
+
+ATLAS_ENABLED = CONFIG.getboolean('ATLAS', 'enabled', fallback=False)
+ATLAS_BUDGET_MB = CONFIG.getint('ATLAS', 'budget_mb', fallback=1024)
+LRU_SIZE = CONFIG.getint('ATLAS', 'lru_size', fallback=4096)
+
+_atlases = {}
+
+
+@functools.lru_cache(maxsize=LRU_SIZE)
+def read_alpha(path):
+    """
+    Decode a word image from disk as an alpha mask
+
+    Parameters
+    ----------
+    path : str
+        The path of a black on white word image
+
+    Returns
+    -------
+    np.ndarray or None
+        A read-only uint8 mask, 255 where the word is fully inked, or None if
+        the image cannot be decoded
+    """
+
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        print("Skipping unreadable word image {}".format(path),
+              file=sys.stderr)
+        return None
+
+    alpha = 255 - img
+    alpha.flags.writeable = False
+
+    return alpha
+
+
+class WordAtlas:
+    """
+    Word sprites of a WordIndex packed into a single buffer
+
+    The alpha mask of word `i` is stored row-major at
+    data[offsets[i]:offsets[i] + heights[i] * widths[i]]. Only the first
+    `packed` words of the index are in the buffer; later words are read from
+    disk. Words that could not be decoded have an offset of -1.
+    """
+
+    def __init__(self, index, data, offsets):
+        self.index = index
+        self.data = data
+        self.offsets = offsets
+        self.packed = len(offsets)
+
+    def alpha(self, word):
+        """
+        Get the alpha mask of a word
+
+        Parameters
+        ----------
+        word : int
+            The position of the word in the atlas' index
+
+        Returns
+        -------
+        np.ndarray or None
+            A read-only uint8 mask. For packed words this is a view into the
+            shared buffer. None if the word image cannot be decoded
+        """
+
+        if word >= self.packed:
+            return read_alpha(self.index.path(word))
+
+        shape = (int(self.index.heights[word]), int(self.index.widths[word]))
+        start = int(self.offsets[word])
+        if start < 0:
+            return None
+
+        return self.data[start:start + shape[0] * shape[1]].reshape(shape)
+
+    @classmethod
+    def build(cls, index, file, budget_mb=ATLAS_BUDGET_MB):
+        """
+        Decode and pack the words of `index` into `file`
+
+        Words are packed in index order until `budget_mb` is exhausted. Words
+        that cannot be decoded are given an offset of -1. The buffer is saved
+        to `file` and the offset table to `file`.offsets.npy, each written
+        under a temporary name first so that readers never see a partial
+        atlas.
+        """
+
+        sizes = index.heights.astype(np.int64) * index.widths.astype(np.int64)
+        ends = np.cumsum(sizes)
+        packed = int(np.searchsorted(ends, budget_mb * 1024 * 1024,
+                                     side='right'))
+
+        offsets = np.concatenate(([0], ends[0:packed]))
+        total = int(offsets[-1])
+        offsets = offsets[0:packed]
+
+        tmp_file = "{}.{}.tmp".format(file, os.getpid())
+        data = np.memmap(tmp_file, dtype=np.uint8, mode='w+',
+                         shape=(max(total, 1),))
+
+        unreadable = []
+
+        for word in range(packed):
+            img = cv2.imread(index.path(word), cv2.IMREAD_GRAYSCALE)
+
+            # The index trusts the image header; a corrupt body is only
+            # found here. Its slot is left empty
+            if img is None or img.shape != (index.heights[word],
+                                            index.widths[word]):
+                print("Skipping unreadable word image {}".format(
+                    index.path(word)), file=sys.stderr)
+                unreadable.append(word)
+                continue
+
+            data[offsets[word]:offsets[word] + sizes[word]] = \
+                (255 - img).ravel()
+
+        data.flush()
+        del data
+
+        offsets[unreadable] = -1
+
+        tmp_offsets = "{}.{}.offsets.npy".format(file, os.getpid())
+        np.save(tmp_offsets, offsets)
+
+        os.replace(tmp_file, file)
+        os.replace(tmp_offsets, file + ".offsets.npy")
+
+    @classmethod
+    def open(cls, index, file):
+        """ Map an atlas previously built into `file`, read-only. """
+
+        offsets = np.load(file + ".offsets.npy")
+        data = np.memmap(file, dtype=np.uint8, mode='r')
+
+        return cls(index, data, offsets)
+
+
+def atlas_file(index, budget_mb=ATLAS_BUDGET_MB, tmp_dir=TMP_DIR):
+    """ The file the atlas of `index` is kept in. """
+
+    root = hashlib.sha1(os.path.abspath(index.root).encode("utf-8"))
+
+    return os.path.join(tmp_dir, "word_atlas_{}_{}_{}.bin".format(
+        root.hexdigest()[0:12], index.signature[0:12], budget_mb))
+
+
+def load_atlas(index, budget_mb=ATLAS_BUDGET_MB, tmp_dir=TMP_DIR):
+    """
+    Get the atlas of a word index, building it if needed
+
+    Parameters
+    ----------
+    index : word_index.WordIndex
+        The words to pack
+    budget_mb : int, optional
+        The maximum size of the atlas, in megabytes
+    tmp_dir : str, optional
+        Where the atlas is kept. This should be a RAM backed folder such as
+        /dev/shm so that all workers share the same pages
+
+    Returns
+    -------
+    WordAtlas
+
+    Building is best done once, in the parent process, before starting the
+    pool. Processes that need the same atlas at the same time take turns
+    through `file`.lock, so it is only built once. Atlases of older versions
+    of the same folder are removed.
+    """
+
+    file = atlas_file(index, budget_mb, tmp_dir)
+
+    if file in _atlases:
+        return _atlases[file]
+
+    if not os.path.isfile(file + ".offsets.npy"):
+        with open(file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Another process may have built it while this one waited
+            if not os.path.isfile(file + ".offsets.npy"):
+                remove_stale_atlases(file)
+                WordAtlas.build(index, file, budget_mb)
+
+    atlas = WordAtlas.open(index, file)
+    _atlases[file] = atlas
+
+    return atlas
+
+
+def remove_stale_atlases(file):
+    """ Remove the atlases of older versions of the folder of `file`. """
+
+    folder, base = os.path.split(file)
+    prefix = base.rsplit("_", 2)[0] + "_"
+
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and not name.startswith(base):
+            # Another process may be removing the same files
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
+
+def word_alpha(index, word):
+    """
+    Get the alpha mask of a word of `index`
+
+    Reads from the shared atlas when it is enabled in settings.ini and from
+    disk, through the LRU cache, otherwise.
+    """
+
+    if ATLAS_ENABLED:
+        return load_atlas(index).alpha(word)
+
+    return read_alpha(index.path(word))
@@ -0,0 +1,268 @@
+"""
+A persistent index of handwritten word images
+
+Listing the handwriting folder for every placed word is prohibitively slow on
+large word sets such as IAM (~115k files). Instead, the folder is scanned once
+and an array-backed index (path, height, width and writer of every word image)
+is saved to the cache directory. Later runs reload the index in a fraction of
+a second, as long as the folder has not changed since it was built.
+"""
+import configparser
+import hashlib
+import os
+import random
+import struct
+
+import cv2
+import numpy as np
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read("settings.ini")
+
+CACHE_DIR = CONFIG.get('DIRECTORIES', 'cache_dir', fallback="./cache/")
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+# Bumped whenever the on-disk layout of the index changes
+INDEX_VERSION = 1
+
+_loaded_indexes = {}
+
+
+def folder_signature(root):
+    """
+    Fingerprint the structure of a folder tree
+
+    Parameters
+    ----------
+    root : str
+        The folder to fingerprint
+
+    Returns
+    -------
+    str
+        A digest of the path and modification time of every directory in the
+        tree. Adding, removing or renaming a file changes the modification
+        time of its directory, and so the signature.
+    """
+
+    digest = hashlib.sha1()
+
+    pending = [root]
+    while pending:
+        folder = pending.pop()
+        digest.update("{}:{}\n".format(os.path.relpath(folder, root),
+                                       os.stat(folder).st_mtime_ns).encode())
+
+        with os.scandir(folder) as entries:
+            pending += sorted((e.path for e in entries if e.is_dir()),
+                              reverse=True)
+
+    return digest.hexdigest()
+
+
+def image_size(path):
+    """
+    Get the (height, width) of an image without decoding it, if possible
+
+    PNG dimensions are read straight from the IHDR chunk. Other formats are
+    decoded. Returns None for files that cannot be read as an image.
+    """
+
+    with open(path, 'rb') as image_file:
+        header = image_file.read(24)
+
+    if header[:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", header[16:24])
+        return height, width
+
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+
+    return img.shape[0:2]
+
+
+def writer_key(path):
+    """
+    Get the key identifying the writer of a word image
+
+    For IAM style names (e.g. a01-000u-00-00.png) this is the form id
+    (a01-000u), as every form was written by a single writer.
+    """
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+
+    return "-".join(stem.split("-")[0:2])
+
+
+class WordIndex:
+    """
+    An index of the word images below a folder
+
+    Words are stored in parallel arrays, so the index of a word is enough to
+    get its path, dimensions and writer:
+
+    paths : np.ndarray of bytes
+        Paths relative to `root`, utf-8 encoded
+    heights, widths : np.ndarray of uint16
+        The dimensions of each word image
+    writers : np.ndarray of int32
+        Each word's writer, as an index into `writer_keys`
+    """
+
+    def __init__(self, root, paths, heights, widths, writers, writer_keys,
+                 signature):
+        self.root = root
+        self.paths = paths
+        self.heights = heights
+        self.widths = widths
+        self.writers = writers
+        self.writer_keys = writer_keys
+        self.signature = signature
+
+    def __len__(self):
+        return len(self.paths)
+
+    def path(self, index):
+        """ The full path of the word at `index`. """
+
+        return os.path.join(self.root, self.paths[index].decode("utf-8"))
+
+    def random_index(self, rng=random):
+        """ Pick a word uniformly at random, in O(1). """
+
+        return rng.randrange(len(self.paths))
+
+    def random_path(self, rng=random):
+        """ The full path of a word picked uniformly at random. """
+
+        return self.path(self.random_index(rng))
+
+    @classmethod
+    def build(cls, root, signature=None):
+        """ Scan `root` and build a new index of every word image below it. """
+
+        if signature is None:
+            signature = folder_signature(root)
+
+        paths = []
+        heights = []
+        widths = []
+        writers = []
+        writer_ids = {}
+
+        for folder, subfolders, files in os.walk(root):
+            subfolders.sort()
+
+            for name in sorted(files):
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+
+                full_path = os.path.join(folder, name)
+                size = image_size(full_path)
+                if size is None or min(size) == 0:
+                    continue
+
+                key = writer_key(name)
+                writers.append(writer_ids.setdefault(key, len(writer_ids)))
+                paths.append(os.path.relpath(full_path, root).encode("utf-8"))
+                heights.append(size[0])
+                widths.append(size[1])
+
+        if not paths:
+            raise OSError("{} folder contains no word images".format(root))
+
+        writer_keys = sorted(writer_ids, key=writer_ids.get)
+
+        return cls(root,
+                   np.array(paths, dtype=bytes),
+                   np.array(heights, dtype=np.uint16),
+                   np.array(widths, dtype=np.uint16),
+                   np.array(writers, dtype=np.int32),
+                   np.array(writer_keys, dtype=str),
+                   signature)
+
+    def save(self, file):
+        """ Atomically save the index to `file`. """
+
+        tmp_file = "{}.{}.tmp".format(file, os.getpid())
+
+        with open(tmp_file, 'wb') as index_file:
+            np.savez(index_file,
+                     version=INDEX_VERSION,
+                     paths=self.paths,
+                     heights=self.heights,
+                     widths=self.widths,
+                     writers=self.writers,
+                     writer_keys=self.writer_keys,
+                     signature=self.signature)
+
+        os.replace(tmp_file, file)
+
+    @classmethod
+    def load(cls, file, root):
+        """ Load an index previously saved to `file`. """
+
+        with np.load(file) as data:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError("Outdated word index {}".format(file))
+
+            return cls(root,
+                       data['paths'],
+                       data['heights'],
+                       data['widths'],
+                       data['writers'],
+                       data['writer_keys'],
+                       str(data['signature']))
+
+
+def index_file(root, cache_dir=CACHE_DIR):
+    """ The cache file the index of `root` is saved to. """
+
+    key = hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()
+
+    return os.path.join(cache_dir, "words_{}.npz".format(key[0:16]))
+
+
+def load_index(root, cache_dir=CACHE_DIR):
+    """
+    Get the word index of a folder
+
+    Parameters
+    ----------
+    root : str
+        The folder holding the word images
+    cache_dir : str, optional
+        Where indexes are saved
+
+    Returns
+    -------
+    WordIndex
+
+    The saved index is reused if the folder is unchanged since it was built.
+    Otherwise the folder is rescanned and the index saved again. Indexes are
+    also kept in memory, so this is cheap to call once per Document.
+    """
+
+    if root in _loaded_indexes:
+        return _loaded_indexes[root]
+
+    file = index_file(root, cache_dir)
+    signature = folder_signature(root)
+
+    index = None
+    if os.path.isfile(file):
+        try:
+            index = WordIndex.load(file, root)
+        except (OSError, ValueError, KeyError):
+            index = None
+
+    if index is None or index.signature != signature:
+        index = WordIndex.build(root, signature)
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(file)
+
+    _loaded_indexes[root] = index
+
+    return index
@@ -12,9 +12,12 @@ import re
 #Macro
 WHITE = [255, 255, 255]
 
-#Read a file to load word images
-word_image_location_file = open("paths/word_image_folder_paths.txt","r")
-word_image_folder_list = word_image_location_file.readlines()
+#Read a file to load word images. Only the script below needs it, so the
+#transform functions can be imported without it
+word_image_folder_list = []
+if os.path.isfile("paths/word_image_folder_paths.txt"):
+    word_image_location_file = open("paths/word_image_folder_paths.txt","r")
+    word_image_folder_list = word_image_location_file.readlines()
 for idx, item in enumerate(word_image_folder_list):
     word_image_folder_list[idx] = item.rstrip('\r\n')
 #print("Word input folders")
@@ -161,7 +164,7 @@ def apply_rotation(im, degree, margin_width):
 
 def apply_shear(im, degree, is_horizontal, margin_width):
     radians = math.tan(degree * math.pi / 180)
-    shear_mat = np.array([ [1, 0, 0], [0, 1, 0] ], dtype=np.float)
+    shear_mat = np.array([ [1, 0, 0], [0, 1, 0] ], dtype=np.float64)
     if is_horizontal:
         shear_mat[0,1] = radians
     else: